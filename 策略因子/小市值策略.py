@@ -3,8 +3,16 @@ import numpy as np
 import pandas as pd
 import datetime
 import time
+import sys
 import traceback
 import re
+import gzip
+import pickle
+import json
+import types
+import cProfile
+import pstats
+import tracemalloc
 
 # 为兼容环境中可能缺少的 log.debug 方法：若无则回退到 info
 try:
@@ -24,8 +32,10 @@ def initialize(context):
     """
     # 设置基准为沪深300
     set_benchmark('000300.SS')
-    # 设置佣金为万分之二(手续费等)
-    set_commission(commission_ratio=0.0002, min_commission=5.0)
+    # 设置佣金为万分之二(手续费等)，整手资金分配按同样的费率计算成本
+    context.commission_ratio = 0.0002
+    context.min_commission = 5.0
+    set_commission(commission_ratio=context.commission_ratio, min_commission=context.min_commission)
     # 设置滑点为千分之二
     set_slippage(0.002)
     # 设置成交量比例 
@@ -45,112 +55,2053 @@ def initialize(context):
     
     # 交易结束日期设置（写死的日期）
     context.trading_end_date = datetime.date(2026, 12, 31)  
+    # 调仓日遇节假日时的处理：'previous' 提前到本周此前最近的交易日(周五休市改为周四等)，'next' 顺延到本周此后最近的交易日，'skip' 本周不调仓
+    context.rebalance_roll = 'previous'
+    context.liquidated_on = None  # 最近一次执行最终清仓的日期，同一天只清仓一次
+    context.liquidation_done = False  # 最终清仓后持仓已全部清空
+    # 预筛股票池：开启后选股从每日构建一次的基础池开始(剔除科创板/创业板/北交所、上市不满2年和ST)，
+    # 振幅、乖离率、换手率等按分位数剔除的阶段随之以该池为样本；universe_index(如'000852.SS')、
+    # universe_blocks(所属板块代码或名称列表)不为None时再与之取交集
+    context.universe_prescreen = False
+    context.universe_index = None
+    context.universe_blocks = None
+    # 流动性容量：单只满仓金额(总资产/selection_count)超过近capacity_adv_days日日均成交额的capacity_participation时，
+    # 'flag' 只输出告警和容量上限，'drop' 剔除该股票由后续排名递补，None(默认)不检查
+    context.capacity_mode = None
+    context.capacity_participation = 0.1
+    context.capacity_adv_days = 20
+    # 盘中风控(仅交易端)：run_interval每risk_interval_seconds秒用一次批量快照检查持仓，在risk_start_time至risk_end_time之间，
+    # 现价低于成本risk_stop_loss、低于持仓以来最高价risk_trailing_stop或触及跌停(risk_limit_down)时卖出；None表示不启用该规则
+    context.risk_monitor_enabled = False
+    context.risk_interval_seconds = 3
+    context.risk_stop_loss = 0.08
+    context.risk_trailing_stop = 0.12
+    context.risk_limit_down = True
+    context.risk_start_time = '09:40'
+    context.risk_end_time = '14:55'
     
+    # 平台接口录制：开启后把接口参数与返回值写入研究目录，供离线回放脚本复现某一天的运行
+    context.api_trace_enabled = False
+    context.api_trace_dir = 'small_cap_trace'
+    # 热点性能分析：开启后每次调仓输出cProfile统计、火焰图折叠栈与内存分配快照，关闭时无任何包装
+    context.profiling_enabled = False
+    context.profiling_dir = 'small_cap_profile'
+    # 调仓内存上限(MB)：行情/财务数据表按紧凑类型存储；设置后用tracemalloc统计每次调仓期间的分配峰值，超过上限时告警；None表示不追踪、不检查
+    context.memory_limit_mb = None
+    # 两段式调仓：先卖后买，买入按卖单实际回笼的现金计算；交易端最多等待buy_deadline_minutes分钟。
+    # 默认关闭(一次性调仓)，设为True开启
+    context.two_phase_rebalance = False
+    context.buy_deadline_minutes = 10
+    # 执行方式：'direct' 09:35一次性下单；'twap'/'pov' 交易端在execution_window_minutes内拆成子单，
+    # 每execution_slice_seconds秒一笔，子单不超过近期成交量的execution_participation(与set_volume_ratio一致)
+    context.execution_mode = 'direct'
+    context.execution_window_minutes = 30
+    context.execution_slice_seconds = 60
+    context.execution_participation = 0.1
+    # 盘口定价：交易端按委托数量在对手盘中选择限价，最多穿越limit_max_levels档；无盘口时沿用开盘后5分钟价格
+    context.limit_max_levels = 3
+    # 调仓方式：'rotation' 只买入新增股票、保留股票不动；'full_book' 保留与新增股票按总资产等权再平衡，
+    # 当前权重偏离目标超过rebalance_band才交易，max_turnover(买卖成交额/总资产)为None时不限制换手
+    context.rebalance_mode = 'rotation'
+    context.rebalance_band = 0.02
+    context.max_turnover = None
+    # 整手资金分配：买入按100股整手求解各股股数，使买入金额贴近等权目标并尽量用满资金，按股数下单。
+    # 默认关闭(按order_target_value逐只取整)，设为True开启
+    context.lot_allocation = False
+    # 延迟卖出队列(T+1、停牌、跌停)每日检查时间，与周度调仓无关
+    context.deferred_sell_time = '09:40'
+    # 日志采样：逐只股票的日志每类每次调仓最多输出log_category_limit条(None不限)、每log_sample_every条取1条，
+    # 其余只计数并汇总；log_level高于'info'时逐只日志不再格式化；log_detail_enabled把完整明细写入研究目录
+    context.log_level = 'info'
+    context.log_category_limit = 20
+    context.log_sample_every = 1
+    context.log_detail_enabled = False
+    context.log_detail_dir = 'small_cap_log'
+    # 运行指标：每次调仓向研究目录 metrics_dir/metrics.db(SQLite) 追加一行漏斗耗时、接口调用、委托与成交记录；
+    # 默认关闭，需要周报时在此设为True，离线回测用 小市值策略_滚动回测.py --metrics 开启
+    context.metrics_enabled = False
+    context.metrics_dir = 'small_cap_metrics'
+    # 共享行情数据：同一主机运行多份不同参数的策略时，一份设为'publisher'在盘前取全市场日线与基本面写入研究目录shared_data_dir，
+    # 其余设为'reader'以内存映射读取当日快照，平台数据请求不随策略份数增加；None表示不共享，直接调用平台接口
+    context.shared_data_role = None
+    context.shared_data_dir = 'small_cap_shared'
+    context.shared_history_days = 30
+    context.shared_history_fields = ['open', 'high', 'low', 'close', 'volume']
+    # 本地日线归档：盘后把当日K线追加到研究目录bar_archive_dir的内存映射数组，选股价格阶段从归档切片读取窗口；
+    # 首次运行取最近bar_archive_bootstrap_days个交易日，复牌股票回补最近bar_archive_repair_days个交易日的空缺
+    context.bar_archive_enabled = False
+    context.bar_archive_dir = 'small_cap_bars'
+    context.bar_archive_fields = ['open', 'high', 'low', 'close', 'volume']
+    context.bar_archive_bootstrap_days = 60
+    context.bar_archive_repair_days = 20
+    # 复权方式：None不复权(与原来的get_history一致)，'pre'前复权，'post'后复权；归档K线读取时按缓存的除权除息因子变换
+    context.price_adjust = None
+    # 滚动统计：随本地日线归档每日更新振幅与乖离率所需的窗口最高/最低价和均价，选股时直接读取当前值(需开启bar_archive_enabled)
+    context.rolling_stats_enabled = False
+    _setup_runtime(context)
+
+
+def _setup_runtime(context):
+    """
+    按 initialize 中的设置配置日志、初始化全局变量、安装接口包装并注册定时任务。
+    这些设置在此之后修改不再生效；离线回测覆盖参数后才调用本函数。
+    """
+    _configure_logging(context)
     # 初始化全局变量
     g.recent_orders = []  # 用于跟踪最近的订单
+    g.order_book = {}  # 订单簿: 订单ID -> 状态/成交数量/成交均价，由委托与成交主推维护
+    g.pending_buys = None  # 两段式调仓中等待卖单成交的买入计划
+    g.exec_parents = {}  # 分片执行母单: 母单ID -> 目标数量/已成交/当前子单/状态
+    g.exec_seq = 0  # 母单编号计数器，只增不减，清理旧母单后编号也不重复
+    g.metrics_run = None  # 当日调仓的运行指标，盘后写完即清空
+    g.risk_peaks = {}  # 盘中风控: 持仓代码 -> 持仓以来最高价(移动止损)
+    g.risk_exits = None  # 盘中风控当日已触发的代码与统计
+    if context.api_trace_enabled:
+        _install_api_recorder(context)
+    if context.profiling_enabled:
+        _install_profiling_hooks(context)
+    if context.metrics_enabled:
+        _install_api_counter(context)
+    if context.shared_data_role in ('publisher', 'reader'):
+        _install_shared_reader(context)
     try:
         if 'is_trade' in globals() and is_trade():
             run_daily(context, trade_rotation, time='09:35')
             log.info('交易端：已注册09:35调仓定时任务')
+            if context.two_phase_rebalance:
+                run_interval(context, pending_buy_worker, seconds=3)
+            if context.execution_mode != 'direct':
+                run_interval(context, execution_worker, seconds=3)
+            if context.risk_monitor_enabled:
+                run_interval(context, risk_monitor_worker, seconds=max(3, int(context.risk_interval_seconds)))
     except Exception as e:
         log.warning(f'注册交易端定时任务失败: {e}')
+    try:
+        run_daily(context, deferred_sell_worker, time=context.deferred_sell_time)
+    except Exception as e:
+        log.warning(f'注册延迟卖出任务失败: {e}')
+
+def before_trading_start(context, data):
+    """
+    交易端盘前处理：撤销未完成订单，避免冲突；共享行情数据的发布者在此发布当日快照。
+    """
+    _trace_event(context, 'before_trading_start')
+    try:
+        if 'is_trade' in globals() and is_trade():
+            try:
+                open_orders = get_open_orders()
+                for order_id in list((open_orders or {}).keys()):
+                    try:
+                        cancel_order(order_id)
+                    except Exception as e:
+                        log.warning(f'撤销订单失败 {order_id}: {e}')
+            except Exception as e:
+                log.warning(f'盘前撤销订单异常: {e}')
+    except Exception as e:
+        log.warning(f'before_trading_start 异常: {e}')
+    if getattr(context, 'shared_data_role', None) == 'publisher':
+        publish_shared_data(context)
+
+def _trade_field(trade, *names):
+    for name in names:
+        value = trade.get(name) if isinstance(trade, dict) else getattr(trade, name, None)
+        if value is not None:
+            return value
+    return None
+
+
+def _is_buy_trade(trade):
+    # get_trades记录用side，成交主推用entrust_bs('1'买/'2'卖)
+    side = _trade_field(trade, 'side', 'entrust_bs')
+    return str(side).upper() in ('BUY', 'B', 'BUY_OPEN', '1')
+
+
+def _bought_today(context):
+    """
+    当日有买入成交的代码集合(T+1卖出保护)。
+    每个交易日首次使用时调用一次get_trades建立索引，之后由on_trade_response增量维护。
+    get_trades失败时保存只含成交主推增量的部分索引并标记待重建，下次使用时重试，成功后与已有增量合并。
+    """
+    today = context.current_dt.date()
+    index = getattr(context, 'bought_today', None)
+    if index is None or index['date'] != today:
+        index = context.bought_today = {'date': today, 'codes': set(), 'rebuild': True}
+    if not index.get('rebuild'):
+        return index['codes']
+    try:
+        trades = get_trades()
+    except Exception as e:
+        log.warning(f'获取当日成交失败，本次T+1检查仅依据成交主推，下次使用时重建: {e}')
+        return index['codes']
+    # 兼容多种返回结构；原地更新集合，保留失败期间成交主推加入的代码
+    for t in _iter_trades(trades):
+        code = _trade_field(t, 'security', 'stock_code')
+        if code and _is_buy_trade(t):
+            index['codes'].add(code)
+    index['rebuild'] = False
+    return index['codes']
+
+
+# 订单簿最多保留的订单数，超出时优先淘汰最早的已结束订单
+_ORDER_BOOK_LIMIT = 500
+# 交易端未完成订单超过该秒数没有收到主推时，才用get_order轮询对账
+_ORDER_RECONCILE_SECONDS = 60
+# 对账时get_order连续查不到的次数上限，超过后不再跟踪
+_ORDER_MISS_LIMIT = 3
+# 委托状态码 -> 订单状态；不在表中的(已报、待报等)视为open
+_ORDER_STATES = {'8': 'filled', '7': 'partial', '6': 'cancelled', '5': 'cancelled', '9': 'rejected'}
+_ORDER_FINAL_STATES = ('filled', 'cancelled', 'rejected')
+
+
+def _order_entry(order_id, security=None):
+    book = g.order_book if hasattr(g, 'order_book') else None
+    if book is None:
+        book = g.order_book = {}
+    entry = book.get(order_id)
+    if entry is None:
+        entry = book[order_id] = {'id': order_id, 'security': security, 'amount': 0, 'filled': 0,
+                                  'traded': 0, 'value': 0.0, 'avg_price': 0.0, 'status': None, 'state': 'open',
+                                  'trade_ids': [], 'misses': 0, 'updated': time.time(),
+                                  'side': None, 'reference': None, 'limit': None, 'submitted': None,
+                                  'first_fill': None, 'last_fill': None, 'fill_source': None, 'exported': False}
+        _trim_order_book(book)
+    elif security and not entry['security']:
+        entry['security'] = security
+    return entry
+
+
+def _trim_order_book(book):
+    if len(book) <= _ORDER_BOOK_LIMIT:
+        return
+    finished = [oid for oid, e in book.items() if e['state'] in _ORDER_FINAL_STATES]
+    for oid in (finished + list(book.keys()))[:len(book) - _ORDER_BOOK_LIMIT]:
+        book.pop(oid, None)
+
+
+def _order_clock(context):
+    """订单时间戳(秒)：交易端用系统时间，回测中用当前K线时间"""
+    if 'is_trade' in globals() and is_trade():
+        return time.time()
+    return time.mktime(context.current_dt.timetuple())
+
+
+def _register_order(context, order_id, security, side=None, reference=None, limit=None):
+    """
+    下单后登记订单；主推可能先于登记到达，此时只补全代码不覆盖状态。
+    side(1买/-1卖)、reference(09:35参考价)和limit(委托限价)供盘后执行质量分析使用。
+    """
+    if order_id in (getattr(g, 'exec_parents', None) or {}):
+        return
+    try:
+        entry = _order_entry(order_id, security)
+        if entry.get('submitted') is None:
+            entry['submitted'] = _order_clock(context)
+        if side is not None:
+            entry['side'] = side
+        if reference:
+            entry['reference'] = float(reference)
+        if limit:
+            entry['limit'] = float(limit)
+        _metric_order(order_id)
+    except Exception as e:
+        log.warning(f'登记订单{order_id}失败: {e}')
+
+
+def _apply_order_status(entry, status, filled=None, amount=None):
+    if status is not None:
+        entry['status'] = str(status)
+        entry['state'] = _ORDER_STATES.get(entry['status'], 'open')
+    if amount:
+        entry['amount'] = abs(int(amount))
+    # 委托主推/查询给出的是累计成交数量，只增不减，避免与成交主推乱序时回退
+    if filled is not None and abs(int(filled)) > entry['filled']:
+        entry['filled'] = abs(int(filled))
+    entry['updated'] = time.time()
+
+
+def on_order_response(context, order_list):
+    """委托主推：更新订单簿中的订单状态"""
+    _trace_event(context, 'on_order_response', order_list)
+    try:
+        for record in order_list or []:
+            order_id = _trade_field(record, 'order_id', 'entrust_no')
+            if not order_id:
+                continue
+            entry = _order_entry(order_id, _trade_field(record, 'stock_code', 'security'))
+            _apply_order_status(entry, _trade_field(record, 'status'),
+                                _trade_field(record, 'business_amount', 'filled'), _trade_field(record, 'amount'))
+    except Exception as e:
+        log.warning(f'处理委托主推异常: {e}')
+
+
+def on_trade_response(context, trade_list):
+    """成交主推：增量更新当日买入索引，并累计订单成交数量与成交均价"""
+    _trace_event(context, 'on_trade_response', trade_list)
+    try:
+        codes = _bought_today(context)
+        for trade in trade_list or []:
+            code = _trade_field(trade, 'stock_code', 'security')
+            if code and _is_buy_trade(trade):
+                codes.add(code)
+            order_id = _trade_field(trade, 'order_id', 'entrust_no')
+            if not order_id:
+                continue
+            entry = _order_entry(order_id, code)
+            trade_id = _trade_field(trade, 'business_id')
+            if trade_id is not None:
+                if trade_id in entry['trade_ids']:
+                    continue
+                entry['trade_ids'].append(trade_id)
+            qty = abs(float(_trade_field(trade, 'business_amount', 'amount') or 0))
+            price = float(_trade_field(trade, 'business_price', 'price') or 0)
+            if qty > 0:
+                now = _order_clock(context)
+                entry['first_fill'] = entry.get('first_fill') or now
+                entry['last_fill'] = now
+                entry['fill_source'] = 'push'
+                if entry.get('side') is None and _trade_field(trade, 'side', 'entrust_bs') is not None:
+                    entry['side'] = 1 if _is_buy_trade(trade) else -1
+            entry['value'] += qty * price
+            entry['traded'] += qty
+            if entry['traded'] > 0:
+                entry['avg_price'] = entry['value'] / entry['traded']
+            _apply_order_status(entry, _trade_field(trade, 'status'), entry['traded'])
+    except Exception as e:
+        log.warning(f'处理成交主推异常: {e}')
+
+def after_trading_end(context, data):
+    """
+    盘后处理：关闭当日接口录制文件，确保轨迹完整落盘；汇总盘中定时任务的采样日志和盘中风控；补全当日调仓的运行指标；
+    追加本地日线归档。
+    """
+    _trace_event(context, 'after_trading_end')
+    _log_flush(context)
+    risk = getattr(g, 'risk_exits', None)
+    if risk and risk['date'] == context.current_dt.date() and risk['ticks']:
+        log.info(f'盘中风控: 检查{risk["ticks"]}次, 触发{risk["rules"]}, 卖出{sum(1 for v in risk["codes"].values() if v)}只')
+    _metrics_finalize(context)
+    if getattr(context, 'metrics_enabled', False):
+        _export_executions(context)
+    if getattr(context, 'bar_archive_enabled', False):
+        update_bar_archive(context)
+    if _API_TRACE['file'] is not None:
+        try:
+            _API_TRACE['file'].close()
+        except Exception as e:
+            log.warning(f'关闭接口录制文件失败: {e}')
+        _API_TRACE['file'] = None
+        _API_TRACE['path'] = None
+
+def trade_rotation(context):
+    """
+    交易端定时任务：09:35触发一次选股+调仓；复用 handle_data 逻辑。
+    """
+    _trace_event(context, 'trade_rotation')
+    _API_TRACE['nested'] = True
+    try:
+        handle_data(context, data={})
+    except Exception as e:
+        log.warning(f'交易端定时任务运行异常: {e}')
+    finally:
+        _API_TRACE['nested'] = False
+
+def _normalize_local(code):
+    """本地代码规范化函数 - 保留完整的股票代码格式"""
+    if isinstance(code, str):
+        s = code
+    else:
+        # 处理Position或Security对象
+        s = str(getattr(code, 'security', None) or getattr(code, 'sid', None) or getattr(code, 'code', None) or code)
+    
+    # 标准化股票代码格式，保留后缀
+    # 处理常见格式：000001.SZ, SZ000001, 000001.XSHE, 600000.SS, SH600000
+    s = s.strip()
+    
+    # 如果是 SZ000001 或 SH600000 格式，转换为 000001.SZ 或 600000.SS
+    if s.startswith('SZ') and len(s) == 8:
+        return s[2:] + '.SZ'
+    elif s.startswith('SH') and len(s) == 8:
+        return s[2:] + '.SS'
+    # 如果是 000001.XSHE 格式，转换为 000001.SZ
+    elif s.endswith('.XSHE'):
+        return s.replace('.XSHE', '.SZ')
+    # 如果已经是标准格式（000001.SZ, 600000.SS），直接返回
+    elif '.' in s and (s.endswith('.SZ') or s.endswith('.SS')):
+        return s
+    # 如果只有6位数字，需要根据前缀判断市场
+    elif re.match(r'^\d{6}$', s):
+        if s.startswith(('000', '002', '003', '300')):
+            return s + '.SZ'  # 深市
+        elif s.startswith(('600', '601', '603', '605', '688')):
+            return s + '.SS'  # 沪市
+        else:
+            return s + '.SZ'  # 默认深市
+    else:
+        # 提取6位数字并添加后缀
+        m = re.search(r'(\d{6})', s)
+        if m:
+            code = m.group(1)
+            if code.startswith(('000', '002', '003', '300')):
+                return code + '.SZ'
+            elif code.startswith(('600', '601', '603', '605', '688')):
+                return code + '.SS'
+            else:
+                return code + '.SZ'
+        return s
+
+# 平台接口录制：开启 context.api_trace_enabled 后，下列接口被包装并把参数与返回值
+# 追加写入研究目录下按日切分的 gzip+pickle 轨迹文件；未开启时不做任何包装
+_TRACE_API_NAMES = (
+    'get_history', 'get_price', 'get_fundamentals', 'get_stock_info', 'get_stock_name', 'get_stock_status',
+    'get_Ashares', 'get_snapshot', 'get_gear_price', 'check_limit', 'get_positions', 'get_position',
+    'get_trades', 'get_order', 'get_orders', 'get_open_orders', 'cancel_order', 'is_trade',
+    'get_trade_days', 'get_index_stocks', 'get_stock_blocks', 'get_stock_exrights',
+    'order', 'order_value', 'order_target', 'order_target_value',
+)
+_API_TRACE = {'file': None, 'path': None, 'nested': False, 'pushes': None, 'caches': None}
+# 跨交易日累积的模块级缓存：当天轨迹中没有填充它们的接口调用，录制时随事件保存(每个轨迹文件的首个事件及变化后)，
+# 回放时恢复，否则回放会重新请求交易日历、上市日期等而找不到对应的录制调用
+_TRACE_MODULE_CACHES = ('_SCHEDULE', '_UNIVERSE', '_EXRIGHTS', '_ROLLING', '_BAR_ARCHIVE', '_SHARED_DATA')
+
+def _research_file(subdir, filename):
+    """研究目录下的文件路径；PTrade禁用了os模块，目录通过create_dir创建"""
+    try:
+        create_dir(subdir)
+    except Exception:
+        pass
+    root = get_research_path() if 'get_research_path' in globals() else './'
+    return root.rstrip('/') + '/' + subdir.strip('/') + '/' + filename
+
+def _trace_plain(obj):
+    """把平台返回的对象转换为可pickle的普通结构（对象转为属性命名空间）"""
+    if obj is None or isinstance(obj, (bool, int, float, str, bytes, np.generic, np.ndarray,
+                                       pd.DataFrame, pd.Series, datetime.date, datetime.time)):
+        return obj
+    if isinstance(obj, dict):
+        return dict((k, _trace_plain(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple, set)):
+        return type(obj)(_trace_plain(v) for v in obj)
+    if hasattr(obj, '__dict__'):
+        return types.SimpleNamespace(**dict((k, _trace_plain(v)) for k, v in vars(obj).items()
+                                            if not k.startswith('_')))
+    return repr(obj)
+
+def _trace_write(record):
+    f = _API_TRACE['file']
+    if f is None:
+        return
+    try:
+        pickle.dump(record, f, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        log.warning(f'接口录制写入失败，停止录制: {e}')
+        _API_TRACE['file'] = None
+
+def _traced_api(name, func):
+    # 接口调用期间同步到达的委托/成交主推(如下单即成交)记在该次调用上，回放时在返回前按序送回策略
+    def wrapper(*args, **kwargs):
+        outer = _API_TRACE['pushes']
+        _API_TRACE['pushes'] = []
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            pushes, _API_TRACE['pushes'] = _API_TRACE['pushes'], outer
+            _trace_write(('call', name, args, kwargs, None, repr(e), pushes))
+            raise
+        pushes, _API_TRACE['pushes'] = _API_TRACE['pushes'], outer
+        _trace_write(('call', name, args, kwargs, _trace_plain(result), None, pushes))
+        return result
+    wrapper._traced = True
+    return wrapper
+
+def _install_api_recorder(context):
+    """用录制包装替换模块全局中的平台接口"""
+    ns = globals()
+    wrapped = []
+    for name in _TRACE_API_NAMES:
+        func = ns.get(name)
+        if func is None or getattr(func, '_traced', False):
+            continue
+        ns[name] = _traced_api(name, func)
+        wrapped.append(name)
+    log.info(f'接口录制已开启，包装接口{len(wrapped)}个，轨迹目录: {context.api_trace_dir}')
+
+def _context_state(obj):
+    """提取context/g上可pickle的策略状态，回放时据此恢复"""
+    state = {}
+    for k, v in list(vars(obj).items()):
+        if k.startswith('_') or k in ('portfolio', 'blotter'):
+            continue
+        try:
+            pickle.dumps(v, protocol=pickle.HIGHEST_PROTOCOL)
+            state[k] = v
+        except Exception:
+            continue
+    return state
+
+def _trace_cache_signature():
+    """模块缓存的廉价指纹：各键的标量值或对象身份与长度，缓存内容变化时随之变化"""
+    ns = globals()
+    signature = []
+    for name in _TRACE_MODULE_CACHES:
+        for key, value in sorted(ns[name].items()):
+            if value is None or isinstance(value, (bool, int, float, str, datetime.date, tuple)):
+                signature.append((name, key, value))
+            else:
+                signature.append((name, key, id(value), len(value) if hasattr(value, '__len__') else None))
+    return tuple(signature)
+
+
+def _trace_preload(context):
+    """
+    新轨迹文件开始时先打开当日会用到的文件型缓存(日线归档、除权因子、滚动统计、共享快照)，使其随首个事件录制；
+    这些缓存每个交易日只打开一次，提前打开不改变当天的结果。开启日线归档时轨迹文件会包含归档窗口，体积较大
+    """
+    try:
+        if getattr(context, 'bar_archive_enabled', False):
+            _bar_archive(context)
+            if getattr(context, 'price_adjust', None):
+                _exrights_cache(context)
+            if getattr(context, 'rolling_stats_enabled', False):
+                _rolling_values(context, [], 'bias')
+        if getattr(context, 'shared_data_role', None) == 'reader':
+            _shared_snapshot(context)
+    except Exception as e:
+        log.debug(f'预先打开缓存失败，回放时按接口重新获取: {e}')
+
+
+def _trace_caches(new_file):
+    """本事件需要保存的模块缓存：新轨迹文件的首个事件或缓存变化后返回快照，否则返回None"""
+    signature = _trace_cache_signature()
+    if not new_file and signature == _API_TRACE['caches']:
+        return None
+    _API_TRACE['caches'] = signature
+    caches = {}
+    for name in _TRACE_MODULE_CACHES:
+        try:
+            cache = dict(globals()[name])
+            pickle.dumps(cache, protocol=pickle.HIGHEST_PROTOCOL)
+            caches[name] = cache
+        except Exception as e:
+            log.warning(f'模块缓存{name}无法录制，回放时为空: {e}')
+    return caches
+
+
+def _trace_event(context, name, payload=None):
+    """
+    记录一次平台回调入口：时间、组合快照、策略状态、主推数据(委托/成交列表)与变化后的模块缓存；按交易日切换轨迹文件。
+    在接口调用内部同步到达的主推不另起事件，记在该次调用上。
+    """
+    if not getattr(context, 'api_trace_enabled', False):
+        return
+    if _API_TRACE['pushes'] is not None:
+        _API_TRACE['pushes'].append((name, _trace_plain(payload)))
+        return
+    if _API_TRACE['nested']:
+        return
+    try:
+        day = context.current_dt.strftime('%Y%m%d')
+        path = _research_file(context.api_trace_dir, f'trace_{day}.pkl.gz')
+        new_file = _API_TRACE['path'] != path
+        if new_file:
+            if _API_TRACE['file'] is not None:
+                _API_TRACE['file'].close()
+            _API_TRACE['file'] = gzip.open(path, 'ab', compresslevel=6)
+            _API_TRACE['path'] = path
+            _trace_preload(context)
+        else:
+            _API_TRACE['file'].flush()
+        portfolio = context.portfolio
+        snapshot = {
+            'cash': portfolio.cash,
+            'portfolio_value': portfolio.portfolio_value,
+            'positions': _trace_plain(dict(portfolio.positions)),
+        }
+        _trace_write(('event', name, context.current_dt, snapshot, _context_state(context), _context_state(g),
+                      _trace_plain(payload), _trace_caches(new_file)))
+    except Exception as e:
+        log.warning(f'记录回调事件失败: {e}')
+
+# 热点性能分析：开启 context.profiling_enabled 后包装下列函数；最外层调用期间运行cProfile与tracemalloc，
+# 若本次调用包含选股或调仓则输出 .pstats、.collapsed(火焰图折叠栈) 与 .txt(函数耗时与内存分配Top)
+_PROFILE_TARGETS = ('handle_data', 'get_stock_pool', 'adjust_position', 'get_market_open_price', 'check_order_status')
+_PROFILE_STATE = {'depth': 0, 'profiler': None, 'rebalance': False, 'timings': {}, 'tracemalloc': False}
+
+def _install_profiling_hooks(context):
+    """用性能分析包装替换模块全局中的热点函数"""
+    ns = globals()
+    for name in _PROFILE_TARGETS:
+        func = ns.get(name)
+        if func is None or getattr(func, '_profiled', False):
+            continue
+        ns[name] = _profiled(name, func, context)
+    log.info(f'性能分析已开启，输出目录: {context.profiling_dir}')
+
+def _profiled(name, func, context):
+    def wrapper(*args, **kwargs):
+        state = _PROFILE_STATE
+        outermost = state['depth'] == 0
+        if outermost:
+            _profile_begin()
+        state['depth'] += 1
+        if name in ('get_stock_pool', 'adjust_position'):
+            state['rebalance'] = True
+        t0 = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stat = state['timings'].setdefault(name, [0, 0.0])
+            stat[0] += 1
+            stat[1] += time.time() - t0
+            state['depth'] -= 1
+            if outermost:
+                _profile_end(context)
+    wrapper._profiled = True
+    return wrapper
+
+def _profile_begin():
+    state = _PROFILE_STATE
+    state['rebalance'] = False
+    state['timings'] = {}
+    try:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        state['profiler'] = profiler
+    except Exception as e:
+        # 已有其他分析器运行（如离线回放 --profile）时只统计函数耗时
+        log.debug(f'cProfile启动失败: {e}')
+        state['profiler'] = None
+    # 已在追踪(如离线 python -X tracemalloc)时沿用，结束时也不停止
+    state['tracemalloc'] = not tracemalloc.is_tracing()
+    if state['tracemalloc']:
+        tracemalloc.start()
+
+def _profile_end(context):
+    state = _PROFILE_STATE
+    profiler = state['profiler']
+    state['profiler'] = None
+    if profiler is not None:
+        profiler.disable()
+    snapshot = None
+    peak = 0
+    if tracemalloc.is_tracing():
+        if state['rebalance']:
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+        if state['tracemalloc']:
+            tracemalloc.stop()
+    state['tracemalloc'] = False
+    if not state['rebalance']:
+        return
+    try:
+        stamp = context.current_dt.strftime('%Y%m%d_%H%M%S')
+        lines = ['函数耗时(次数, 累计秒):']
+        for name, (count, total) in sorted(state['timings'].items(), key=lambda x: -x[1][1]):
+            lines.append(f'  {name}: {count}次, {total:.3f}s')
+        lines.append(f'内存分配峰值: {peak / 1024 / 1024:.1f}MB')
+        if snapshot is not None:
+            lines.append('内存分配Top30(按代码行):')
+            for stat in snapshot.statistics('lineno')[:30]:
+                lines.append(f'  {stat}')
+        with open(_research_file(context.profiling_dir, f'profile_{stamp}.txt'), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        if profiler is not None:
+            stats = pstats.Stats(profiler)
+            stats.dump_stats(_research_file(context.profiling_dir, f'profile_{stamp}.pstats'))
+            with open(_research_file(context.profiling_dir, f'profile_{stamp}.collapsed'), 'w') as f:
+                for stack, micros in _collapsed_stacks(stats):
+                    f.write(f'{stack} {micros}\n')
+        # 最外层函数的累计耗时即本次调仓总耗时
+        total = max(t for _, t in state['timings'].values())
+        log.info(f'性能分析已输出 profile_{stamp}: 总耗时{total:.2f}s, 内存峰值{peak / 1024 / 1024:.1f}MB')
+    except Exception as e:
+        log.warning(f'输出性能分析结果失败: {e}')
+
+def _collapsed_stacks(stats, max_depth=64, min_fraction=0.001):
+    """
+    由cProfile调用图近似还原调用栈，输出火焰图工具(flamegraph.pl/speedscope)可读的折叠栈
+    每条路径按调用边的累计耗时比例分摊被调函数的自身耗时，单位微秒；
+    占总耗时比例低于 min_fraction 的路径不再展开，避免调用路径数量爆炸
+    """
+    raw = stats.stats
+    callees = {}
+    for func, (cc, nc, tt, ct, callers) in raw.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, []).append((func, edge[3]))
+    roots = [func for func, value in raw.items() if not value[4]]
+    min_budget = sum(raw[root][3] for root in roots) * min_fraction
+    result = {}
+
+    def label(func):
+        filename, line, name = func
+        base = filename.replace('\\', '/').rsplit('/', 1)[-1]
+        return f'{name}@{base}:{line}'.replace(';', ':').replace(' ', '_')
+
+    def walk(func, budget, path, seen):
+        cc, nc, tt, ct, callers = raw[func]
+        if ct <= 0 or budget < min_budget:
+            return
+        scale = min(budget / ct, 1.0)
+        path = path + [label(func)]
+        key = ';'.join(path)
+        result[key] = result.get(key, 0.0) + tt * scale
+        if len(path) >= max_depth:
+            return
+        children = [(c, t) for c, t in callees.get(func, []) if c not in seen]
+        edge_total = sum(t for _, t in children)
+        if edge_total <= 0:
+            return
+        # 递归调用会使调用边累计耗时重复计入，按父节点的子调用耗时归一化，保证分摊总量守恒
+        share = min(1.0, max(ct - tt, 0.0) / edge_total) * scale
+        for callee, edge_ct in children:
+            walk(callee, edge_ct * share, path, seen | {callee})
+
+    for root in roots:
+        walk(root, raw[root][3], [], {root})
+    return [(stack, int(seconds * 1e6)) for stack, seconds in sorted(result.items()) if seconds * 1e6 >= 1]
+
+
+# 价格类字段用float32足够(A股价格精确到分，7位有效数字)；成交量/金额/市值等保持float64避免大数精度损失
+_FLOAT32_FIELDS = ('open', 'high', 'low', 'close', 'price', 'avg', 'high_limit', 'low_limit', 'preclose')
+
+
+def _compact_frame(df):
+    """
+    把get_history返回的长表压缩为紧凑类型：code列转为category，价格列转为float32。
+    仅用于聚合计算，聚合结果需要比较/除法时再转回float64。
+    """
+    if df is None or not hasattr(df, 'columns') or df.empty:
+        return df
+    try:
+        if 'code' in df.columns and df['code'].dtype == object:
+            df['code'] = df['code'].astype('category')
+        for field in _FLOAT32_FIELDS:
+            if field in df.columns and df[field].dtype == np.float64:
+                df[field] = df[field].astype(np.float32)
+    except Exception as e:
+        log.warning('行情数据类型压缩失败，按原类型继续: %s' % str(e))
+    return df
+
+
+def _compact_fundamentals(df):
+    """
+    把get_fundamentals返回的表压缩为紧凑类型：重复较多的文本列(代码、报告期、公告日)转为category，
+    浮点列转为float32，整数列在取值范围内转为int32；索引不变，按股票代码筛选的写法不受影响。
+    财务数值只用于正负、阈值和排序判断，float32的7位有效数字足够；返回dict等其他格式时原样返回。
+    """
+    if df is None or not hasattr(df, 'columns') or df.empty:
+        return df
+    try:
+        for column in df.columns:
+            series = df[column]
+            if series.dtype == object:
+                if series.nunique(dropna=True) * 2 < len(series):
+                    df[column] = series.astype('category')
+            elif series.dtype == np.float64:
+                df[column] = series.astype(np.float32)
+            elif series.dtype == np.int64 and len(series) and \
+                    np.iinfo(np.int32).min <= series.min() and series.max() <= np.iinfo(np.int32).max:
+                df[column] = series.astype(np.int32)
+    except Exception as e:
+        log.warning('财务数据类型压缩失败，按原类型继续: %s' % str(e))
+    return df
+
+
+def _frame_bytes(*frames):
+    total = 0
+    for df in frames:
+        try:
+            if hasattr(df, 'memory_usage'):
+                usage = df.memory_usage(index=True, deep=True)
+                total += int(usage.sum() if hasattr(usage, 'sum') else usage)
+        except Exception:
+            continue
+    return total
+
+
+def _process_peak_mb():
+    """
+    进程启动以来的峰值常驻内存(MB)，不是本次调仓的峰值，只会单调上升；平台不支持resource模块时返回None
+    """
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss 在macOS上单位为字节，Linux等其他平台为KB
+        return peak / 1024.0 / (1024.0 if sys.platform == 'darwin' else 1.0)
+    except Exception:
+        return None
+
+
+def _begin_memory_report(context):
+    """
+    开始记录本次调仓的内存：设置了 memory_limit_mb 时用tracemalloc统计本次调仓期间Python(含numpy/pandas)分配的峰值，
+    未在追踪时本函数开启、调仓结束时关闭；已在追踪(性能分析或 python -X tracemalloc)时以开始时的占用为基准相减
+    """
+    stale = getattr(context, 'rebalance_memory', None)
+    if stale and stale.get('owner') and tracemalloc.is_tracing():
+        # 上次调仓异常退出未结束记录，先关闭其开启的追踪
+        tracemalloc.stop()
+    report = {'peak_bytes': 0, 'peak_stage': None, 'stages': [], 'traced': False, 'owner': False, 'base': 0}
+    if getattr(context, 'memory_limit_mb', None):
+        try:
+            report['owner'] = not tracemalloc.is_tracing()
+            if report['owner']:
+                tracemalloc.start()
+            report['base'] = tracemalloc.get_traced_memory()[0]
+            report['traced'] = True
+        except Exception as e:
+            log.warning('开启调仓内存追踪失败，只统计数据表占用: %s' % str(e))
+    context.rebalance_memory = report
+
+
+def _track_memory(context, stage, *frames):
+    """记录某一阶段同时存活的数据表占用，更新最大阶段"""
+    report = getattr(context, 'rebalance_memory', None)
+    if report is None:
+        return
+    size = _frame_bytes(*frames)
+    report['stages'].append((stage, size))
+    if size > report['peak_bytes']:
+        report['peak_bytes'] = size
+        report['peak_stage'] = stage
+
+
+def _rebalance_peak_bytes(report):
+    """本次调仓的内存峰值：开启追踪时为tracemalloc峰值减去开始时的占用，否则为最大阶段的数据表合计"""
+    if report.get('traced') and tracemalloc.is_tracing():
+        return max(tracemalloc.get_traced_memory()[1] - report['base'], 0)
+    return report['peak_bytes']
+
+
+def _end_memory_report(context):
+    report = getattr(context, 'rebalance_memory', None)
+    if not report:
+        return
+    context.rebalance_memory = None
+    table_mb = report['peak_bytes'] / 1024.0 / 1024.0
+    rss_mb = _process_peak_mb()
+    detail = ', '.join('%s=%.2fMB' % (stage, size / 1024.0 / 1024.0) for stage, size in report['stages'])
+    traced_mb = _rebalance_peak_bytes(report) / 1024.0 / 1024.0 if report['traced'] else None
+    if report['owner'] and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    log.info('调仓内存: %s最大阶段数据表 %.2fMB(%s), 进程启动以来峰值 %s; 各阶段: %s' % (
+        '本次调仓分配峰值 %.2fMB, ' % traced_mb if traced_mb is not None else '', table_mb, report['peak_stage'],
+        '%.1fMB' % rss_mb if rss_mb is not None else '未知', detail))
+    limit = getattr(context, 'memory_limit_mb', None)
+    if limit and traced_mb is not None and traced_mb > limit:
+        log.warning('本次调仓内存分配峰值 %.1fMB 超过上限 %sMB' % (traced_mb, limit))
+
+# 日志门面：逐只股票的日志按类别计数，每个类别每次调仓最多输出 log_category_limit 条、每 log_sample_every 条取1条，
+# 参数只在真正输出时才格式化；被抑制的条数在调仓结束时汇总输出，开启 log_detail_enabled 后完整明细写入研究目录
+_LOG_LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+_LOG_STATE = {'level': 20, 'limit': 20, 'sample': 1, 'counts': {}, 'emitted': {}, 'detail': None,
+              'detail_dir': 'small_cap_log'}
+
+
+def _configure_logging(context):
+    _LOG_STATE['level'] = _LOG_LEVELS.get(str(getattr(context, 'log_level', 'info')).lower(), 20)
+    _LOG_STATE['limit'] = getattr(context, 'log_category_limit', 20)
+    _LOG_STATE['sample'] = max(int(getattr(context, 'log_sample_every', 1) or 1), 1)
+    _LOG_STATE['detail'] = [] if getattr(context, 'log_detail_enabled', False) else None
+    _LOG_STATE['detail_dir'] = getattr(context, 'log_detail_dir', 'small_cap_log')
+
+
+def _log_event(category, level, fmt, *args):
+    """按类别采样/限流的日志；未输出的记录不做格式化，明细开启时只保存参数，落盘时再格式化"""
+    state = _LOG_STATE
+    if state['detail'] is not None:
+        state['detail'].append((category, level, fmt, args))
+    if _LOG_LEVELS.get(level, 20) < state['level']:
+        return
+    count = state['counts'].get(category, 0) + 1
+    state['counts'][category] = count
+    limit = state['limit']
+    if (limit is not None and count > limit) or (count - 1) % state['sample']:
+        return
+    state['emitted'][category] = state['emitted'].get(category, 0) + 1
+    getattr(log, level, log.info)(fmt % args if args else fmt)
+
+
+def _log_summary(title, values, top_k=5, reverse=True, unit=''):
+    """用一条汇总记录代替逐只日志：数量、最小/分位数/最大值和前top_k只"""
+    items = [(k, float(v)) for k, v in values.items() if v is not None and np.isfinite(v)]
+    if not items:
+        log.info('%s: 共%d只, 无有效数值' % (title, len(values)))
+        return
+    arr = np.array([v for _, v in items])
+    p10, p50, p90 = np.percentile(arr, [10, 50, 90])
+    top = sorted(items, key=lambda x: x[1], reverse=reverse)[:top_k]
+    log.info('%s: 共%d只, 最小%.2f%s, P10 %.2f%s, 中位%.2f%s, P90 %.2f%s, 最大%.2f%s; %s%d: %s' % (
+        title, len(values), arr.min(), unit, p10, unit, p50, unit, p90, unit, arr.max(), unit,
+        '最高' if reverse else '最低', len(top), ', '.join('%s=%.2f%s' % (k, v, unit) for k, v in top)))
+
+
+def _stock_name(context, code):
+    """日志用的股票名称，只读选股时缓存的名称，不为拼日志调用get_stock_info"""
+    return (getattr(context, 'stock_names', None) or {}).get(code, '')
+
+
+def _named(context, codes):
+    return ', '.join('%s(%s)' % (code, _stock_name(context, code)) for code in codes)
+
+
+def _log_flush(context):
+    """输出各类别被抑制的条数并重置计数；明细开启时把本次全部记录写入研究目录"""
+    state = _LOG_STATE
+    suppressed = []
+    for category, count in sorted(state['counts'].items()):
+        emitted = state['emitted'].get(category, 0)
+        if count > emitted:
+            suppressed.append('%s %d/%d' % (category, emitted, count))
+    if suppressed:
+        log.info('日志采样(已输出/总数): %s' % ', '.join(suppressed))
+    detail = state['detail']
+    if detail:
+        try:
+            stamp = context.current_dt.strftime('%Y%m%d_%H%M%S')
+            path = _research_file(state['detail_dir'], 'detail_%s.log' % stamp)
+            with open(path, 'a') as f:
+                for category, level, fmt, args in detail:
+                    f.write('%s\t%s\t%s\n' % (category, level, fmt % args if args else fmt))
+            log.info('日志明细已写入 %s: %d条' % (path, len(detail)))
+        except Exception as e:
+            log.warning('写入日志明细失败: %s' % str(e))
+    state['counts'] = {}
+    state['emitted'] = {}
+    if detail is not None:
+        state['detail'] = []
+
+# 运行指标：开启 context.metrics_enabled 后，每次调仓向研究目录下的SQLite库写入一行记录(漏斗各阶段数量与耗时、
+# 接口调用次数、委托数量、资金缩放比例与利用率)，盘后补全成交率、下单延迟和全天接口调用；趋势报表见 小市值策略_报告.py
+_METRICS_TABLE = 'rebalance_runs'
+_METRICS_COLUMNS = (
+    ('run_id', 'TEXT PRIMARY KEY'), ('trade_date', 'TEXT'), ('mode', 'TEXT'),
+    ('pool_size', 'INTEGER'), ('selected', 'INTEGER'), ('stages', 'TEXT'),
+    ('select_seconds', 'REAL'), ('adjust_seconds', 'REAL'), ('total_seconds', 'REAL'),
+    ('api_calls', 'INTEGER'), ('api_detail', 'TEXT'),
+    ('sell_orders', 'INTEGER'), ('buy_orders', 'INTEGER'), ('failed_orders', 'INTEGER'),
+    ('orders', 'INTEGER'), ('orders_filled', 'INTEGER'), ('fill_ratio', 'REAL'),
+    ('scaling_factor', 'REAL'), ('cash_utilization', 'REAL'), ('latency_seconds', 'REAL'),
+    ('peak_memory_mb', 'REAL'), ('capacity_aum', 'REAL'),
+)
+_RUN_METRICS = {'api': {}}
+
+
+def _counted_api(name, func):
+    def wrapper(*args, **kwargs):
+        counts = _RUN_METRICS['api']
+        counts[name] = counts.get(name, 0) + 1
+        return func(*args, **kwargs)
+    wrapper._counted = True
+    return wrapper
+
+
+def _install_api_counter(context):
+    """用计数包装替换模块全局中的平台接口(与接口录制同一列表)，调用开销只有一次字典累加"""
+    ns = globals()
+    for name in _TRACE_API_NAMES:
+        func = ns.get(name)
+        if func is None or getattr(func, '_counted', False):
+            continue
+        ns[name] = _counted_api(name, func)
+
+
+def _metrics_begin(context):
+    if not getattr(context, 'metrics_enabled', False):
+        return
+    now = time.time()
+    _RUN_METRICS['api'] = {}
+    g.metrics_run = {
+        'run_id': context.current_dt.strftime('%Y%m%d_%H%M%S'),
+        'trade_date': context.current_dt.strftime('%Y-%m-%d'),
+        'started': now, 'mark': now, 'stages': [], 'select_seconds': None, 'adjust_seconds': None,
+        'orders': [], 'last_order': None, 'peak_memory_mb': None,
+    }
+
+
+def _metric_stage(context, stage, count):
+    """记录漏斗阶段：该阶段结束时的股票数量和距上一阶段的耗时"""
+    run = getattr(g, 'metrics_run', None)
+    if not run:
+        return
+    now = time.time()
+    run['stages'].append((stage, int(count), round(now - run['mark'], 4)))
+    run['mark'] = now
+
+
+def _metric_order(order_id):
+    run = getattr(g, 'metrics_run', None)
+    if run:
+        run['orders'].append(order_id)
+        run['last_order'] = time.time()
+
+
+def _metrics_fills(order_ids, trade_mode):
+    """本次调仓委托的结束情况：委托笔数、全部成交笔数、按股数的成交率"""
+    book = getattr(g, 'order_book', None) or {}
+    now = time.time()
+    total = filled_orders = 0
+    amount = filled = 0
+    for order_id in order_ids:
+        entry = book.get(order_id)
+        if entry is None:
+            continue
+        _refresh_order(entry, trade_mode, now)
+        total += 1
+        amount += entry['amount']
+        filled += entry['filled']
+        if entry['state'] == 'filled':
+            filled_orders += 1
+    return total, filled_orders, (float(filled) / amount if amount else None)
+
+
+def _metrics_row(context, run):
+    trade_mode = 'is_trade' in globals() and is_trade()
+    stages = run['stages']
+    adjustment = (getattr(context, 'recent_orders', None) or {}).get('last_adjustment') or {}
+    # 只采用本交易日的调仓结果，两段式调仓的买入在pending_buy_worker中完成后才写入
+    timestamp = adjustment.get('timestamp')
+    if not timestamp or timestamp.strftime('%Y-%m-%d') != run['trade_date']:
+        adjustment = {}
+    orders, orders_filled, fill_ratio = _metrics_fills(run['orders'], trade_mode)
+    api = dict(_RUN_METRICS['api'])
+    return {
+        'run_id': run['run_id'],
+        'trade_date': run['trade_date'],
+        'mode': 'trade' if trade_mode else 'backtest',
+        'pool_size': stages[0][1] if stages else 0,
+        'selected': stages[-1][1] if stages else 0,
+        'stages': json.dumps(stages, ensure_ascii=False),
+        'select_seconds': run['select_seconds'],
+        'adjust_seconds': run['adjust_seconds'],
+        'total_seconds': (run['select_seconds'] or 0) + (run['adjust_seconds'] or 0),
+        'api_calls': sum(api.values()),
+        'api_detail': json.dumps(api, sort_keys=True),
+        'sell_orders': len(adjustment.get('sell_orders', [])) + len(adjustment.get('sell_orders_adjust', [])),
+        'buy_orders': len(adjustment.get('buy_orders', [])),
+        'failed_orders': adjustment.get('failed'),
+        'orders': orders,
+        'orders_filled': orders_filled,
+        'fill_ratio': fill_ratio,
+        'scaling_factor': adjustment.get('scaling_factor'),
+        'cash_utilization': adjustment.get('cash_utilization'),
+        'latency_seconds': run['last_order'] - run['started'] if run['last_order'] else None,
+        'peak_memory_mb': run['peak_memory_mb'],
+        'capacity_aum': run.get('capacity_aum'),
+    }
+
+
+def _metrics_write(context, rows, table=_METRICS_TABLE, columns=_METRICS_COLUMNS):
+    try:
+        import sqlite3
+    except ImportError:
+        log.warning('平台不支持sqlite3，关闭运行指标记录')
+        context.metrics_enabled = False
+        return
+    path = _research_file(getattr(context, 'metrics_dir', 'small_cap_metrics'), 'metrics.db')
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute('CREATE TABLE IF NOT EXISTS %s (%s)' % (table, ', '.join('%s %s' % col for col in columns)))
+        # 旧库缺少的新列直接补上，历史记录中为NULL
+        existing = set(r[1] for r in conn.execute('PRAGMA table_info(%s)' % table))
+        for name, kind in columns:
+            if name not in existing:
+                conn.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table, name, kind.replace(' PRIMARY KEY', '')))
+        names = [name for name, _ in columns]
+        conn.executemany('INSERT OR REPLACE INTO %s (%s) VALUES (%s)' % (
+            table, ', '.join(names), ', '.join('?' * len(names))), [[row.get(n) for n in names] for row in rows])
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _metrics_record(context):
+    """调仓结束时写入本次记录；盘后由_metrics_finalize补全成交与延迟"""
+    run = getattr(g, 'metrics_run', None)
+    if not run:
+        return
+    try:
+        # 选股耗时为各漏斗阶段之和，最后一个阶段(排序)之后到此为调仓耗时
+        run['select_seconds'] = round(sum(stage[2] for stage in run['stages']), 4)
+        run['adjust_seconds'] = round(time.time() - run['mark'], 4)
+        report = getattr(context, 'rebalance_memory', None)
+        if report:
+            run['peak_memory_mb'] = round(_rebalance_peak_bytes(report) / 1024.0 / 1024.0, 3)
+        _metrics_write(context, [_metrics_row(context, run)])
+    except Exception as e:
+        log.warning('写入运行指标失败: %s' % str(e))
+
+
+def _metrics_finalize(context):
+    run = getattr(g, 'metrics_run', None)
+    if not run:
+        return
+    try:
+        _metrics_write(context, [_metrics_row(context, run)])
+    except Exception as e:
+        log.warning('补全运行指标失败: %s' % str(e))
+    g.metrics_run = None
+
+# 执行质量：每笔委托登记时记下方向、09:35参考价和限价，成交主推记下首笔/末笔成交时间；
+# 盘后把当日委托写入同一指标库的 executions 表，报表按周、价格档和市值档汇总执行偏差、成交率和成交用时
+_EXECUTION_TABLE = 'executions'
+_EXECUTION_COLUMNS = (
+    ('order_id', 'TEXT PRIMARY KEY'), ('trade_date', 'TEXT'), ('security', 'TEXT'), ('side', 'INTEGER'),
+    ('amount', 'INTEGER'), ('filled', 'INTEGER'), ('state', 'TEXT'),
+    ('reference', 'REAL'), ('limit_price', 'REAL'), ('avg_price', 'REAL'), ('close', 'REAL'),
+    ('market_value', 'REAL'), ('fill_ratio', 'REAL'), ('shortfall_bps', 'REAL'), ('opportunity_bps', 'REAL'),
+    ('time_to_fill', 'REAL'), ('time_to_complete', 'REAL'), ('fill_source', 'TEXT'),
+)
+# 回测中get_trades按订单编号返回的成交记录为列表时的字段顺序
+_TRADE_LIST_FIELDS = ('order_id', 'business_id', 'entrust_no', 'security', 'entrust_bs', 'business_amount',
+                      'business_price', 'business_balance', 'business_time')
+
+
+def _execution_row(entry, trade_date, close, market_value):
+    """
+    单笔委托的执行质量。执行偏差按方向取正为不利：买入成交均价高于参考价、卖出低于参考价；
+    未成交部分按当日收盘价相对参考价计机会成本，两者之和即实施偏差(implementation shortfall)。
+    有成交但取不到成交明细时 fill_source 为空，成交均价、执行偏差和成交用时留空。
+    """
+    side = entry.get('side') or 0
+    reference = entry.get('reference')
+    filled = int(entry['traded'] or entry['filled'])
+    amount = max(int(entry['amount']), filled)
+    fill_source = entry.get('fill_source') if filled else None
+    avg_price = (entry['avg_price'] or None) if fill_source else None
+    fill_ratio = float(filled) / amount if amount else None
+    shortfall = opportunity = None
+    if side and reference:
+        if filled and avg_price:
+            shortfall = side * (avg_price - reference) / reference * 10000
+        if close and fill_ratio is not None:
+            opportunity = side * (close - reference) / reference * 10000 * (1 - fill_ratio)
+    submitted = entry.get('submitted')
+    first_fill, last_fill = entry.get('first_fill'), entry.get('last_fill')
+    return {
+        'order_id': str(entry['id']), 'trade_date': trade_date, 'security': entry['security'], 'side': side,
+        'amount': amount, 'filled': filled, 'state': entry['state'],
+        'reference': reference, 'limit_price': entry.get('limit'), 'avg_price': avg_price, 'close': close,
+        'market_value': market_value, 'fill_ratio': fill_ratio,
+        'shortfall_bps': shortfall, 'opportunity_bps': opportunity,
+        'time_to_fill': first_fill - submitted if first_fill and submitted else None,
+        'time_to_complete': last_fill - submitted if last_fill and submitted and entry['state'] == 'filled' else None,
+        'fill_source': fill_source,
+    }
+
+
+def _iter_trades(trades):
+    """展开get_trades的返回：成交列表，或按订单编号分组的字典(值为单条或多条成交，成交可以是按字段顺序的列表)"""
+    groups = trades.items() if isinstance(trades, dict) else [(None, trades or [])]
+    for order_id, records in groups:
+        if not isinstance(records, list) or (records and not isinstance(records[0], (list, tuple, dict))
+                                             and not hasattr(records[0], '__dict__')):
+            records = [records]
+        for record in records:
+            if isinstance(record, (list, tuple)):
+                record = dict(zip(_TRADE_LIST_FIELDS, record))
+            if order_id is not None and _trade_field(record, 'order_id', 'entrust_no') is None:
+                record = dict(vars(record)) if hasattr(record, '__dict__') else dict(record)
+                record['order_id'] = order_id
+            yield record
+
+
+def _trade_time(value, day):
+    """成交时间转为时间戳；只有时分秒时按当日补全，无法解析返回None"""
+    if value is None:
+        return None
+    try:
+        if not isinstance(value, datetime.datetime):
+            text = str(value)
+            value = pd.Timestamp(text if len(text) > 8 else '%s %s' % (day, text)).to_pydatetime()
+        return time.mktime(value.timetuple())
+    except Exception:
+        return None
+
+
+def _fill_from_trades(context, entries):
+    """没有成交主推的委托(回测或主推丢失)：用一次get_trades按订单编号汇总成交均价与首笔/末笔成交时间"""
+    pending = dict((str(e['id']), e) for e in entries
+                   if not e['traded'] and (e['filled'] or e['state'] in ('filled', 'partial')))
+    if not pending:
+        return
+    try:
+        trades = get_trades()
+    except Exception as e:
+        log.warning(f'获取当日成交失败，{len(pending)}笔委托没有成交明细: {e}')
+        return
+    day = context.current_dt.date()
+    for trade in _iter_trades(trades):
+        entry = pending.get(str(_trade_field(trade, 'order_id', 'entrust_no')))
+        if entry is None:
+            continue
+        qty = abs(float(_trade_field(trade, 'business_amount', 'amount') or 0))
+        price = float(_trade_field(trade, 'business_price', 'price') or 0)
+        if qty <= 0 or price <= 0:
+            continue
+        entry['value'] += qty * price
+        entry['traded'] += qty
+        entry['avg_price'] = entry['value'] / entry['traded']
+        entry['fill_source'] = 'trades'
+        ts = _trade_time(_trade_field(trade, 'business_time', 'trade_time'), day)
+        if ts is not None:
+            entry['first_fill'] = min(entry['first_fill'] or ts, ts)
+            entry['last_fill'] = max(entry['last_fill'] or ts, ts)
+
+
+def _export_executions(context):
+    """盘后写出当日登记的委托：先对账一次，再用一次日线请求取收盘价计算机会成本"""
+    book = getattr(g, 'order_book', None) or {}
+    entries = [e for e in book.values() if e.get('submitted') and not e.get('exported')]
+    if not entries:
+        return
+    try:
+        trade_mode = 'is_trade' in globals() and is_trade()
+        now = time.time()
+        for entry in entries:
+            _refresh_order(entry, trade_mode, now)
+        _fill_from_trades(context, entries)
+        codes = sorted(set(e['security'] for e in entries if e['security']))
+        closes = _last_by_code(get_history(1, '1d', ['close'], security_list=codes, include=True)) if codes else {}
+        caps = getattr(context, 'stock_market_values', None) or {}
+        trade_date = context.current_dt.strftime('%Y-%m-%d')
+        rows = [_execution_row(e, trade_date, closes.get(e['security'], (None, None))[0], caps.get(e['security']))
+                for e in entries]
+        _metrics_write(context, rows, _EXECUTION_TABLE, _EXECUTION_COLUMNS)
+        for entry in entries:
+            entry['exported'] = True
+        shortfalls = [r['shortfall_bps'] for r in rows if r['shortfall_bps'] is not None]
+        log.info('执行质量: 委托%d笔, 全部成交%d笔, 平均执行偏差%s' % (
+            len(rows), sum(1 for r in rows if r['state'] == 'filled'),
+            '%.1fbp' % np.mean(shortfalls) if shortfalls else '无成交'))
+    except Exception as e:
+        log.warning('写出执行质量记录失败: %s' % str(e))
+
+# 共享行情数据：同一主机上运行多份参数不同的策略时，context.shared_data_role='publisher' 的一份在盘前用全市场一次性请求
+# 取齐选股漏斗需要的日线、基本面和股票信息，日线按字段写成 (日期x代码) 的.npy，基本面原样pickle，放在研究目录 shared_data_dir；
+# 'reader' 的各份策略以内存映射只读打开当日快照，get_history/get_fundamentals/get_stock_info/get_Ashares 命中时直接切片返回，
+# 未命中(快照尚未发布、日期不符、代码或字段不全)时照常调用平台接口
+_SHARED_API_NAMES = ('get_Ashares', 'get_stock_info', 'get_history', 'get_fundamentals')
+_SHARED_DATA = {'date': None, 'meta': None, 'panels': {}, 'frames': {}, 'stock_info': {}}
+
+
+def _shared_slot(day):
+    """按日期奇偶轮换两个槽位：发布当日快照时不会覆盖读者仍在映射的前一日文件"""
+    return 'slot%d' % (day.toordinal() % 2)
+
+
+def _shared_queries(context):
+    """发布者代全市场执行的基本面查询，与选股漏斗中的调用参数一致"""
+    current_year = int(context.current_dt.strftime('%Y'))
+    return [
+        ('valuation', {'fields': ['dividend_ratio', 'total_value', 'turnover_rate']}),
+        ('balance_statement', {'fields': ['total_liability', 'total_assets']}),
+        ('income_statement', {'fields': ['net_profit', 'np_parent_company_owners'], 'start_year': str(current_year - 2),
+                              'end_year': str(current_year - 1), 'report_types': '1'}),
+        ('income_statement', {'fields': ['np_parent_company_owners', 'net_profit', 'end_date', 'publ_date'],
+                              'start_year': str(current_year - 2), 'end_year': str(current_year)}),
+    ]
+
+
+def _shared_key(table, kwargs):
+    return '%s|%s|%s|%s|%s' % (table, kwargs.get('date'), kwargs.get('start_year'), kwargs.get('end_year'),
+                               kwargs.get('report_types'))
+
+
+def publish_shared_data(context):
+    """发布者：盘前取全市场数据写入当日槽位，meta最后写入，读者以meta中的日期判断快照是否完整可用"""
+    try:
+        t0 = time.time()
+        day = context.current_dt.date()
+        slot = _shared_slot(day)
+        subdir = context.shared_data_dir
+        universe = list(get_Ashares())
+        fields = list(context.shared_history_fields)
+        bars = get_history(context.shared_history_days, '1d', fields, security_list=universe)
+        codes = sorted(set(str(c) for c in bars['code'])) if bars is not None and not bars.empty else []
+        dates = sorted(set(bars.index)) if codes else []
+        for field in fields:
+            panel = np.full((len(dates), len(codes)), np.nan)
+            if codes:
+                wide = bars.pivot_table(index=bars.index, columns='code', values=field, aggfunc='last', observed=True)
+                wide.columns = [str(c) for c in wide.columns]
+                panel = wide.reindex(index=dates, columns=codes).to_numpy(dtype=np.float64)
+            np.save(_research_file(subdir, '%s_%s.npy' % (slot, field)), panel)
+        frames = {}
+        for table, kwargs in _shared_queries(context):
+            frames[_shared_key(table, kwargs)] = {'fields': kwargs['fields'],
+                                                  'frame': get_fundamentals(universe, table, **kwargs)}
+        shared = {'frames': frames, 'stock_info': get_stock_info(universe, ['stock_name', 'listed_date']) or {}}
+        with open(_research_file(subdir, '%s_fundamentals.pkl' % slot), 'wb') as f:
+            pickle.dump(shared, f, protocol=pickle.HIGHEST_PROTOCOL)
+        meta = {'date': day.isoformat(), 'universe': universe, 'codes': codes, 'fields': fields,
+                'dates': [pd.Timestamp(d).strftime('%Y-%m-%d') for d in dates]}
+        with open(_research_file(subdir, '%s_meta.json' % slot), 'w') as f:
+            json.dump(meta, f)
+        log.info('共享行情数据已发布: %s, 股票%d只, 日线%d天x%d字段, 基本面查询%d个, 耗时%.2fs' % (
+            slot, len(universe), len(dates), len(fields), len(frames), time.time() - t0))
+    except Exception as e:
+        log.warning('发布共享行情数据失败，各策略将直接调用平台接口: %s' % str(e))
+
+
+def _shared_snapshot(context):
+    """读者：打开当日快照(每个交易日只映射一次)，快照不可用时返回None"""
+    state = _SHARED_DATA
+    day = context.current_dt.date()
+    if state['date'] == day and state['meta'] is not None:
+        return state
+    state.update(date=day, meta=None, panels={}, frames={}, stock_info={})
+    subdir = context.shared_data_dir
+    slot = _shared_slot(day)
+    try:
+        with open(_research_file(subdir, '%s_meta.json' % slot)) as f:
+            meta = json.load(f)
+        if meta.get('date') != day.isoformat():
+            return None
+        panels = dict((field, np.load(_research_file(subdir, '%s_%s.npy' % (slot, field)), mmap_mode='r'))
+                      for field in meta['fields'])
+        with open(_research_file(subdir, '%s_fundamentals.pkl' % slot), 'rb') as f:
+            shared = pickle.load(f)
+    except Exception as e:
+        log.debug('共享行情快照不可用: %s' % str(e))
+        return None
+    meta['code_index'] = dict((c, i) for i, c in enumerate(meta['codes']))
+    state.update(meta=meta, panels=panels, frames=shared['frames'], stock_info=shared['stock_info'])
+    return state
+
+
+def _shared_rows(frame, codes):
+    """按代码从全市场基本面结果中取行；代码在索引某一级或secu_code列中，都找不到时返回None"""
+    wanted = list(codes)
+    for level in range(frame.index.nlevels):
+        mask = frame.index.get_level_values(level).astype(str).isin(wanted)
+        if mask.any():
+            return frame[mask]
+    if 'secu_code' in frame.columns:
+        return frame[frame['secu_code'].isin(wanted)]
+    return None
+
+
+def _panel_frame(panels, dates, code_index, count, codes, fields, adjust=None):
+    """
+    从 (日期x代码) 面板取最近count个交易日，拼成与get_history相同的长表(code列+日期索引)。
+    行窗口是内存映射上的切片，只复制所需股票的窗口；代码、字段或天数不全时返回None。
+    adjust(field, window, days, codes) 可对取出的 (天数x股票) 窗口做变换(如复权)后再展开。
+    """
+    n = len(dates)
+    if not codes or count <= 0 or count > n or any(f not in panels for f in fields) \
+            or any(c not in code_index for c in codes):
+        return None
+    cols = [code_index[c] for c in codes]
+    days = np.array(dates[n - count:], dtype='datetime64[D]')
+    data = {'code': np.repeat(np.array(codes, dtype=object), len(days))}
+    for f in fields:
+        window = panels[f][n - count:n].take(cols, axis=1)
+        if adjust is not None:
+            window = adjust(f, window, days, codes)
+        data[f] = window.T.ravel()
+    frame = pd.DataFrame(data, index=pd.DatetimeIndex(np.tile(days, len(codes))))
+    # 平台不返回无数据的K线，面板中补齐的空行去掉
+    return frame.dropna(subset=fields, how='all')
+
+
+def _shared_call(name, state, args, kwargs):
+    """用当日快照应答一次接口调用；不能完全由快照覆盖的请求返回None"""
+    meta = state['meta']
+    if name == 'get_Ashares':
+        return list(meta['universe']) if not args and not kwargs else None
+    if name == 'get_stock_info':
+        stocks = args[0] if args else kwargs.get('stocks')
+        field = args[1] if len(args) > 1 else kwargs.get('field', 'stock_name')
+        stocks = [stocks] if isinstance(stocks, str) else list(stocks or [])
+        fields = [field] if isinstance(field, str) else list(field)
+        info = state['stock_info']
+        if not stocks or any(s not in info or any(f not in info[s] for f in fields) for s in stocks):
+            return None
+        return dict((s, dict((f, info[s][f]) for f in fields)) for s in stocks)
+    if name == 'get_history':
+        names = ('count', 'frequency', 'field', 'security_list')
+        params = dict(zip(names, args))
+        params.update((k, v) for k, v in kwargs.items() if k in names)
+        if len(args) > len(names) or any(k not in names for k in kwargs) or params.get('frequency', '1d') != '1d':
+            return None
+        fields = params.get('field', 'close')
+        fields = [fields] if isinstance(fields, str) else list(fields)
+        codes = params.get('security_list')
+        codes = [codes] if isinstance(codes, str) else list(codes or [])
+        return _panel_frame(state['panels'], meta['dates'], meta['code_index'], int(params.get('count', 0)),
+                            codes, fields)
+    if name == 'get_fundamentals':
+        security = args[0] if args else kwargs.get('security')
+        table = args[1] if len(args) > 1 else kwargs.get('table_name')
+        fields = args[2] if len(args) > 2 else kwargs.get('fields')
+        options = dict((k, v) for k, v in kwargs.items() if k not in ('security', 'table_name', 'fields'))
+        if len(args) > 3 or any(k not in ('date', 'start_year', 'end_year', 'report_types') for k in options):
+            return None
+        entry = state['frames'].get(_shared_key(table, options))
+        fields = [fields] if isinstance(fields, str) else list(fields or [])
+        if entry is None or not fields or any(f not in entry['fields'] for f in fields):
+            return None
+        frame = entry['frame']
+        if frame is None or not hasattr(frame, 'index'):
+            return None
+        codes = [security] if isinstance(security, str) else list(security or [])
+        rows = _shared_rows(frame, codes) if len(frame) else frame
+        if rows is None:
+            return None
+        extra = [f for f in entry['fields'] if f not in fields and f in rows.columns]
+        return rows.drop(columns=extra) if extra else rows
+    return None
+
+
+def _shared_api(name, func, context):
+    def wrapper(*args, **kwargs):
+        state = _shared_snapshot(context)
+        if state is not None:
+            try:
+                result = _shared_call(name, state, args, kwargs)
+            except Exception as e:
+                log.debug('共享行情应答%s失败，改为调用平台接口: %s' % (name, str(e)))
+                result = None
+            if result is not None:
+                return result
+        return func(*args, **kwargs)
+    wrapper._shared = True
+    return wrapper
+
+
+def _install_shared_reader(context):
+    """用共享快照包装替换行情与基本面接口；在接口计数之后安装，计数只统计真正发往平台的调用"""
+    ns = globals()
+    for name in _SHARED_API_NAMES:
+        func = ns.get(name)
+        if func is None or getattr(func, '_shared', False):
+            continue
+        ns[name] = _shared_api(name, func, context)
+    log.info(f'共享行情数据: 角色{context.shared_data_role}, 目录{context.shared_data_dir}')
+
+# 本地日线归档：context.bar_archive_enabled 开启后，研究目录 bar_archive_dir 下每个字段一个 (日期x代码) 的.npy数组，
+# 盘后 after_trading_end 用一次全市场请求追加当日K线(漏跑的交易日一并补齐)，复牌股票回补停牌期间的空缺；
+# 选股各价格阶段经 _daily_bars 从内存映射切片读取窗口，归档未更新到上一交易日时回退 get_history。
+# 数组按容量预留行列，meta.json 最后写入并记录实际日期与代码，格式与离线回测面板一致，可直接作为 --store 打开
+_BAR_ARCHIVE = {'day': None, 'meta': None, 'panels': {}}
+_ARCHIVE_META = 'meta.json'
+# 归档数组的初始行容量(交易日)和列余量(代码)，不足时按倍数扩容
+_ARCHIVE_ROWS = 512
+_ARCHIVE_SPARE_CODES = 512
+
+
+def _archive_meta(subdir):
+    try:
+        with open(_research_file(subdir, _ARCHIVE_META)) as f:
+            return json.load(f)
+    except Exception:
+        return None
+
+
+def _archive_trade_days(context, last, today):
+    """归档最后一天之后到今天的交易日；归档为空时取最近 bar_archive_bootstrap_days 个交易日"""
+    if last is None:
+        days = get_trade_days(end_date=today.strftime('%Y-%m-%d'), count=context.bar_archive_bootstrap_days)
+    else:
+        days = get_trade_days(start_date=last, end_date=today.strftime('%Y-%m-%d'))
+    days = [pd.Timestamp(d).strftime('%Y-%m-%d') for d in days]
+    return [d for d in days if last is None or d > last]
+
+
+def _archive_wide(bars, field, dates, codes):
+    """把get_history长表的一个字段展开成 (dates x codes) 数组，缺失为NaN"""
+    if bars is None or bars.empty or field not in bars.columns:
+        return np.full((len(dates), len(codes)), np.nan)
+    frame = bars[['code', field]].copy()
+    frame['code'] = frame['code'].astype(str)
+    frame['date'] = pd.DatetimeIndex(frame.index).strftime('%Y-%m-%d')
+    wide = frame.pivot_table(index='date', columns='code', values=field, aggfunc='last')
+    return wide.reindex(index=dates, columns=codes).to_numpy(dtype=np.float64)
+
+
+def _archive_panel(subdir, field, rows, cols, shape):
+    """以读写方式映射字段数组，容量不足时扩容(原数据复制到新数组，其余填NaN)"""
+    path = _research_file(subdir, field + '.npy')
+    panel = None
+    if shape is not None:
+        try:
+            panel = np.load(path, mmap_mode='r+')
+        except Exception:
+            panel = None
+    if panel is not None and panel.shape[0] >= rows and panel.shape[1] >= cols:
+        return panel
+    old = np.array(panel) if panel is not None else None
+    del panel
+    capacity = (max(rows * 2, _ARCHIVE_ROWS), cols + _ARCHIVE_SPARE_CODES)
+    if old is not None:
+        capacity = (max(capacity[0], old.shape[0]), max(capacity[1], old.shape[1]))
+    grown = np.lib.format.open_memmap(path, mode='w+', dtype=np.float64, shape=capacity)
+    grown[:] = np.nan
+    if old is not None:
+        grown[:old.shape[0], :old.shape[1]] = old
+    return grown
+
+
+def _archive_request(fields, adjusting):
+    """日线归档的请求字段：总是带上成交量用于识别停牌，复权时再带上前收盘价用于识别除权"""
+    request = list(fields)
+    for extra, need in (('volume', True), ('preclose', adjusting)):
+        if need and extra not in request:
+            request.append(extra)
+    return request
+
+
+def _archive_halted(bars, days, codes):
+    """
+    停牌日平台仍返回K线，价格沿用停牌前收盘价、成交量为0(部分版本另有status='HALT')。
+    返回 (天数x股票) 的停牌掩码，归档时这些格子存为空值，复牌判断与回补都以此为准。
+    """
+    with np.errstate(invalid='ignore'):
+        halt = _archive_wide(bars, 'volume', days, codes) <= 0
+    if bars is not None and 'status' in getattr(bars, 'columns', ()):
+        status = bars[['code', 'status']].copy()
+        status['status'] = (status['status'].astype(str).str.upper() == 'HALT').astype(float)
+        halt |= _archive_wide(status, 'status', days, codes) > 0
+    return halt
+
+
+def update_bar_archive(context):
+    """盘后追加当日日线：一次请求取齐待补交易日，停牌日存为空值，复牌股票再用一次请求回补停牌期间的空缺，meta最后写入"""
+    try:
+        t0 = time.time()
+        today = context.current_dt.date()
+        subdir = context.bar_archive_dir
+        fields = list(context.bar_archive_fields)
+        meta = _archive_meta(subdir)
+        if meta is not None and list(meta.get('daily_fields', [])) != fields:
+            log.warning('本地日线归档字段与配置不一致，重新建立归档: %s' % meta.get('daily_fields'))
+            meta = None
+        dates = list(meta['dates']) if meta else []
+        codes = list(meta['codes']) if meta else []
+        days = _archive_trade_days(context, dates[-1] if dates else None, today)
+        if not days:
+            return
+        universe = sorted(str(c) for c in get_Ashares())
+        index = dict((c, i) for i, c in enumerate(codes))
+        old_codes = len(codes)
+        codes.extend(c for c in universe if c not in index)
+        adjusting = getattr(context, 'price_adjust', None) in ('pre', 'post')
+        request = _archive_request(fields, adjusting)
+        bars = get_history(len(days), '1d', request, security_list=universe, include=True)
+        halt = _archive_halted(bars, days, codes)
+        start, stop = len(dates), len(dates) + len(days)
+        shape = meta.get('capacity') if meta else None
+        # 停牌后今日复牌的股票：上一归档日停牌(已存为空值)、本次有成交
+        resumed = []
+        panels = {}
+        _BAR_ARCHIVE.update(day=None, meta=None, panels={})
+        for field in fields:
+            panel = _archive_panel(subdir, field, stop, len(codes), shape)
+            panel[start:stop, :len(codes)] = np.where(halt, np.nan, _archive_wide(bars, field, days, codes))
+            panels[field] = panel
+        if start > 0 and 'close' in panels and old_codes:
+            halted = np.isnan(panels['close'][start - 1, :old_codes]) & ~np.isnan(panels['close'][stop - 1, :old_codes])
+            resumed = [codes[i] for i in np.flatnonzero(halted)]
+        repaired = 0
+        if resumed:
+            window = min(context.bar_archive_repair_days, start)
+            repair_days = dates[start - window:] + days
+            patch = get_history(len(repair_days), '1d', _archive_request(fields, False), security_list=resumed,
+                                include=True)
+            patch_halt = _archive_halted(patch, repair_days, resumed)
+            index = dict((c, i) for i, c in enumerate(codes))
+            cols = [index[c] for c in resumed]
+            for field in fields:
+                block = panels[field][stop - len(repair_days):stop, cols]
+                fresh = np.where(patch_halt, np.nan, _archive_wide(patch, field, repair_days, resumed))
+                fill = np.isnan(block) & ~np.isnan(fresh)
+                repaired += int(fill.sum())
+                block[fill] = fresh[fill]
+                panels[field][stop - len(repair_days):stop, cols] = block
+        exrights = 0
+        if adjusting and 'close' in panels:
+            # 前收盘价与上一交易日收盘价不一致说明当日除权，重新获取；尚无缓存的股票获取一次
+            known = _exrights_cache(context)
+            prev_close = panels['close'][max(start - 1, 0):stop - 1, :len(codes)]
+            preclose = np.where(halt[len(halt) - len(prev_close):], np.nan,
+                                _archive_wide(bars, 'preclose', days[len(days) - len(prev_close):], codes))
+            # 停牌期间常有除权，复牌日上一归档日为空值，无法比较时也重新获取
+            with np.errstate(invalid='ignore'):
+                changed = np.any((np.abs(preclose - prev_close) > 1e-4 * np.abs(prev_close))
+                                 | (np.isnan(prev_close) & ~np.isnan(preclose)), axis=0)
+            exrights = refresh_exrights(context, [c for i, c in enumerate(codes) if changed[i] or c not in known])
+        for panel in panels.values():
+            panel.flush()
+        capacity = list(next(iter(panels.values())).shape)
+        meta = {'dates': dates + days, 'codes': codes, 'daily_fields': fields, 'capacity': capacity,
+                'annual_fields': [], 'years': [], 'stock_info': {}}
+        with open(_research_file(subdir, _ARCHIVE_META), 'w') as f:
+            json.dump(meta, f)
+        log.info('本地日线归档已更新: 追加%d个交易日(%s至%s), 股票%d只, 复牌回补%d只/%d个数据, 更新除权信息%d只, 耗时%.2fs' % (
+            len(days), days[0], days[-1], len(codes), len(resumed), repaired, exrights, time.time() - t0))
+        if getattr(context, 'rolling_stats_enabled', False):
+            update_rolling_stats(context, panels, meta['dates'], len(codes), start, rebuild=repaired > 0)
+    except Exception as e:
+        log.warning('更新本地日线归档失败，选股将直接调用get_history: %s' % str(e))
+
+
+def _bar_archive(context):
+    """只读映射归档(每个交易日只打开一次)；归档未更新到上一交易日时返回None"""
+    state = _BAR_ARCHIVE
+    day = context.current_dt.date()
+    if state['day'] == day:
+        return state if state['meta'] is not None else None
+    state.update(day=day, meta=None, panels={})
+    subdir = context.bar_archive_dir
+    meta = _archive_meta(subdir)
+    try:
+        previous = pd.Timestamp(get_trading_day(-1)).strftime('%Y-%m-%d')
+        if not meta or not meta['dates'] or meta['dates'][-1] != previous:
+            log.info('本地日线归档未覆盖上一交易日%s，本日选股直接调用get_history' % previous)
+            return None
+        rows, cols = len(meta['dates']), len(meta['codes'])
+        panels = dict((field, np.load(_research_file(subdir, field + '.npy'), mmap_mode='r')[:rows, :cols])
+                      for field in meta['daily_fields'])
+    except Exception as e:
+        log.debug('本地日线归档不可用: %s' % str(e))
+        return None
+    meta['code_index'] = dict((c, i) for i, c in enumerate(meta['codes']))
+    state.update(meta=meta, panels=panels)
+    return state
+
+
+# 复权引擎：归档保存不复权K线，context.price_adjust 为 'pre'(前复权)或'post'(后复权)时，读取窗口按除权除息事件变换价格。
+# 每只股票的 get_stock_exrights 只取一次，换算成每个除权日的仿射因子 (除权日, a, b)：除权参考价 = 除权前价格*a + b，
+# 缓存在归档目录 exrights.pkl；盘后追加K线时 preclose 与归档前收盘价不一致的股票视为发生除权，重新获取其事件
+_EXRIGHTS = {'events': None}
+_EXRIGHTS_FILE = 'exrights.pkl'
+_ADJUST_FIELDS = ('open', 'high', 'low', 'close', 'high_limit', 'low_limit', 'preclose')
+
+
+def _exrights_day(value):
+    """除权日(20230615 / '2023-06-15' / 日期对象)转为自1970-01-01起的天数，与窗口日期的datetime64[D]可直接比较"""
+    text = str(value).strip()
+    if text.isdigit() and len(text) == 8:
+        text = '%s-%s-%s' % (text[:4], text[4:6], text[6:])
+    return int(np.datetime64(pd.Timestamp(text).date(), 'D').astype(np.int64))
+
+
+def _exrights_events(frame):
+    """
+    把 get_stock_exrights 的结果换算成按日期排序的 (除权日, a, b) 数组：
+    送转 allotted_ps、配股 rationed_ps/rationed_px、每股派息 bonus_ps，
+    除权参考价 = (前收盘 - 派息 + 配股价*配股比例) / (1 + 送转比例 + 配股比例)
+    """
+    if frame is None or len(frame) == 0:
+        return np.empty((0, 3))
+    rows = []
+    for day, row in frame.iterrows():
+        allotted = float(row.get('allotted_ps', 0) or 0)
+        rationed = float(row.get('rationed_ps', 0) or 0)
+        rationed_px = float(row.get('rationed_px', 0) or 0)
+        bonus = float(row.get('bonus_ps', 0) or 0)
+        values = np.nan_to_num([allotted, rationed, rationed_px, bonus])
+        base = 1.0 + values[0] + values[1]
+        rows.append((_exrights_day(row.get('date', day)), 1.0 / base, (values[2] * values[1] - values[3]) / base))
+    return np.array(sorted(rows), dtype=np.float64).reshape(-1, 3)
+
+
+def _exrights_cache(context):
+    if _EXRIGHTS['events'] is None:
+        try:
+            with open(_research_file(context.bar_archive_dir, _EXRIGHTS_FILE), 'rb') as f:
+                _EXRIGHTS['events'] = pickle.load(f)
+        except Exception:
+            _EXRIGHTS['events'] = {}
+    return _EXRIGHTS['events']
+
+
+def refresh_exrights(context, codes):
+    """逐只获取除权除息事件并写回缓存；平台没有该接口时不复权"""
+    events = _exrights_cache(context)
+    if not codes or 'get_stock_exrights' not in globals():
+        return 0
+    failed = 0
+    for code in codes:
+        try:
+            events[code] = _exrights_events(get_stock_exrights(code))
+        except Exception:
+            failed += 1
+            events[code] = np.empty((0, 3))
+    try:
+        with open(_research_file(context.bar_archive_dir, _EXRIGHTS_FILE), 'wb') as f:
+            pickle.dump(events, f, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        log.warning('保存除权除息缓存失败: %s' % str(e))
+    if failed:
+        log.warning('获取除权除息信息失败 %d 只，按无除权处理' % failed)
+    return len(codes)
+
+
+def _adjust_factors(events, days, asof, mode):
+    """
+    单只股票在各交易日的复权仿射因子 (A, B)，复权价 = 原价*A + B；只使用 asof 当日及以前已发生的除权事件。
+    前复权：交易日之后的事件依次作用；后复权：交易日及以前的事件依次取逆变换。
+    """
+    events = events[events[:, 0] <= asof]
+    k = np.searchsorted(events[:, 0], days, side='right')
+    n = len(events)
+    A = np.ones(n + 1)
+    B = np.zeros(n + 1)
+    if mode == 'pre':
+        # 后缀复合 S_i = T_n ... T_i，S_n+1 为恒等
+        for i in range(n - 1, -1, -1):
+            a, b = events[i, 1], events[i, 2]
+            A[i], B[i] = A[i + 1] * a, A[i + 1] * b + B[i + 1]
+    else:
+        # 前缀复合 P_i = T_1^-1 ... T_i^-1，P_0 为恒等
+        for i in range(1, n + 1):
+            a, b = events[i - 1, 1], events[i - 1, 2]
+            A[i], B[i] = A[i - 1] / a, B[i - 1] - A[i - 1] * b / a
+    return A[k], B[k]
+
+
+def _price_adjuster(context):
+    """返回 _panel_frame 的 adjust 回调；未开启复权时返回None"""
+    mode = getattr(context, 'price_adjust', None)
+    if mode not in ('pre', 'post'):
+        return None
+    events = _exrights_cache(context)
+    asof = int(np.datetime64(context.current_dt.date(), 'D').astype(np.int64))
+
+    def adjust(field, window, days, codes):
+        if field not in _ADJUST_FIELDS:
+            return window
+        day_numbers = days.astype(np.int64)
+        window = np.array(window, dtype=np.float64)
+        for j, code in enumerate(codes):
+            code_events = events.get(code)
+            if code_events is None or not len(code_events):
+                continue
+            A, B = _adjust_factors(code_events, day_numbers, asof, mode)
+            window[:, j] = window[:, j] * A + B
+        return window
+    return adjust
+
+
+# 滚动统计：振幅(30日最高价/最低价)与乖离率(20日均价/最新收盘价)的逐股状态，随本地日线归档每日追加一根K线更新。
+# 最高/最低价用单调队列(每只股票一行环形缓冲，存值与交易日序号)，均价用环形缓冲+滚动和，全市场按数组整体更新；
+# 状态写入归档目录 rolling.npz，选股时按代码 O(1) 取当前值，不再获取和扫描多日窗口
+_AMPLITUDE_DAYS = 30
+_BIAS_DAYS = 20
+_ROLLING = {'day': None, 'state': None}
+_ROLLING_FILE = 'rolling.npz'
+
+
+def _rolling_new(n):
+    state = {'t': np.array(-1), 'last': np.array(''), 'amplitude_days': np.array(_AMPLITUDE_DAYS),
+             'bias_days': np.array(_BIAS_DAYS)}
+    for side in ('max', 'min'):
+        state[side + '_vals'] = np.full((n, _AMPLITUDE_DAYS), np.nan)
+        state[side + '_idx'] = np.zeros((n, _AMPLITUDE_DAYS), dtype=np.int64)
+        state[side + '_head'] = np.zeros(n, dtype=np.int64)
+        state[side + '_size'] = np.zeros(n, dtype=np.int64)
+    state['close_ring'] = np.full((n, _BIAS_DAYS), np.nan)
+    state['close_sum'] = np.zeros(n)
+    state['close_count'] = np.zeros(n, dtype=np.int64)
+    return state
+
+
+def _rolling_extend(state, n):
+    """新增代码追加空行(队列为空，窗口内无数据)"""
+    extra = n - len(state['close_sum'])
+    if extra <= 0:
+        return state
+    fresh = _rolling_new(extra)
+    for key, value in state.items():
+        if value.ndim > 0:
+            state[key] = np.concatenate([value, fresh[key]])
+    return state
 
-def before_trading_start(context, data):
+
+def _deque_push(state, side, x, t):
+    """单调队列追加第t个交易日的值x(NaN为无数据，只做过期出队)；队首即窗口内最大(max)/最小(min)值"""
+    vals, idx = state[side + '_vals'], state[side + '_idx']
+    head, size = state[side + '_head'], state[side + '_size']
+    window = vals.shape[1]
+    rows = np.arange(len(x))
+    # 每个交易日至多入队一个值，队首每次至多过期一个
+    expired = (size > 0) & (idx[rows, head] <= t - window)
+    head[expired] = (head[expired] + 1) % window
+    size[expired] -= 1
+    valid = ~np.isnan(x)
+    while True:
+        back = vals[rows, (head + size - 1) % window]
+        pop = valid & (size > 0) & ((back <= x) if side == 'max' else (back >= x))
+        if not pop.any():
+            break
+        size[pop] -= 1
+    pos = (head + size) % window
+    vals[rows[valid], pos[valid]] = x[valid]
+    idx[rows[valid], pos[valid]] = t
+    size[valid] += 1
+
+
+def _rolling_push(state, high, low, close, day):
+    t = int(state['t']) + 1
+    _deque_push(state, 'max', high, t)
+    _deque_push(state, 'min', low, t)
+    ring = state['close_ring']
+    pos = t % ring.shape[1]
+    old = ring[:, pos]
+    state['close_sum'] -= np.nan_to_num(old)
+    state['close_count'] -= ~np.isnan(old)
+    ring[:, pos] = close
+    state['close_sum'] += np.nan_to_num(close)
+    state['close_count'] += ~np.isnan(close)
+    if pos == ring.shape[1] - 1:
+        # 每轮环形缓冲重新求和一次，消除滚动加减的累计误差
+        state['close_sum'] = np.nansum(ring, axis=1)
+    state['t'] = np.array(t)
+    state['last'] = np.array(day)
+
+
+def update_rolling_stats(context, panels, dates, n_codes, start, rebuild=False):
     """
-    交易端盘前处理：撤销未完成订单，避免冲突；可扩展其他检查。
+    按归档新追加的行(start起)更新滚动状态；状态与归档不衔接、窗口长度变化或归档有回补时，
+    用归档最近的窗口重建
     """
     try:
-        if 'is_trade' in globals() and is_trade():
-            try:
-                open_orders = get_open_orders()
-                for order_id in list((open_orders or {}).keys()):
-                    try:
-                        cancel_order(order_id)
-                    except Exception as e:
-                        log.warning(f'撤销订单失败 {order_id}: {e}')
-            except Exception as e:
-                log.warning(f'盘前撤销订单异常: {e}')
+        state = _ROLLING['state'] if _ROLLING['state'] is not None else _rolling_load(context)
+        stale = (state is None or rebuild or int(state['amplitude_days']) != _AMPLITUDE_DAYS
+                 or int(state['bias_days']) != _BIAS_DAYS or start == 0 or str(state['last']) != dates[start - 1])
+        if stale:
+            state = _rolling_new(n_codes)
+            start = max(len(dates) - max(_AMPLITUDE_DAYS, _BIAS_DAYS), 0)
+        state = _rolling_extend(state, n_codes)
+        for row in range(start, len(dates)):
+            _rolling_push(state, panels['high'][row, :n_codes], panels['low'][row, :n_codes],
+                          panels['close'][row, :n_codes], dates[row])
+        with open(_research_file(context.bar_archive_dir, _ROLLING_FILE), 'wb') as f:
+            np.savez(f, **state)
+        _ROLLING.update(day=None, state=state)
     except Exception as e:
-        log.warning(f'before_trading_start 异常: {e}')
+        _ROLLING.update(day=None, state=None)
+        log.warning('更新滚动统计失败，振幅与乖离率将按窗口计算: %s' % str(e))
 
-def trade_rotation(context):
-    """
-    交易端定时任务：09:35触发一次选股+调仓；复用 handle_data 逻辑。
-    """
+
+def _rolling_load(context):
     try:
-        handle_data(context, data={})
-    except Exception as e:
-        log.warning(f'交易端定时任务运行异常: {e}')
+        with np.load(_research_file(context.bar_archive_dir, _ROLLING_FILE)) as data:
+            return dict((key, data[key]) for key in data.files)
+    except Exception:
+        return None
 
-def _normalize_local(code):
-    """本地代码规范化函数 - 保留完整的股票代码格式"""
-    if isinstance(code, str):
-        s = code
-    else:
-        # 处理Position或Security对象
-        s = str(getattr(code, 'security', None) or getattr(code, 'sid', None) or getattr(code, 'code', None) or code)
-    
-    # 标准化股票代码格式，保留后缀
-    # 处理常见格式：000001.SZ, SZ000001, 000001.XSHE, 600000.SS, SH600000
-    s = s.strip()
-    
-    # 如果是 SZ000001 或 SH600000 格式，转换为 000001.SZ 或 600000.SS
-    if s.startswith('SZ') and len(s) == 8:
-        return s[2:] + '.SZ'
-    elif s.startswith('SH') and len(s) == 8:
-        return s[2:] + '.SS'
-    # 如果是 000001.XSHE 格式，转换为 000001.SZ
-    elif s.endswith('.XSHE'):
-        return s.replace('.XSHE', '.SZ')
-    # 如果已经是标准格式（000001.SZ, 600000.SS），直接返回
-    elif '.' in s and (s.endswith('.SZ') or s.endswith('.SS')):
-        return s
-    # 如果只有6位数字，需要根据前缀判断市场
-    elif re.match(r'^\d{6}$', s):
-        if s.startswith(('000', '002', '003', '300')):
-            return s + '.SZ'  # 深市
-        elif s.startswith(('600', '601', '603', '605', '688')):
-            return s + '.SS'  # 沪市
-        else:
-            return s + '.SZ'  # 默认深市
+
+def _rolling_values(context, codes, kind):
+    """
+    从滚动状态取当前值：kind='amplitude' 返回 max_high/min_low，'bias' 返回 ma/close，按代码索引。
+    第二个返回值是状态无法给出的代码(不在归档中，或复权时窗口内发生除权)，由调用方按窗口计算。
+    """
+    archive = _bar_archive(context) if getattr(context, 'rolling_stats_enabled', False) else None
+    if archive is None:
+        return None, list(codes)
+    if _ROLLING['day'] != archive['day']:
+        state = _ROLLING['state'] if _ROLLING['state'] is not None else _rolling_load(context)
+        if state is not None and str(state['last']) != archive['meta']['dates'][-1]:
+            state = None
+        _ROLLING.update(day=archive['day'], state=state)
+    state = _ROLLING['state']
+    if state is None:
+        return None, list(codes)
+    index = archive['meta']['code_index']
+    n = len(state['close_sum'])
+    served = [c for c in codes if c in index and index[c] < n]
+    rows = np.array([index[c] for c in served], dtype=np.int64)
+    if kind == 'amplitude':
+        first, second = [], []
+        for side, out in (('max', first), ('min', second)):
+            head, size = state[side + '_head'][rows], state[side + '_size'][rows]
+            out.append(np.where(size > 0, state[side + '_vals'][rows, head], np.nan))
+        values = {'max_high': first[0], 'min_low': second[0]}
+        window = _AMPLITUDE_DAYS
     else:
-        # 提取6位数字并添加后缀
-        m = re.search(r'(\d{6})', s)
-        if m:
-            code = m.group(1)
-            if code.startswith(('000', '002', '003', '300')):
-                return code + '.SZ'
-            elif code.startswith(('600', '601', '603', '605', '688')):
-                return code + '.SS'
+        count = state['close_count'][rows]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ma = np.where(count > 0, state['close_sum'][rows] / count, np.nan)
+        ring = state['close_ring']
+        values = {'ma': ma, 'close': ring[rows, int(state['t']) % ring.shape[1]]}
+        window = _BIAS_DAYS
+    frame = pd.DataFrame(values, index=served)
+    rest = [c for c in codes if c not in frame.index]
+    adjust = _price_adjuster(context)
+    if adjust is not None:
+        # 窗口内各交易日复权因子相同的股票，统计量随价格做同一仿射变换；窗口内发生除权的改为按窗口计算
+        days = np.array(archive['meta']['dates'][-window:], dtype='datetime64[D]')
+        events = _exrights_cache(context)
+        asof = int(np.datetime64(context.current_dt.date(), 'D').astype(np.int64))
+        mode = context.price_adjust
+        split = []
+        for code in served:
+            code_events = events.get(code)
+            if code_events is None or not len(code_events):
+                continue
+            A, B = _adjust_factors(code_events, days.astype(np.int64), asof, mode)
+            if A.min() != A.max() or B.min() != B.max():
+                split.append(code)
             else:
-                return code + '.SZ'
-        return s
+                frame.loc[code] = frame.loc[code] * A[0] + B[0]
+        if split:
+            frame = frame.drop(index=split)
+            rest.extend(split)
+    return frame, rest
+
+
+def _daily_bars(context, count, fields, stocks):
+    """
+    选股价格阶段的日线窗口(截至上一交易日)：优先从本地归档切片(按 price_adjust 复权)，
+    不可用时调用get_history(复权方式相同，由平台计算)
+    """
+    fq = getattr(context, 'price_adjust', None)
+    if getattr(context, 'bar_archive_enabled', False):
+        state = _bar_archive(context)
+        if state is not None:
+            meta = state['meta']
+            frame = _panel_frame(state['panels'], meta['dates'], meta['code_index'], count, list(stocks), fields,
+                                 adjust=_price_adjuster(context))
+            if frame is not None:
+                return frame
+    if fq in ('pre', 'post'):
+        return get_history(count, '1d', fields, security_list=stocks, fq=fq)
+    return get_history(count, '1d', fields, security_list=stocks)
+
+
+# 预筛股票池：context.universe_prescreen 开启后，选股漏斗不再从全部A股开始，而是从每日构建一次的基础池开始：
+# 按代码前缀剔除本策略从不买入的板块，上市日期按代码永久缓存、名称(ST)按日缓存，可选与指数成分股/所属板块取交集，
+# 之后各阶段的行情和基本面请求随股票数同比缩小
+_UNIVERSE = {'day': None, 'codes': [], 'listed': {}, 'names_day': None, 'names': {}, 'blocks': {}}
+# 本策略从不买入的板块：代码前缀 -> 名称(与第13步一致)
+_EXCLUDED_BOARDS = (('68', '科创板'), ('3', '创业板'), ('8', '北交所'))
+# 上市时间下限(自然日)
+_MIN_LISTED_DAYS = 365 * 2
+
+
+def _excluded_board(code):
+    for prefix, board in _EXCLUDED_BOARDS:
+        if code.startswith(prefix):
+            return board
+    return None
+
+
+def _parse_listed_date(value):
+    for fmt in ('%Y-%m-%d', '%Y%m%d'):
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    return None
+
+
+def _listing_info(stocks):
+    """上市日期：按代码永久缓存，只为未缓存的股票调用一次get_stock_info；返回与get_stock_info相同的结构"""
+    cache = _UNIVERSE['listed']
+    missing = [stock for stock in stocks if stock not in cache]
+    if missing:
+        info = get_stock_info(missing, ['listed_date']) or {}
+        cache.update((stock, value.get('listed_date')) for stock, value in info.items() if isinstance(value, dict))
+    return dict((stock, {'listed_date': cache[stock]}) for stock in stocks if cache.get(stock) is not None)
+
+
+def _stock_names(context, stocks):
+    """当日股票名称(用于判断ST)：按交易日缓存，只为未缓存的股票调用一次get_stock_info"""
+    day = context.current_dt.date()
+    if _UNIVERSE['names_day'] != day:
+        _UNIVERSE.update(names_day=day, names={})
+    names = _UNIVERSE['names']
+    missing = [stock for stock in stocks if stock not in names]
+    if missing:
+        info = get_stock_info(missing, ['stock_name']) or {}
+        names.update((stock, value.get('stock_name', '')) for stock, value in info.items() if isinstance(value, dict))
+    return dict((stock, {'stock_name': names[stock]}) for stock in stocks if stock in names)
+
+
+def _in_blocks(code, wanted):
+    """股票所属板块(get_stock_blocks，按代码缓存)中是否有 wanted 中的板块代码或名称"""
+    blocks = _UNIVERSE['blocks'].get(code)
+    if blocks is None:
+        blocks = set()
+        try:
+            for entries in (get_stock_blocks(code) or {}).values():
+                for entry in entries or []:
+                    blocks.update(str(item) for item in entry)
+        except Exception as e:
+            log.debug('获取所属板块失败 %s: %s' % (code, str(e)))
+        _UNIVERSE['blocks'][code] = blocks
+    return bool(blocks & wanted)
+
+
+def _eligible_universe(context):
+    """
+    当日预筛股票池(每个交易日只构建一次)：板块前缀 -> 指数成分股 -> 上市满2年 -> 非ST -> 所属板块，
+    按代价从低到高依次过滤，get_stock_blocks 只对前面留下的股票调用
+    """
+    day = context.current_dt.date()
+    if _UNIVERSE['day'] == day:
+        return list(_UNIVERSE['codes'])
+    t0 = time.time()
+    stocks = list(get_Ashares())
+    counts = [('全部A股', len(stocks))]
+    codes = [stock for stock in stocks if not _excluded_board(stock)]
+    counts.append(('板块', len(codes)))
+    index = getattr(context, 'universe_index', None)
+    if index:
+        members = set(get_index_stocks(index) or [])
+        codes = [stock for stock in codes if stock in members]
+        counts.append(('指数%s' % index, len(codes)))
+    listed = _listing_info(codes)
+    now = context.current_dt
+    eligible = []
+    for stock in codes:
+        value = listed.get(stock, {}).get('listed_date')
+        list_date = _parse_listed_date(value) if isinstance(value, str) else None
+        if list_date is not None and (now - list_date).days > _MIN_LISTED_DAYS:
+            eligible.append(stock)
+    codes = eligible
+    counts.append(('上市时间', len(codes)))
+    names = _stock_names(context, codes)
+    codes = [stock for stock in codes if stock in names and 'ST' not in names[stock]['stock_name']]
+    counts.append(('ST', len(codes)))
+    blocks = getattr(context, 'universe_blocks', None)
+    if blocks:
+        wanted = set(blocks)
+        codes = [stock for stock in codes if _in_blocks(stock, wanted)]
+        counts.append(('所属板块', len(codes)))
+    _UNIVERSE.update(day=day, codes=codes)
+    log.info('预筛股票池: %s, 耗时%.2fs' % (' -> '.join('%s%d' % item for item in counts), time.time() - t0))
+    return list(codes)
+
 
 def get_stock_pool(context):
     """
     获取符合条件的股票池
     """
-    # 获取所有A股代码
-    stocks = get_Ashares()
-    log.info('初始股票池数量: %d' % len(stocks))
+    # 获取所有A股代码；开启预筛时从当日预筛股票池开始
+    if getattr(context, 'universe_prescreen', False):
+        stocks = _eligible_universe(context)
+        log.info('初始股票池数量(预筛): %d' % len(stocks))
+    else:
+        stocks = get_Ashares()
+        log.info('初始股票池数量: %d' % len(stocks))
+    _metric_stage(context, '初始', len(stocks))
     # 获取当前日期
     current_date = context.current_dt
     
-    # 1. 获取上市时间大于2年的股票
-    stock_info = get_stock_info(stocks, ['listed_date'])
+    # 1. 获取上市时间大于2年的股票(上市日期按代码缓存)
+    stock_info = _listing_info(stocks)
     valid_stocks = []
     for stock in stocks:
         try:
             start_date = stock_info[stock]['listed_date']
             if isinstance(start_date, str):
-                try:
-                    list_date = datetime.datetime.strptime(start_date, '%Y-%m-%d')  # 修改日期格式
-                except ValueError:
-                    try:
-                        list_date = datetime.datetime.strptime(start_date, '%Y%m%d')  # 尝试另一种格式
-                    except ValueError:
-                        log.info('股票 %s 的日期格式无法解析: %s' % (stock, start_date))
-                        continue
+                list_date = _parse_listed_date(start_date)
+                if list_date is None:
+                    log.info('股票 %s 的日期格式无法解析: %s' % (stock, start_date))
+                    continue
                 days_listed = (current_date - list_date).days
                 if days_listed > 365*2:
                     valid_stocks.append(stock)
@@ -162,34 +2113,33 @@ def get_stock_pool(context):
         return []
     
     log.info('上市时间筛选后数量: %d' % len(valid_stocks))
+    _metric_stage(context, '上市时间', len(valid_stocks))
     
     # 2和3暂时跳过因为API不支持违规和问询信息
     # 4暂时跳过因为无法获取未来数据
     
     # 5. 剔除近30天内振幅最大的前5%的股票
     # log.info('开始振幅筛选，筛选前股票数量: %d' % len(valid_stocks))
-    price_data = get_history(30, '1d', ['high', 'low'], security_list=valid_stocks)
+    # 滚动统计可用时直接取30日最高/最低，其余股票按窗口计算
+    rolling, rest = _rolling_values(context, valid_stocks, 'amplitude')
+    price_data = _compact_frame(_daily_bars(context, _AMPLITUDE_DAYS, ['high', 'low'], rest)) if rest else None
+    _track_memory(context, '振幅', price_data)
     # log.info('获取到的价格数据形状: %s' % str(price_data.shape))
     
     amplitudes = {}
-    for stock in valid_stocks:
-        try:
-            stock_data = price_data[price_data['code'] == stock]
-            highs = stock_data['high'].values
-            lows = stock_data['low'].values
-            
-            if len(highs) > 0 and len(lows) > 0:
-                highs = highs[~np.isnan(highs)]  # 移除NaN值
-                lows = lows[~np.isnan(lows)]     # 移除NaN值
-                if len(highs) > 0 and len(lows) > 0:
-                    max_high = max(highs)
-                    min_low = min(lows)
-                    if min_low > 0:  # 确保不会除以0
-                        amplitude = (max_high - min_low) / min_low
-                        amplitudes[stock] = amplitude
-        except Exception as e:
-            log.info('计算股票 %s 振幅时出错: %s' % (stock, str(e)))
-            continue
+    try:
+        max_high = rolling['max_high'] if rolling is not None else pd.Series(dtype=np.float64)
+        min_low = rolling['min_low'] if rolling is not None else pd.Series(dtype=np.float64)
+        if price_data is not None and not price_data.empty:
+            # 按代码分组一次性求30日最高/最低（自动忽略NaN），不再逐只股票切片
+            grouped = price_data.groupby('code', observed=True)
+            max_high = pd.concat([max_high, grouped['high'].max().astype(np.float64)])
+            min_low = pd.concat([min_low, grouped['low'].min().astype(np.float64)])
+        amplitude = ((max_high - min_low) / min_low)[min_low > 0].dropna()  # 确保不会除以0
+        amplitudes = dict((str(stock), float(value)) for stock, value in amplitude.items())
+    except Exception as e:
+        log.info('计算振幅时出错: %s' % str(e))
+    del price_data
             
     if not amplitudes:
         log.info('没有任何股票的振幅数据可用')
@@ -211,6 +2161,7 @@ def get_stock_pool(context):
         return []
     
     log.info('振幅筛选后数量: %d' % len(valid_stocks))
+    _metric_stage(context, '振幅', len(valid_stocks))
 
         
 
@@ -218,39 +2169,53 @@ def get_stock_pool(context):
     # 7. 20日乖离率10至90%的剔除 
     log.info('开始乖离率筛选，输入股票数量: %d' % len(valid_stocks))
     
-    # 获取价格数据，增加异常保护
-    try:
-        price_data = get_history(20, '1d', ['close'], security_list=valid_stocks)
-        current_data = get_history(1, '1d', ['close'], security_list=valid_stocks)
-        
-        if price_data is None or getattr(price_data, 'empty', False):
-            log.warning('无法获取20日历史价格数据，跳过乖离率筛选')
-            return valid_stocks
-        if current_data is None or getattr(current_data, 'empty', False):
-            log.warning('无法获取当前价格数据，跳过乖离率筛选')
-            return valid_stocks
-        
-        # 尽量给出数据量级，便于排查
+    # 滚动统计可用时直接取20日均价与最新收盘价，其余股票获取价格窗口，增加异常保护
+    rolling, rest = _rolling_values(context, valid_stocks, 'bias')
+    price_data = current_data = None
+    if rest:
         try:
-            log.info('成功获取价格数据，20日数据行数: %d，当前数据行数: %d' % (len(price_data), len(current_data)))
-        except Exception:
-            pass
-    except Exception as e:
-        log.error('获取价格数据时发生错误: %s' % str(e))
-        return valid_stocks
+            price_data = _compact_frame(_daily_bars(context, _BIAS_DAYS, ['close'], rest))
+            current_data = _compact_frame(_daily_bars(context, 1, ['close'], rest))
+            _track_memory(context, '乖离率', price_data, current_data)
+            
+            if rolling is None and (price_data is None or getattr(price_data, 'empty', False)):
+                log.warning('无法获取20日历史价格数据，跳过乖离率筛选')
+                return valid_stocks
+            if rolling is None and (current_data is None or getattr(current_data, 'empty', False)):
+                log.warning('无法获取当前价格数据，跳过乖离率筛选')
+                return valid_stocks
+            
+            # 尽量给出数据量级，便于排查
+            try:
+                log.info('成功获取价格数据，20日数据行数: %d，当前数据行数: %d' % (len(price_data), len(current_data)))
+            except Exception:
+                pass
+        except Exception as e:
+            log.error('获取价格数据时发生错误: %s' % str(e))
+            return valid_stocks
     
-    # 计算乖离率
+    # 计算乖离率：20日均价与最新收盘价各做一次分组聚合，再按股票查表
     bias = {}
     failed_stocks = []
+    ma20_map, current_map = {}, {}
+    if rolling is not None:
+        ma20_map = rolling['ma'].dropna().to_dict()
+        current_map = rolling['close'].to_dict()
+    try:
+        if price_data is not None and not price_data.empty:
+            ma20_map.update(price_data.groupby('code', observed=True)['close'].mean().astype(np.float64).to_dict())
+        if current_data is not None and not current_data.empty:
+            current_map.update(current_data.groupby('code', observed=True)['close'].first().astype(np.float64).to_dict())
+    except Exception as e:
+        log.error('计算20日均价时发生错误: %s' % str(e))
+    del price_data, current_data
     for stock in valid_stocks:
         try:
-            stock_price_data = price_data.query('code == "%s"' % stock)['close']
-            stock_current_data = current_data.query('code == "%s"' % stock)['close']
-            if getattr(stock_price_data, 'empty', False) or getattr(stock_current_data, 'empty', False):
+            if stock not in ma20_map or stock not in current_map:
                 failed_stocks.append((stock, '数据为空'))
                 continue
-            ma20 = stock_price_data.mean()
-            current_price = stock_current_data.iloc[0]
+            ma20 = ma20_map[stock]
+            current_price = current_map[stock]
             if ma20 > 0 and not np.isnan(ma20) and not np.isnan(current_price):
                 bias[stock] = (current_price - ma20) / ma20 * 100
             else:
@@ -292,16 +2257,18 @@ def get_stock_pool(context):
         log.info('返回所有有乖离率数据的股票，数量: %d' % len(valid_stocks))
     
     log.info('乖离率筛选后数量: %d' % len(valid_stocks))
+    _metric_stage(context, '乖离率', len(valid_stocks))
         
     # 8. TTM股息等于0的剔除
     try:
         # 获取估值数据中的滚动股息率
-        dividend_data = get_fundamentals(valid_stocks, 'valuation', fields=['dividend_ratio'])
+        dividend_data = _compact_fundamentals(get_fundamentals(valid_stocks, 'valuation', fields=['dividend_ratio']))
         # log.info('获取到的股息率数据类型: %s' % type(dividend_data))
         
         if dividend_data is None or len(dividend_data) == 0:
             log.info('获取到的股息率数据为空')
             return []
+        _track_memory(context, '股息率', dividend_data)
             
         # 处理股息率数据
         dividends = {}
@@ -357,6 +2324,7 @@ def get_stock_pool(context):
             return []
         
         log.info('股息率筛选后数量: %d' % len(valid_stocks))
+        _metric_stage(context, '股息率', len(valid_stocks))
         # 正确log 
         # log.info('股息率筛选后股票: %s' % valid_stocks)
         
@@ -373,6 +2341,7 @@ def get_stock_pool(context):
                                        start_year=str(current_year-2),  # 从当前年份往前推2年
                                        end_year=str(current_year-1), 
                                        report_types='1')  # 只看年报
+        financial_data = _compact_fundamentals(financial_data)
         
         log.info('尝试获取的股票数量: %d' % len(valid_stocks))
         # log.info('获取到的财务数据类型: %s' % type(financial_data))
@@ -380,6 +2349,7 @@ def get_stock_pool(context):
         if financial_data is None or len(financial_data) == 0:
             log.info('获取到的财务数据为空')
             return []
+        _track_memory(context, '利润表', financial_data)
             
         # 处理净利润数据
         valid_profit_stocks = []
@@ -419,7 +2389,7 @@ def get_stock_pool(context):
                         else:
                             problematic_stocks.append((stock, recent_profits))
                     else:
-                        log.info('股票 %s 财务数据不足两年' % stock)
+                        _log_event('finance', 'info', '股票 %s 财务数据不足两年', stock)
                             
             except Exception as e:
                 log.error('处理股票 %s 时发生错误: %s' % (stock, str(e)))
@@ -440,6 +2410,7 @@ def get_stock_pool(context):
             return []
         
         log.info('盈利能力筛选后数量: %d' % len(valid_stocks))
+        _metric_stage(context, '盈利能力', len(valid_stocks))
         # log.info('盈利能力筛选后股票: %s' % valid_stocks)
         
     except Exception as e:
@@ -452,12 +2423,13 @@ def get_stock_pool(context):
     
     try:
         # 使用PTrade API获取资产负债表数据
-        debt_data = get_fundamentals(valid_stocks, 'balance_statement', 
-                                   fields=['total_liability', 'total_assets'])
+        debt_data = _compact_fundamentals(get_fundamentals(valid_stocks, 'balance_statement', 
+                                                           fields=['total_liability', 'total_assets']))
         
         if debt_data is None or len(debt_data) == 0:
             log.warning('获取资产负债表数据为空，跳过资产负债率筛选')
             return []
+        _track_memory(context, '资产负债表', debt_data)
             
         filtered_stocks = []
         removed_stocks = []
@@ -534,6 +2506,7 @@ def get_stock_pool(context):
         log.info("==========资产负债率筛选结束==========")
         
         valid_stocks = filtered_stocks
+        _metric_stage(context, '资产负债率', len(valid_stocks))
         
     except Exception as e:
         log.error('获取资产负债率数据时发生错误: {}'.format(str(e)))
@@ -554,20 +2527,15 @@ def get_stock_pool(context):
         log.info('资产负债率筛选后数量: %d' % len(valid_stocks))
     # 11. 剔除收盘价最高的10%
     try:
-        price_data = get_history(1, '1d', ['close'], security_list=valid_stocks)
+        price_data = _compact_frame(_daily_bars(context, 1, ['close'], valid_stocks))
         if price_data is None or price_data.empty:
             log.info('获取价格数据为空')
             return []
+        _track_memory(context, '收盘价', price_data)
             
-        prices = {}
-        for stock in valid_stocks:
-            try:
-                stock_data = price_data[price_data['code'] == stock]
-                if not stock_data.empty:
-                    prices[stock] = stock_data['close'].iloc[0]
-            except Exception as e:
-                log.info('处理股票 %s 收盘价时出错: %s' % (stock, str(e)))
-                continue
+        close_map = price_data.groupby('code', observed=True)['close'].first().astype(np.float64).to_dict()
+        del price_data
+        prices = dict((stock, close_map[stock]) for stock in valid_stocks if stock in close_map)
                 
         if not prices:
             return []
@@ -589,6 +2557,7 @@ def get_stock_pool(context):
             return []
         
         log.info('收盘价筛选后数量: %d' % len(valid_stocks))
+        _metric_stage(context, '收盘价', len(valid_stocks))
         
     except Exception as e:
         log.error('获取收盘价数据时发生错误: %s' % str(e))
@@ -597,12 +2566,13 @@ def get_stock_pool(context):
     # 12. 剔除总市值排名最大的95%
     try:
         # 使用valuation表获取总市值数据
-        market_data = get_fundamentals(valid_stocks, 'valuation', 
-                                     fields=['total_value'])  # total_value是A股总市值
+        market_data = _compact_fundamentals(get_fundamentals(valid_stocks, 'valuation', 
+                                                             fields=['total_value']))  # total_value是A股总市值
         
         if market_data is None or len(market_data) == 0:
             log.info('获取市值数据为空')
             return []
+        _track_memory(context, '市值', market_data)
             
         caps = {}
         for stock in valid_stocks:
@@ -626,9 +2596,7 @@ def get_stock_pool(context):
                            if cap > threshold]
         
         if large_cap_stocks:
-            log.info('以下股票因市值过大被剔除:')
-            for stock, cap in sorted(large_cap_stocks, key=lambda x: x[1], reverse=True)[:5]:
-                log.info('  %s: 总市值 %.2f亿' % (stock, cap/100000000))
+            _log_summary('市值过大被剔除', dict((stock, cap / 100000000) for stock, cap in large_cap_stocks), unit='亿')
                 
         valid_stocks = [stock for stock in valid_stocks if stock in caps 
                        and caps[stock] <= threshold]
@@ -638,6 +2606,7 @@ def get_stock_pool(context):
             return []
         
         log.info('市值筛选后数量: %d' % len(valid_stocks))
+        _metric_stage(context, '市值', len(valid_stocks))
         
     except Exception as e:
         log.error('获取市值数据时发生错误: %s' % str(e))
@@ -648,12 +2617,13 @@ def get_stock_pool(context):
     log.info("输入股票数量: {}".format(len(valid_stocks)))
     try:
         # 使用PTrade API获取估值数据中的换手率
-        turnover_data = get_fundamentals(valid_stocks, 'valuation', 
-                                       fields=['turnover_rate'])
+        turnover_data = _compact_fundamentals(get_fundamentals(valid_stocks, 'valuation', 
+                                                               fields=['turnover_rate']))
         
         if turnover_data is None or len(turnover_data) == 0:
             log.warning('获取换手率数据为空，跳过换手率筛选')
             return []
+        _track_memory(context, '换手率', turnover_data)
             
         # 处理换手率数据
         turnovers = {}
@@ -677,7 +2647,7 @@ def get_stock_pool(context):
                             turnovers[stock] = turnover_rate
                             # log.debug("股票 {} 换手率: {:.2f}%".format(stock, turnover_rate))
                         else:
-                            log.debug("股票 {} 换手率为0，跳过".format(stock))
+                            _log_event('turnover', 'debug', '股票 %s 换手率为0，跳过', stock)
                             invalid_data_count += 1
                     else:
                         log.warning("股票 {} 未找到换手率数据".format(stock))
@@ -720,7 +2690,7 @@ def get_stock_pool(context):
                         turnovers[stock] = turnover_rate
                         # log.debug("股票 {} 换手率: {:.2f}%".format(stock, turnover_rate))
                     else:
-                        log.debug("股票 {} 换手率为0，跳过".format(stock))
+                        _log_event('turnover', 'debug', '股票 %s 换手率为0，跳过', stock)
                         invalid_data_count += 1
                         
                 except Exception as e:
@@ -766,13 +2736,11 @@ def get_stock_pool(context):
         # 保留的股票列表
         filtered_stocks = [stock for stock, rate in keep_stocks if stock in valid_stocks]
         
-        # 记录被剔除的股票
+        # 记录被剔除的股票：一条汇总，逐只明细只进入采样日志
         if high_turnover_stocks:
-            log.info('以下 {} 只股票因换手率过高被剔除:'.format(len(high_turnover_stocks)))
-            for stock, rate in high_turnover_stocks[:10]:  # 只显示前10只
-                log.info('  {}: 换手率 {:.2f}%'.format(stock, rate))
-            if len(high_turnover_stocks) > 10:
-                log.info('  ... 还有 {} 只股票被剔除'.format(len(high_turnover_stocks) - 10))
+            _log_summary('换手率过高被剔除', dict(high_turnover_stocks), top_k=10, unit='%')
+            for stock, rate in high_turnover_stocks:
+                _log_event('turnover', 'debug', '  %s: 换手率 %.2f%%', stock, rate)
         
         if not filtered_stocks:
             log.warning('换手率筛选后股票池为空')
@@ -794,12 +2762,13 @@ def get_stock_pool(context):
         return []
         
     log.info('最终筛选后数量: %d' % len(valid_stocks))
+    _metric_stage(context, '换手率', len(valid_stocks))
     # log.info('最终筛选后股票: %s' % valid_stocks) 
     
-    # 13. 剔除科创板、创业板、北交所、ST
+    # 13. 剔除科创板、创业板、北交所、ST(名称取当日缓存，预筛时已全部取到)
     try:
-        stock_info = get_stock_info(valid_stocks, ['stock_name'])
-        if stock_info is None:
+        stock_info = _stock_names(context, valid_stocks)
+        if not stock_info:
             log.info('获取股票信息为空')
             return []
             
@@ -816,15 +2785,10 @@ def get_stock_pool(context):
                     is_excluded = False
                     reason = None
                     
-                    if stock.startswith('68'):
-                        is_excluded = True
-                        reason = '科创板'
-                    elif stock.startswith('3'):
+                    board = _excluded_board(stock)
+                    if board:
                         is_excluded = True
-                        reason = '创业板'
-                    elif stock.startswith('8'):
-                        is_excluded = True
-                        reason = '北交所'
+                        reason = board
                     elif 'ST' in stock_name:
                         is_excluded = True
                         reason = 'ST股票'
@@ -839,8 +2803,14 @@ def get_stock_pool(context):
                 continue
                 
         valid_stocks = filtered_stocks
+        # 缓存名称供后续日志使用，避免为拼日志再次调用get_stock_info
+        if not isinstance(getattr(context, 'stock_names', None), dict):
+            context.stock_names = {}
+        context.stock_names.update((stock, info.get('stock_name', '')) for stock, info in stock_info.items()
+                                   if isinstance(info, dict))
     
         log.info('科创板等剔除后数量: %d' % len(valid_stocks))
+        _metric_stage(context, '板块与ST', len(valid_stocks))
         # log.info('科创板等剔除后股票: %s' % valid_stocks)
         
     except Exception as e:
@@ -849,6 +2819,177 @@ def get_stock_pool(context):
     
     return valid_stocks
 
+# 流动性容量：按候选股票近 capacity_adv_days 日的日均成交额(收盘价x成交量，本地归档开启时取自归档)，
+# 以总资产/selection_count 作为单只满仓金额，参与率超过 capacity_participation 的股票标记('flag')或剔除('drop')，
+# 并给出本次入选股票在该参与率下能容纳的最大资金规模
+def _average_daily_value(context, stocks, days):
+    """日均成交额(元)：code -> 均值，停牌的日期(无数据或成交量为0的补齐K线)不计入"""
+    bars = _daily_bars(context, days, ['close', 'volume'], stocks)
+    if bars is None or getattr(bars, 'empty', True):
+        return {}
+    volume = bars['volume'].to_numpy(dtype=np.float64)
+    value = bars['close'].to_numpy(dtype=np.float64) * np.where(volume > 0, volume, np.nan)
+    frame = pd.DataFrame({'code': bars['code'].astype(str).to_numpy(), 'value': value})
+    return frame.groupby('code')['value'].mean().dropna().to_dict()
+
+
+def _capacity_screen(context, ranked):
+    """按排名顺序检查流动性容量；返回(剔除超限后的)排名列表"""
+    mode = getattr(context, 'capacity_mode', None)
+    if mode not in ('flag', 'drop') or not ranked:
+        return ranked
+    try:
+        count = max(int(getattr(context, 'selection_count', 5)), 1)
+        limit = float(context.capacity_participation)
+        position = float(context.portfolio.portfolio_value) / count
+        adv = _average_daily_value(context, ranked, context.capacity_adv_days)
+        participation = dict((stock, position / adv[stock]) for stock in ranked if adv.get(stock, 0) > 0)
+        over = [stock for stock in ranked if participation.get(stock, float('inf')) > limit]
+        if participation:
+            _log_summary('满仓参与率', dict((k, v * 100) for k, v in participation.items()), top_k=5, unit='%')
+        if over:
+            log.info('流动性容量超限(单只%.0f元, 参与率上限%.1f%%): %s' % (
+                position, limit * 100, ', '.join('%s(%s)' % (stock, '%.1f%%' % (participation[stock] * 100)
+                                                 if stock in participation else '无成交') for stock in over[:20])))
+        excluded = set(over) if mode == 'drop' else set()
+        kept = [stock for stock in ranked if stock not in excluded]
+        top = kept[:count]
+        capacities = dict((stock, limit * adv[stock] * count) for stock in top if adv.get(stock, 0) > 0)
+        if capacities:
+            binding = min(capacities, key=capacities.get)
+            log.info('入选股票容量上限: %.0f万元(受限于%s, 日均成交额%.0f万元), 当前总资产%.0f万元' % (
+                capacities[binding] / 1e4, _named(context, [binding]), adv[binding] / 1e4, position * count / 1e4))
+            run = getattr(g, 'metrics_run', None)
+            if run:
+                run['capacity_aum'] = capacities[binding]
+        _metric_stage(context, '流动性', len(kept))
+        return kept
+    except Exception as e:
+        log.warning('流动性容量检查失败，按原排名选股: %s' % str(e))
+        return ranked
+
+
+# 调仓日程：首次运行时用一次 get_trade_days 载入交易日历，预先算出每周的调仓日(按 rebalance_roll 处理节假日)
+# 和最终清仓日；handle_data 在非调仓日只做一次字典查找即返回。日历用完或相关设置变化时重新计算
+_SCHEDULE = {'key': None, 'start': None, 'end': None, 'rebalance': set(), 'liquidation': None}
+# 日历一次载入的天数(自然日)
+_SCHEDULE_HORIZON_DAYS = 400
+
+
+def _build_schedule(context, today):
+    """
+    从本周一起载入交易日历，按ISO周分组：设定的 weekly_buy_weekday 是交易日时在当天调仓，
+    否则按 rebalance_roll 处理：'previous' 提前到本周此前最近的交易日，'next' 顺延到本周此后最近的交易日，'skip' 本周不调仓。
+    日历载入到期末所在周的周日，只按完整的周计算；平台日历不足期末(最后一周可能不完整)时舍弃最后一周，
+    日程截止到其前一天，重建后再按完整的周计算，避免同一周在截断处和真正的调仓日各调仓一次
+    """
+    weekday = getattr(context, 'weekly_buy_weekday', 0)
+    roll = getattr(context, 'rebalance_roll', 'previous')
+    end_date = getattr(context, 'trading_end_date', None)
+    start = today - datetime.timedelta(days=today.weekday())
+    horizon = today + datetime.timedelta(days=_SCHEDULE_HORIZON_DAYS)
+    horizon += datetime.timedelta(days=6 - horizon.weekday())
+    days = [pd.Timestamp(d).date() for d in get_trade_days(start_date=start.strftime('%Y-%m-%d'),
+                                                           end_date=horizon.strftime('%Y-%m-%d'))]
+    end = horizon
+    if days and max(days) < horizon - datetime.timedelta(days=6):
+        last_monday = max(days) - datetime.timedelta(days=max(days).weekday())
+        if last_monday > today:
+            days = [d for d in days if d < last_monday]
+            end = last_monday - datetime.timedelta(days=1)
+        else:
+            end = max(days)
+    weeks = {}
+    for day in days:
+        weeks.setdefault(day.isocalendar()[:2], []).append(day)
+    rebalance = set()
+    for week_days in weeks.values():
+        target = week_days[0] - datetime.timedelta(days=week_days[0].weekday() - weekday)
+        earlier = [d for d in week_days if d < target]
+        later = [d for d in week_days if d > target]
+        if target in week_days:
+            chosen = target
+        elif roll == 'previous' and earlier:
+            chosen = earlier[-1]
+        elif roll == 'next' and later:
+            chosen = later[0]
+        else:
+            chosen = None
+        if chosen is not None and (end_date is None or chosen < end_date):
+            rebalance.add(chosen)
+    liquidation = None
+    if end_date is not None:
+        liquidation = next((d for d in days if d >= end_date), None)
+    _SCHEDULE.update(key=(weekday, roll, end_date), start=start, end=end if days else today,
+                     rebalance=rebalance, liquidation=liquidation)
+    upcoming = sorted(d for d in rebalance if d >= today)[:3]
+    log.info('调仓日程: 交易日历至%s, 调仓日%d个(近期 %s), 节假日规则%s, 最终清仓日%s' % (
+        _SCHEDULE['end'], len(rebalance), ', '.join(str(d) for d in upcoming), roll, liquidation or end_date))
+
+
+def _scheduled_action(context, today):
+    """
+    当天的调仓动作：'rebalance'、'liquidate'(最终清仓日起每天一次，直到持仓清空)、
+    当天已清仓或已清空后为 'finished'，其余为 None
+    """
+    state = _SCHEDULE
+    end_date = getattr(context, 'trading_end_date', None)
+    if getattr(context, 'liquidation_done', False):
+        return 'finished'
+    key = (getattr(context, 'weekly_buy_weekday', 0), getattr(context, 'rebalance_roll', 'previous'), end_date)
+    if state['key'] != key or not state['start'] <= today <= state['end']:
+        try:
+            _build_schedule(context, today)
+        except Exception as e:
+            # 取不到交易日历时按星期和结束日期判断，节假日不顺延
+            log.warning('载入交易日历失败，按星期判断调仓日: %s' % str(e))
+            state.update(key=None, liquidation=None)
+            if end_date is not None and today >= end_date:
+                return 'finished' if getattr(context, 'liquidated_on', None) == today else 'liquidate'
+            return 'rebalance' if today.weekday() == key[0] else None
+    liquidation = state['liquidation'] or end_date
+    if liquidation is not None and today >= liquidation:
+        return 'finished' if getattr(context, 'liquidated_on', None) == today else 'liquidate'
+    return 'rebalance' if today in state['rebalance'] else None
+
+
+def _final_liquidation(context):
+    """
+    最终清仓日起每天清仓一次：对仍有持仓的股票重新下单，前一日未成交(停牌、跌停、被拒或收盘撤单)的订单当天重试，
+    持仓全部清空后标记 liquidation_done，之后不再执行
+    """
+    log.info('已到达交易结束日期 %s，执行清仓操作' % context.trading_end_date)
+    context.liquidated_on = context.current_dt.date()
+    context.rotation_keep_codes = set()
+    try:
+        current_positions = get_positions()
+        held = [key for key, position in (current_positions or {}).items()
+                if (getattr(position, 'total_amount', None) or getattr(position, 'amount', 0) or 0) > 0]
+        if not held:
+            context.liquidation_done = True
+            log.info('当前无持仓，清仓完成')
+            return
+        if current_positions:
+            log.info('开始清仓，当前持仓: %s' % list(current_positions.keys()))
+            for pos_key, position in current_positions.items():
+                # 检查持仓数量，避免重复清仓和重复log
+                position_amount = 0
+                if hasattr(position, 'total_amount'):
+                    position_amount = position.total_amount
+                elif hasattr(position, 'amount'):
+                    position_amount = position.amount
+                
+                if position_amount > 0:
+                    try:
+                        order_target_value(pos_key, 0)
+                    except Exception as e:
+                        log.warning('清仓下单失败 %s: %s' % (pos_key, e))
+                    log.info('清仓股票: %s (持仓数量: %s)' % (pos_key, position_amount))
+            log.info('清仓操作完成，未成交的持仓下一交易日继续清仓')
+    except Exception as e:
+        log.error('清仓操作失败: %s' % str(e))
+
+
 def handle_data(context, data):
     """
     交易逻辑主函数 - 周五选股轮换策略
@@ -858,60 +2999,29 @@ def handle_data(context, data):
     - 买入本周五新增的股票
     
     特殊逻辑：
-    - 如果到达交易结束日期，执行清仓操作
+    - 调仓日和最终清仓日由交易日历预先算出(_build_schedule)，非调仓日直接返回
+    - 如果到达交易结束日期，每天执行一次清仓操作直到持仓清空，之后不再选股
     - 如果交易结束日期是周五，不执行买入操作，只执行清仓
     """
-    # 检查是否到达交易结束日期
+    _trace_event(context, 'handle_data')
     today = context.current_dt.date()
-    trading_end_date = getattr(context, 'trading_end_date', None)
-    
-    if trading_end_date and today >= trading_end_date:
-        log.info('已到达交易结束日期 %s，执行清仓操作' % trading_end_date)
-        # 执行清仓操作
-        try:
-            current_positions = get_positions()
-            if current_positions:
-                log.info('开始清仓，当前持仓: %s' % list(current_positions.keys()))
-                for pos_key, position in current_positions.items():
-                    # 检查持仓数量，避免重复清仓和重复log
-                    position_amount = 0
-                    if hasattr(position, 'total_amount'):
-                        position_amount = position.total_amount
-                    elif hasattr(position, 'amount'):
-                        position_amount = position.amount
-                    
-                    if position_amount > 0:
-                        try:
-                            order_target_value(pos_key, 0)
-                        except Exception as e:
-                            log.warning('清仓下单失败 %s: %s' % (pos_key, e))
-                        log.info('清仓股票: %s (持仓数量: %s)' % (pos_key, position_amount))
-                log.info('清仓操作完成')
-            else:
-                log.info('当前无持仓，无需清仓')
-        except Exception as e:
-            log.error('清仓操作失败: %s' % str(e))
+    action = _scheduled_action(context, today)
+    if action == 'finished':
+        return
+    if action is None:
+        # 当天首次提示，后续同日不再重复打印
+        if getattr(context, 'last_non_select_log_date', None) != today:
+            log.info('非选股日(weekday=%d)，跳过选股与调仓' % context.current_dt.weekday())
+            context.last_non_select_log_date = today
+        return
+    if action == 'liquidate':
+        _final_liquidation(context)
         return
     
-    # 仅在每周一执行选股和调仓
+    # 选股日：开盘后5分钟执行，同日只执行一次
     try:
         current_time = context.current_dt.time()
-        weekday = context.current_dt.weekday()
-        weekly_buy_weekday = getattr(context, 'weekly_buy_weekday', 0)
-        
-        if weekday != weekly_buy_weekday:
-            # 当天首次提示，后续同日不再重复打印
-            last_log_date = getattr(context, 'last_non_select_log_date', None)
-            if last_log_date != today:
-                log.info('非选股日(weekday=%d)，跳过选股与调仓' % weekday)
-                try:
-                    context.last_non_select_log_date = today
-                except Exception:
-                    pass
-            return
-            
         # 检查是否为开盘后5分钟（A股开盘时间为9:30，开盘后5分钟为9:35）
-        market_open_time = datetime.time(9, 30)  # 9:30开盘
         buy_time = datetime.time(9, 35)  # 开盘后5分钟
         
         if current_time < buy_time:
@@ -938,17 +3048,23 @@ def handle_data(context, data):
     except Exception as e:
         log.warning('选股日判断异常: %s，允许本次继续执行' % str(e))
     
+    _begin_memory_report(context)
+    _metrics_begin(context)
     stock_pool = get_stock_pool(context)
 
     # 若选股结果为空，直接返回，避免不必要的下单逻辑
     if not stock_pool:
         log.info('选股结果为空，本轮不进行调仓')
+        _metrics_record(context)
+        _end_memory_report(context)
+        _log_flush(context)
         return
     
     # 获取排序需要的数据
     try:
         # 1. 获取收盘价数据
-        price_data = get_history(1, '1d', ['close'], security_list=stock_pool)
+        price_data = _compact_frame(_daily_bars(context, 1, ['close'], stock_pool))
+        _track_memory(context, '排序收盘价', price_data)
         # log.info('价格数据类型: %s' % type(price_data))
         # log.info('价格数据形状: %s' % str(price_data.shape if hasattr(price_data, 'shape') else 'N/A'))
         # log.info('价格数据列名: %s' % str(price_data.columns.tolist() if hasattr(price_data, 'columns') else 'N/A'))
@@ -956,13 +3072,13 @@ def handle_data(context, data):
             log.debug('价格数据前几行:\n%s' % str(price_data))
         
         # 2. 获取股息率数据
-        dividend_data = get_fundamentals(stock_pool, 'valuation', fields=['dividend_ratio'])
+        dividend_data = _compact_fundamentals(get_fundamentals(stock_pool, 'valuation', fields=['dividend_ratio']))
         # log.info('股息率数据类型: %s' % type(dividend_data))
         if hasattr(dividend_data, 'head'):
             log.debug('股息率数据前几行:\n%s' % str(dividend_data.head()))
         
         # 3. 获取总市值数据
-        market_data = get_fundamentals(stock_pool, 'valuation', fields=['total_value'])
+        market_data = _compact_fundamentals(get_fundamentals(stock_pool, 'valuation', fields=['total_value']))
         log.info('总市值数据类型: %s' % type(market_data))
         if hasattr(market_data, 'head'):
             log.info('总市值数据前几行:\n%s' % str(market_data.head()))
@@ -1000,6 +3116,8 @@ def handle_data(context, data):
                     fields=['dividend_ratio', 'total_value'],
                     date=past_date
                 )
+            financial_data = _compact_fundamentals(financial_data)
+            dividend_data = _compact_fundamentals(dividend_data)
             
             # 打印数据结构信息用于调试
             # log.info(f'财务数据结构: 类型={type(financial_data)}, 形状={financial_data.shape if hasattr(financial_data, "shape") else "无形状"}')
@@ -1030,7 +3148,7 @@ def handle_data(context, data):
             或者 股息支付率 = 总分红金额 / 净利润 * 100%
             """
             try:
-                log.info('开始计算股票 %s 的股息支付率' % stock_code)
+                _log_event('payout', 'info', '开始计算股票 %s 的股息支付率', stock_code)
                 
                 # 获取净利润数据
                 net_profit = 0
@@ -1051,7 +3169,7 @@ def handle_data(context, data):
                         # 单级索引，直接查找
                         if stock_code in financial_df.index:
                             stock_financial = financial_df.loc[stock_code]
-                            log.info('股票 %s 在财务数据单级索引中找到' % stock_code)
+                            _log_event('payout', 'info', '股票 %s 在财务数据单级索引中找到', stock_code)
                     
                     if stock_financial is not None and not getattr(stock_financial, 'empty', False):
                         # 优先使用归属于母公司股东的净利润，其次使用净利润
@@ -1090,9 +3208,9 @@ def handle_data(context, data):
                                 else:
                                     net_profit = 0.0
                     else:
-                        log.info('股票 %s 未找到财务数据' % stock_code)
+                        _log_event('payout', 'info', '股票 %s 未找到财务数据', stock_code)
                 else:
-                    log.info('财务数据为空')
+                    _log_event('payout', 'info', '财务数据为空')
                 
                 # 获取股息数据
                 dividend_amount = 0
@@ -1105,7 +3223,7 @@ def handle_data(context, data):
                             try:
                                 if stock_code in dividend_df.index.get_level_values(level):
                                     stock_dividend = dividend_df.xs(stock_code, level=level)
-                                    log.info('股票 %s 在股息数据第%d级索引中找到' % (stock_code, level))
+                                    _log_event('payout', 'info', '股票 %s 在股息数据第%d级索引中找到', stock_code, level)
                                     break
                             except:
                                 continue
@@ -1113,7 +3231,7 @@ def handle_data(context, data):
                         # 单级索引，直接查找
                         if stock_code in dividend_df.index:
                             stock_dividend = dividend_df.loc[stock_code]
-                            log.info('股票 %s 在股息数据单级索引中找到' % stock_code)
+                            _log_event('payout', 'info', '股票 %s 在股息数据单级索引中找到', stock_code)
                     
                     if stock_dividend is not None and not getattr(stock_dividend, 'empty', False):
                         # 从股息率和市值计算分红金额
@@ -1149,34 +3267,47 @@ def handle_data(context, data):
                                 total_val = stock_dividend['total_value'].iloc[0]
                                 market_value = float(total_val) if pd.notna(total_val) and total_val != 0 else 0
                         
-                        log.info('股票 %s 股息率: %.2f%%, 市值: %.2f万元' % (stock_code, dividend_ratio, market_value/10000))
+                        _log_event('payout', 'info', '股票 %s 股息率: %.2f%%, 市值: %.2f万元', stock_code, dividend_ratio, market_value/10000)
                         
                         # 计算分红金额 = 市值 * 股息率 / 100
                         dividend_amount = market_value * dividend_ratio / 100
-                        log.info('股票 %s 分红金额: %.2f万元' % (stock_code, dividend_amount/10000))
+                        _log_event('payout', 'info', '股票 %s 分红金额: %.2f万元', stock_code, dividend_amount/10000)
                     else:
-                        log.info('股票 %s 未找到股息数据' % stock_code)
+                        _log_event('payout', 'info', '股票 %s 未找到股息数据', stock_code)
                 else:
-                    log.info('股息数据为空')
+                    _log_event('payout', 'info', '股息数据为空')
                 
                 # 计算股息支付率（不做截断，允许负值；净利润为0返回NaN）
                 net_profit_val = pd.to_numeric(net_profit, errors='coerce')
                 dividend_amount_val = pd.to_numeric(dividend_amount, errors='coerce')
                 
                 if pd.isna(net_profit_val) or pd.isna(dividend_amount_val):
-                    log.warning('股票 %s 股息支付率计算数据缺失: 净利润TTM=%s, 分红金额TTM=%s' % (stock_code, net_profit_val, dividend_amount_val))
+                    _log_event('payout', 'warning', '股票 %s 股息支付率计算数据缺失: 净利润TTM=%s, 分红金额TTM=%s', stock_code, net_profit_val, dividend_amount_val)
                     return np.nan
                 if float(net_profit_val) == 0.0:
-                    log.warning('股票 %s 净利润TTM为0，无法计算股息支付率，返回NaN')
+                    _log_event('payout', 'warning', '股票 %s 净利润TTM为0，无法计算股息支付率，返回NaN', stock_code)
                     return np.nan
                 
                 payout_ratio = (float(dividend_amount_val) / float(net_profit_val)) * 100
-                log.info('股票 %s 股息支付率: %.2f%% (净利润TTM: %.2f, 分红金额TTM: %.2f)' % (stock_code, payout_ratio, float(net_profit_val), float(dividend_amount_val)))
+                _log_event('payout', 'info', '股票 %s 股息支付率: %.2f%% (净利润TTM: %.2f, 分红金额TTM: %.2f)', stock_code, payout_ratio, float(net_profit_val), float(dividend_amount_val))
                 return float(payout_ratio)
             except Exception as e:
                 log.error('计算股票%s股息支付率时发生错误: %s' % (stock_code, str(e)))
                 return np.nan
         
+        # 收盘价按代码聚合一次；股息与市值合并表与股票无关，循环外只构建一次
+        close_map = {}
+        if price_data is not None and not price_data.empty and 'code' in price_data.columns:
+            close_map = price_data.groupby('code', observed=True)['close'].first().astype(np.float64).to_dict()
+        combined_data = pd.DataFrame()
+        if not dividend_data.empty and not market_data.empty:
+            try:
+                combined_data = pd.concat([dividend_data, market_data], axis=1)
+            except Exception as e:
+                log.error('合并股息和市值数据时出错: %s' % str(e))
+                combined_data = dividend_data  # 使用dividend_data作为备选
+        _track_memory(context, '排序因子', dividend_data, market_data, combined_data)
+
         # 处理每个股票的因子数据
         for stock in stock_pool:
             try:
@@ -1195,17 +3326,15 @@ def handle_data(context, data):
                 close_price = 0
                 if price_data is not None and not price_data.empty:
                     # 根据PTrade API，price_data通常包含code列
-                    log.info('股票 %s' % (price_data.columns))
                     if 'code' in price_data.columns:
-                        stock_price_data = price_data[price_data['code'] == stock]
-                        if not stock_price_data.empty:
-                            close_price = float(stock_price_data['close'].iloc[0])
+                        if stock in close_map:
+                            close_price = float(close_map[stock])
                     # 如果是以股票代码为列名的格式
                     elif stock in price_data.columns:
                         close_price = float(price_data[stock].iloc[0])
                 
                 stock_factors[stock]['close_price'] = close_price
-                log.info('股票 %s 收盘价: %.2f' % (stock, close_price))
+                _log_event('factor', 'info', '股票 %s 收盘价: %.2f', stock, close_price)
                 
                 # 2. 处理股息率数据（从dividend_data中获取）
                 # log.info('开始处理股票 %s 的股息率数据' % stock)
@@ -1226,7 +3355,7 @@ def handle_data(context, data):
                         # 单级索引，直接查找
                         if stock in dividend_data.index:
                             stock_dividend = dividend_data.loc[stock]
-                            log.info('股票 %s 在股息数据单级索引中找到' % stock)
+                            _log_event('factor', 'info', '股票 %s 在股息数据单级索引中找到', stock)
                     
                     if stock_dividend is not None and not stock_dividend.empty:
                         # log.info('股票 %s 股息数据类型: %s' % (stock, type(stock_dividend)))
@@ -1270,26 +3399,11 @@ def handle_data(context, data):
                                 stock_factors[stock]['market_value'] = float(market_val) if pd.notna(market_val) and market_val != 0 else float('inf')
                                 # log.info('股票 %s 市值(DataFrame): %.2f万元' % (stock, stock_factors[stock]['market_value']/10000))
                     else:
-                        log.info('股票 %s 未找到股息数据' % stock)
+                        _log_event('factor', 'info', '股票 %s 未找到股息数据', stock)
                 else:
-                    log.info('股息数据为空，股票 %s 跳过股息率处理' % stock)
+                    _log_event('factor', 'info', '股息数据为空，股票 %s 跳过股息率处理', stock)
                 
                 # 3. 计算股息支付率（使用新的计算函数，需要同时传递股息率和市值数据）
-                # 合并dividend_data和market_data用于计算
-                combined_data = pd.DataFrame()
-                if not dividend_data.empty and not market_data.empty:
-                    try:
-                        # 尝试合并dividend_data和market_data
-                        if hasattr(dividend_data.index, 'levels') and hasattr(market_data.index, 'levels'):
-                            # 都是MultiIndex
-                            combined_data = pd.concat([dividend_data, market_data], axis=1)
-                        else:
-                            # 简单合并
-                            combined_data = pd.concat([dividend_data, market_data], axis=1)
-                    except Exception as e:
-                        log.error('合并股息和市值数据时出错: %s' % str(e))
-                        combined_data = dividend_data  # 使用dividend_data作为备选
-                
                 stock_factors[stock]['payout_ratio'] = calculate_payout_ratio(stock, financial_data, combined_data)
                 
                 # 4. 高管增持比例暂时设为0，因为需要额外的数据源
@@ -1308,6 +3422,12 @@ def handle_data(context, data):
                 # 保持默认值，继续处理下一个股票
                 continue
 
+        # 市值缓存供盘后执行质量分析按市值分组，与名称缓存一样跨周累积
+        if not isinstance(getattr(context, 'stock_market_values', None), dict):
+            context.stock_market_values = {}
+        context.stock_market_values.update((stock, factors['market_value']) for stock, factors in stock_factors.items()
+                                           if np.isfinite(factors['market_value']))
+
         # 对每个因子进行排序并分配分数
         # 基于排名的加权总分：每个因子按有利方向排名，
         # 顶部得分为N，次序依次递减到1；总分为五个因子分数之和
@@ -1352,7 +3472,7 @@ def handle_data(context, data):
             score_insider = dict((s, 0) for s in stock_pool)
             score_mcap    = make_score_map(mcap_sorted)
             
-            # 计算总分并记录日志
+            # 计算总分；逐只得分进入采样日志，排序后输出一条得分分布汇总
             for stock in stock_pool:
                 total_score = (
                     score_close.get(stock, 0) +
@@ -1361,16 +3481,16 @@ def handle_data(context, data):
                     score_insider.get(stock, 0) +
                     score_mcap.get(stock, 0)
                 )
-                log.info('total_score: %s = %d (close=%d, div=%d, payout=%d, insider=%d, mcap=%d)' % (
-                    stock,
-                    total_score,
-                    score_close.get(stock, 0),
-                    score_div.get(stock, 0),
-                    score_payout.get(stock, 0),
-                    score_insider.get(stock, 0),
-                    score_mcap.get(stock, 0)
-                ))
+                _log_event('score', 'info', 'total_score: %s = %d (close=%d, div=%d, payout=%d, insider=%d, mcap=%d)',
+                           stock,
+                           total_score,
+                           score_close.get(stock, 0),
+                           score_div.get(stock, 0),
+                           score_payout.get(stock, 0),
+                           score_insider.get(stock, 0),
+                           score_mcap.get(stock, 0))
                 sorted_stocks.append((stock, total_score))
+            _log_summary('综合得分', dict(sorted_stocks), top_k=10)
             
         # 根据总分排序
         sorted_stocks.sort(key=lambda x: x[1], reverse=True)
@@ -1380,26 +3500,26 @@ def handle_data(context, data):
         
         log.info('多因子排序后的股票列表:')
         for stock, score in sorted_stocks:
-            stock_info = get_stock_info([stock], ['stock_name'])[stock]
-            log.info(f"{stock}({stock_info['stock_name']}): 收盘价={stock_factors[stock]['close_price']:.2f}, "
-                    f"股息率={stock_factors[stock]['dividend_ratio']:.2f}%, "
-                    f"股息支付率={stock_factors[stock]['payout_ratio']:.2f}, "
-                    f"总市值={stock_factors[stock]['market_value']/100000000:.2f}亿")
+            factors = stock_factors[stock]
+            _log_event('ranked', 'info', '%s(%s): 收盘价=%.2f, 股息率=%.2f%%, 股息支付率=%.2f, 总市值=%.2f亿',
+                       stock, _stock_name(context, stock), factors['close_price'], factors['dividend_ratio'],
+                       factors['payout_ratio'], factors['market_value'] / 100000000)
     
     except Exception as e:
         log.error(f'多因子排序过程中发生错误: {str(e)}')
     
-    log.debug('选股结果名称2: %s' % get_stock_info(stock_pool, ['stock_name']))
+    # 流动性容量：按近期日均成交额检查满仓单只的参与率，'drop' 时剔除超限股票由后续排名递补
+    stock_pool = _capacity_screen(context, stock_pool)
     
     # 选取前5只股票进行交易
     selection_count = getattr(context, 'selection_count', 5)
     top_stocks = stock_pool[:selection_count] if len(stock_pool) >= selection_count else stock_pool
-    log.info('选取前%d只股票进行交易: %s' % (len(top_stocks), get_stock_info(top_stocks, ['stock_name'])))
+    _metric_stage(context, '排序', len(top_stocks))
+    log.info('选取前%d只股票进行交易: %s' % (len(top_stocks), _named(context, top_stocks)))
     log.info('前%d只股票详细信息:' % len(top_stocks))
     for i, stock in enumerate(top_stocks, 1):
         if stock in stock_factors:
-            stock_info = get_stock_info([stock], ['stock_name'])[stock]
-            log.info(f"第{i}名: {stock}({stock_info['stock_name']}): "
+            log.info(f"第{i}名: {stock}({_stock_name(context, stock)}): "
                     f"收盘价={stock_factors[stock]['close_price']:.2f}, "
                     f"股息率={stock_factors[stock]['dividend_ratio']:.2f}%, "
                     f"总市值={stock_factors[stock]['market_value']/100000000:.2f}亿")
@@ -1433,50 +3553,264 @@ def handle_data(context, data):
     to_buy = sorted(list(current_selection - last_selection))
     
     if last_selection:
-        log.info('与上周五选股对比: 保留(重复)=%s, 卖出(不重复)=%s, 买入(新增)=%s' % (
-            get_stock_info(overlap, ['stock_name']) if overlap else {},
-            get_stock_info(to_sell, ['stock_name']) if to_sell else {},
-            get_stock_info(to_buy, ['stock_name']) if to_buy else {}
-        ))
+        log.info('与上周五选股对比: 保留(重复)=[%s], 卖出(不重复)=[%s], 买入(新增)=[%s]' % (
+            _named(context, overlap), _named(context, to_sell), _named(context, to_buy)))
+    else:
+        log.info('首次周五选股，无上周对比，目标买入: %s' % _named(context, top_stocks))
+
+    # 告知调仓逻辑保留 overlap，不对其做再平衡；仅卖出 to_sell，买入 to_buy
+    try:
+        context.rotation_keep_codes = overlap
+        log.info(f'本次保留并不再平衡的股票: {overlap}')
+    except Exception:
+        context.rotation_keep_codes = overlap
+
+    # 仅为新增(to_buy)构建目标权重，避免对重复(overlap)做再平衡
+    target_position = {}
+    if getattr(context, 'rebalance_mode', 'rotation') == 'full_book':
+        # 全组合再平衡：保留与新增股票统一等权，是否交易由adjust_position按容忍带和换手上限决定
+        weight = 1.0 / max(len(top_stocks), 1)
+        target_position = dict((stock, weight) for stock in top_stocks)
+        log.info(f'全组合再平衡: {len(top_stocks)}只股票等权，每只目标权重{weight:.2%}')
+    elif to_buy:
+        # 设置权重为“新增股票数量”的等权，确保总权重<=100%
+        weight = 1.0 / max(len(to_buy), 1)
+        for stock in to_buy:
+            target_position[stock] = weight
+        log.info(f'为新增{len(to_buy)}只股票设置目标权重，每只权重: {weight:.2%}')
     else:
-        log.info('首次周五选股，无上周对比，目标买入: %s' % get_stock_info(top_stocks, ['stock_name']))
+        log.info('本周选股与上周完全重合，无需新增买入')
+
+    # 调整仓位：将非保留的上周股票卖出，买入新增股票；保留重复股票不动
+    adjust_position(context, target_position)
+    _metrics_record(context)
+    _end_memory_report(context)
+    _log_flush(context)
+    
+    # 记录本次已在今日执行建仓，并更新上周一选股缓存
+    try:
+        context.last_buy_date = context.current_dt.date()
+        context.last_friday_selection = top_stocks
+        context.last_selection_date = context.current_dt.date()
+    except Exception:
+        pass
+
+    context.day_counter += 1
+    return
+
+def _snapshot_price(info):
+    if isinstance(info, dict) or hasattr(info, 'get'):
+        return info.get('last_px') or info.get('open_px')
+    return getattr(info, 'last_px', None) or getattr(info, 'open_px', None)
+
+
+def _last_by_code(frame, field='close'):
+    """长表按代码取最后一根K线，返回 {code: (价格, K线时间)}"""
+    result = {}
+    if not isinstance(frame, pd.DataFrame) or frame.empty or 'code' not in frame.columns:
+        return result
+    last = frame.dropna(subset=[field]).groupby('code', observed=True).tail(1)
+    for code, px, stamp in zip(last['code'], last[field], last.index):
+        result[str(code)] = (float(px), stamp.to_pydatetime() if hasattr(stamp, 'to_pydatetime') else None)
+    return result
+
+
+def _build_price_cache(context, stocks):
+    """
+    构建单次调仓内有效的价格缓存：交易端一次批量快照，缺口用一次5分钟K线补齐，仍缺失的再用一次日线收盘价兜底。
+    每条记录带来源(snapshot/5m/1d)与时间，日线兜底价视为过期价格。
+    """
+    codes = sorted(set(s for s in stocks if s))
+    cache = {}
+    if not codes:
+        return cache
+    now = context.current_dt
+    missing = list(codes)
+    try:
+        if 'is_trade' in globals() and is_trade():
+            snap = get_snapshot(codes)
+            if isinstance(snap, dict) or hasattr(snap, 'get'):
+                for stock in codes:
+                    info = snap.get(stock)
+                    px = _snapshot_price(info) if info is not None else None
+                    if px is not None and np.isfinite(px) and px > 0:
+                        cache[stock] = {'price': float(px), 'source': 'snapshot', 'as_of': now, 'stale': False,
+                                        'bid_grp': info.get('bid_grp'), 'offer_grp': info.get('offer_grp')}
+            missing = [s for s in codes if s not in cache]
+    except Exception as e:
+        log.warning(f'批量获取实时快照失败，回退到历史K线: {e}')
+
+    if missing:
+        try:
+            bars = _last_by_code(get_history(1, '5m', ['close'], security_list=missing, include=True))
+            for stock in missing:
+                if stock in bars:
+                    px, stamp = bars[stock]
+                    cache[stock] = {'price': px, 'source': '5m', 'as_of': stamp or now, 'stale': False}
+            missing = [s for s in missing if s not in cache]
+        except Exception as e:
+            log.warning(f'批量获取5分钟K线失败: {e}')
+
+    if missing:
+        try:
+            bars = _last_by_code(_daily_bars(context, 1, ['close'], missing))
+            for stock in missing:
+                if stock in bars:
+                    px, stamp = bars[stock]
+                    cache[stock] = {'price': px, 'source': '1d', 'as_of': stamp, 'stale': True}
+                    log.warning(f'无法获取股票{stock}9:35价格，使用当日收盘价: {px:.2f}元')
+            missing = [s for s in missing if s not in cache]
+        except Exception as e:
+            log.warning(f'批量获取日线收盘价失败: {e}')
+
+    sources = {}
+    for entry in cache.values():
+        sources[entry['source']] = sources.get(entry['source'], 0) + 1
+    log.info(f'调仓价格缓存: 共{len(codes)}只, 来源{sources}, 缺失{len(missing)}只')
+    return cache
+
+
+def _reference_price(context, stock):
+    """本次调仓的09:35参考价(价格缓存中的批量价格)，用于衡量成交相对参考价的执行偏差"""
+    entry = (getattr(context, 'price_cache', None) or {}).get(stock)
+    return entry['price'] if entry else None
+
+
+def _price_staleness(context, entry):
+    """价格距当前时间的秒数；时间未知时返回None"""
+    as_of = entry.get('as_of')
+    if isinstance(as_of, datetime.datetime):
+        return max((context.current_dt - as_of).total_seconds(), 0.0)
+    return None
+
+
+def _build_tradability(positions, stocks):
+    """
+    构建单次调仓的可交易性快照：停牌(get_stock_status)与涨跌停(check_limit)各批量查询一次，
+    可卖/总持仓直接取自已获取的持仓字典，不再逐只调用get_position。
+    limit取值同check_limit：1涨停、-1跌停、2/-2曾触及涨/跌停、0正常。
+    """
+    codes = sorted(set(s for s in stocks if s))
+    halted, limits = {}, {}
+    if codes:
+        try:
+            halted = get_stock_status(codes, 'HALT') or {}
+        except Exception as e:
+            log.warning(f'批量查询停牌状态失败，按未停牌处理: {e}')
+        if 'check_limit' in globals():
+            try:
+                limits = check_limit(codes) or {}
+            except Exception as e:
+                log.warning(f'批量查询涨跌停状态失败，按正常处理: {e}')
+    snapshot = {}
+    for stock in codes:
+        pos = positions.get(stock) if positions else None
+        try:
+            limit = int(limits.get(stock, 0) or 0)
+        except (TypeError, ValueError):
+            limit = 0
+        snapshot[stock] = {
+            'halted': bool(halted.get(stock, False)),
+            'limit': limit,
+            'enable_amount': getattr(pos, 'enable_amount', 0) if pos else 0,
+            'total_amount': (getattr(pos, 'amount', 0) or getattr(pos, 'total_amount', 0)) if pos else 0,
+        }
+    log.info(f'调仓可交易性快照: 共{len(codes)}只, 停牌{sum(1 for v in snapshot.values() if v["halted"])}只, '
+             f'涨停{sum(1 for v in snapshot.values() if v["limit"] == 1)}只, '
+             f'跌停{sum(1 for v in snapshot.values() if v["limit"] == -1)}只')
+    return snapshot
 
-    # 告知调仓逻辑保留 overlap，不对其做再平衡；仅卖出 to_sell，买入 to_buy
-    try:
-        context.rotation_keep_codes = overlap
-        log.info(f'本次保留并不再平衡的股票: {overlap}')
-    except Exception:
-        context.rotation_keep_codes = overlap
 
-    # 仅为新增(to_buy)构建目标权重，避免对重复(overlap)做再平衡
-    target_position = {}
-    if to_buy:
-        # 设置权重为“新增股票数量”的等权，确保总权重<=100%
-        weight = 1.0 / max(len(to_buy), 1)
-        for stock in to_buy:
-            target_position[stock] = weight
-        log.info(f'为新增{len(to_buy)}只股票设置目标权重，每只权重: {weight:.2%}')
-    else:
-        log.info('本周选股与上周完全重合，无需新增买入')
+def _depth_levels(info, side):
+    """对手方盘口 [(价格, 数量), ...]：买入看卖盘(offer_grp)，卖出看买盘(bid_grp)，按档位排序"""
+    if not info:
+        return []
+    grp = info.get('offer_grp') if side > 0 else info.get('bid_grp')
+    if not grp:
+        return []
+    items = sorted(grp.items()) if isinstance(grp, dict) else enumerate(grp, 1)
+    levels = []
+    for _, level in items:
+        try:
+            px = float(level[0])
+            vol = float(level[1]) if len(level) > 1 else 0.0
+        except (TypeError, ValueError, IndexError):
+            continue
+        if px > 0:
+            levels.append((px, vol))
+    return levels
 
-    # 调整仓位：将非保留的上周股票卖出，买入新增股票；保留重复股票不动
-    adjust_position(context, target_position)
-    
-    # 记录本次已在今日执行建仓，并更新上周一选股缓存
-    try:
-        context.last_buy_date = context.current_dt.date()
-        context.last_friday_selection = top_stocks
-        context.last_selection_date = context.current_dt.date()
-    except Exception:
-        pass
 
-    context.day_counter += 1
-    return
+def _depth_limit_price(info, side, qty, max_levels=3):
+    """
+    按可见深度为数量qty选择限价：取对手盘累计挂单量首次覆盖qty的档位价格，
+    最多穿越max_levels档；深度不足时以第max_levels档价格挂单等待成交。无盘口时返回None。
+    """
+    levels = _depth_levels(info, side)[:max_levels]
+    if not levels:
+        return None
+    cumulative = 0.0
+    for px, vol in levels:
+        cumulative += vol
+        if cumulative >= qty:
+            return px
+    return levels[-1][0]
+
+
+def _build_depth_cache(context, stocks):
+    """
+    交易端一次批量get_gear_price取全部候选股票的买卖档位；取不到的用价格缓存中快照的bid_grp/offer_grp补齐。
+    回测中没有盘口数据，返回空字典，限价沿用原逻辑。
+    """
+    codes = sorted(set(s for s in stocks if s))
+    depth = {}
+    if not codes or not ('is_trade' in globals() and is_trade()):
+        return depth
+    if 'get_gear_price' in globals():
+        try:
+            gear = get_gear_price(codes) or {}
+            # 单只股票时平台直接返回档位字典
+            if len(codes) == 1 and ('bid_grp' in gear or 'offer_grp' in gear):
+                gear = {codes[0]: gear}
+            for stock in codes:
+                info = gear.get(stock)
+                if info and (info.get('bid_grp') or info.get('offer_grp')):
+                    depth[stock] = info
+        except Exception as e:
+            log.warning(f'批量获取档位行情失败，改用快照盘口: {e}')
+    cache = getattr(context, 'price_cache', None) or {}
+    for stock in codes:
+        entry = cache.get(stock)
+        if stock not in depth and entry and (entry.get('bid_grp') or entry.get('offer_grp')):
+            depth[stock] = entry
+    log.info(f'调仓盘口深度: 共{len(codes)}只, 有深度{len(depth)}只')
+    return depth
+
+
+def _order_limit_price(context, stock, side, qty, fallback):
+    """本次调仓的委托限价：有盘口深度时按数量在对手盘中定价，否则沿用开盘后5分钟价格"""
+    depth = getattr(context, 'depth_cache', None) or {}
+    if qty and qty > 0 and stock in depth:
+        px = _depth_limit_price(depth[stock], side, qty, getattr(context, 'limit_max_levels', 3))
+        if px:
+            log.debug(f'股票{stock}按盘口深度定价: {"买" if side > 0 else "卖"}{qty:.0f}股, 限价{px:.2f}元'
+                      f'(参考价{fallback if fallback else 0:.2f}元)')
+            return px
+    return fallback
+
 
 def get_market_open_price(stock, context):
     """
     获取交易端实时价格（优先），回测端取9:35的5分钟收盘价；失败则回退到当日收盘价。
+    调仓期间优先读取 context.price_cache 中的批量价格，未命中时才逐只查询。
     """
+    cache = getattr(context, 'price_cache', None)
+    if cache and stock in cache:
+        entry = cache[stock]
+        age = _price_staleness(context, entry)
+        log.debug(f'股票{stock}缓存价格{entry["price"]:.2f}元, 来源{entry["source"]}, '
+                  f'距今{"未知" if age is None else "%.0f秒" % age}{", 已过期" if entry["stale"] else ""}')
+        return entry['price']
     try:
         # 交易端优先使用快照
         try:
@@ -1518,7 +3852,306 @@ def get_market_open_price(stock, context):
         log.error(f'获取股票{stock}价格失败: {str(e)}')
     return None
 
-def adjust_position(context, target_position):
+def _full_book_plan(weights, current_values, equity, band, turnover_budget=None, cash_buffer=0.05):
+    """
+    全组合再平衡计划(对整个目标组合向量化计算)。
+    目标市值 = 权重 × 总资产 × (1-现金缓冲)；当前权重与目标权重之差在band以内的股票不交易，
+    每只股票最多一笔净交易。turnover_budget(元)限制本次买卖成交额合计，超出时按交易额从大到小保留，
+    最后一笔按剩余额度缩减。返回 (代码列表, 目标市值数组, 计划交易额数组)，交易额>0买入、<0卖出。
+    """
+    codes = sorted(weights)
+    w = np.array([weights[c] for c in codes], dtype=np.float64)
+    v = np.array([current_values.get(c, 0.0) for c in codes], dtype=np.float64)
+    investable = max(equity * (1 - cash_buffer), 1e-9)
+    target = w * investable
+    trade = target - v
+    trade[np.abs(v / investable - w) <= band] = 0.0
+    if turnover_budget is not None:
+        order = np.argsort(-np.abs(trade), kind='stable')
+        size = np.abs(trade[order])
+        before = np.concatenate(([0.0], np.cumsum(size)[:-1]))
+        allowed = np.clip(turnover_budget - before, 0.0, None)
+        scale = np.where(size > 0, np.minimum(allowed / np.where(size > 0, size, 1.0), 1.0), 0.0)
+        trade[order] = trade[order] * scale
+    return codes, target, trade
+
+
+# A股买入最小单位(股)
+_LOT_SIZE = 100
+
+
+def _allocate_lots(prices, targets, cash, commission_ratio, min_commission, lot_size=_LOT_SIZE):
+    """
+    整手资金分配：在总成本(含佣金，单笔不足min_commission按min_commission收取)不超过cash的前提下，
+    为每只股票求整数手数，使买入金额贴近各自目标金额并尽量用满资金。
+    以 J = Σ(买入金额-目标金额)² + 剩余资金² 为目标，剩余资金按 min(cash, 目标合计) 计，现金多于目标时不为用满现金而超买；
+    从目标金额向下取整的手数出发，每次给使J下降最多的股票加一手，直到J不再下降或资金不足一手。返回 {股票: 股数}。
+    """
+    codes = [c for c in targets if prices.get(c) and prices[c] > 0 and targets[c] > 0]
+    if not codes or cash <= 0:
+        return {}
+    lot_value = np.array([prices[c] for c in codes], dtype=np.float64) * lot_size
+    target = np.array([targets[c] for c in codes], dtype=np.float64)
+
+    def cost(lots):
+        value = lots * lot_value
+        return np.where(lots > 0, value + np.maximum(value * commission_ratio, min_commission), 0.0)
+
+    budget = min(cash, target.sum())
+    lots = np.floor(target / (lot_value * (1 + commission_ratio))).astype(np.int64)
+    # 最低佣金可能使向下取整后的总成本仍超出资金，从超出目标最多的股票逐手减少
+    while lots.sum() > 0 and cost(lots).sum() > cash:
+        over = np.where(lots > 0, lots * lot_value - target, -np.inf)
+        lots[int(np.argmax(over))] -= 1
+    spent = cost(lots)
+    while True:
+        step_cost = cost(lots + 1) - spent
+        affordable = step_cost <= cash - spent.sum() + 1e-6
+        if not affordable.any():
+            break
+        # 加一手对J的变化：偏离项 2(v-t)L+L²，剩余资金项 c²-2Rc
+        remaining = budget - spent.sum()
+        delta = (2 * (lots * lot_value - target) * lot_value + lot_value ** 2
+                 + step_cost ** 2 - 2 * remaining * step_cost)
+        delta = np.where(affordable, delta, np.inf)
+        i = int(np.argmin(delta))
+        if delta[i] >= 0:
+            break
+        lots[i] += 1
+        spent[i] += step_cost[i]
+    return dict((c, int(n) * lot_size) for c, n in zip(codes, lots))
+
+
+def _committed_buy_cash():
+    """分片执行中尚未成交的买入母单按参考价占用的资金，含已报未成交的子单(保守计入)"""
+    committed = 0.0
+    for parent in (getattr(g, 'exec_parents', None) or {}).values():
+        if parent['state'] == 'working' and parent['side'] > 0:
+            committed += max(parent['total'] - parent['filled'], 0) * (parent.get('reference') or 0.0)
+    return committed
+
+
+def _sell_block_reason(stock, entry, bought_today):
+    """卖出前检查：可卖数量>0、非停牌、非跌停、非当日买入；可以卖出时返回None，否则返回原因"""
+    # 可卖数量检查
+    if entry['enable_amount'] <= 0:
+        return f'可卖数量为0(总持仓={entry["total_amount"]})'
+    # 停牌检查
+    if entry['halted']:
+        return '停牌中'
+    # 跌停封板时卖单难以成交，留待后续交易日
+    if entry['limit'] == -1:
+        return '跌停中'
+    # 当日买入检查（T+1保护）：查当日买入索引，不再逐只扫描成交
+    if stock in bought_today:
+        return '当日有买入成交(T+1)'
+    return None
+
+
+def _deferred_sell_stats(context):
+    stats = getattr(context, 'deferred_sell_stats', None)
+    if stats is None:
+        stats = context.deferred_sell_stats = {'runs': 0, 'submitted': 0, 'dropped': 0, 'wait_days': 0,
+                                               'released_value': 0.0, 'last_waiting': {}}
+    return stats
+
+
+def _process_deferred_sells(context, keep_codes, tradability, bought_today):
+    """
+    处理延迟卖出队列：保留集合中的或已无持仓的移出队列，可卖的按限价清仓，其余继续等待。
+    tradability(stock) 返回可交易性快照条目。返回提交的订单ID列表。
+    """
+    stats = _deferred_sell_stats(context)
+    since = getattr(context, 'deferred_since', None)
+    if since is None:
+        since = context.deferred_since = {}
+    today = context.current_dt.date()
+    processed, order_ids, waiting = [], [], {}
+    for stock in sorted(context.deferred_sells):
+        since.setdefault(stock, today)
+        # 检查是否在保留集合中
+        if _normalize_local(stock) in keep_codes:
+            log.info(f'延迟卖出队列中的股票{stock}在保留集合中，移出队列')
+            processed.append(stock)
+            stats['dropped'] += 1
+            continue
+        entry = tradability(stock)
+        if entry['total_amount'] <= 0:
+            log.info(f'延迟卖出队列中的股票{stock}已无持仓，移出队列')
+            processed.append(stock)
+            stats['dropped'] += 1
+            continue
+        reason = _sell_block_reason(stock, entry, bought_today)
+        if reason:
+            waiting[stock] = reason
+            log.info(f'延迟卖出继续等待: {stock}，原因: {reason}')
+            continue
+        try:
+            # 获取开盘后5分钟的价格作为限价，有盘口深度时按深度定价
+            market_open_price = _order_limit_price(context, stock, -1, entry['enable_amount'],
+                                                   get_market_open_price(stock, context))
+            if market_open_price:
+                # 使用开盘后5分钟价格作为限价进行卖出
+                order_id = order_target_value(stock, 0, limit_price=market_open_price)
+                _log_event('order', 'info', '延迟卖出%s使用开盘后5分钟价格%.2f元作为限价', stock, market_open_price)
+            else:
+                # 如果无法获取开盘后5分钟价格，使用市价单
+                order_id = order_target_value(stock, 0)
+                log.warning(f'延迟卖出无法获取开盘后5分钟价格，使用市价单')
+            
+            if order_id:
+                _register_order(context, order_id, stock, -1, _reference_price(context, stock), market_open_price)
+                order_ids.append(order_id)
+                processed.append(stock)
+                stats['submitted'] += 1
+                stats['wait_days'] += (today - since[stock]).days
+                stats['released_value'] += entry['enable_amount'] * (market_open_price or 0.0)
+                log.info(f'延迟卖出执行成功: {stock} (订单ID: {order_id}, 等待{(today - since[stock]).days}天)')
+            else:
+                log.warning(f'延迟卖出提交失败: {stock}')
+        except Exception as e:
+            log.warning(f'延迟卖出执行异常: {stock}, {str(e)}')
+    for stock in processed:
+        context.deferred_sells.discard(stock)
+        since.pop(stock, None)
+    stats['last_waiting'] = waiting
+    return order_ids
+
+
+def deferred_sell_worker(context):
+    """
+    每日延迟卖出任务(run_daily)：不依赖周度调仓，每天用一次批量取价和可交易性快照重新检查延迟卖出队列，
+    T+1到期、复牌或打开跌停后当天即卖出，回笼资金不必等到下一个调仓日。
+    """
+    if not getattr(context, 'deferred_sells', None):
+        return
+    _trace_event(context, 'deferred_sell_worker')
+    try:
+        positions = get_positions()
+    except Exception as e:
+        log.warning(f'延迟卖出任务获取持仓失败，使用context.portfolio.positions: {e}')
+        positions = context.portfolio.positions
+    codes = list(context.deferred_sells)
+    stats = _deferred_sell_stats(context)
+    stats['runs'] += 1
+    submitted_before, released_before = stats['submitted'], stats['released_value']
+    context.price_cache = _build_price_cache(context, codes)
+    context.depth_cache = _build_depth_cache(context, codes)
+    try:
+        snapshot = _build_tradability(positions, codes)
+        order_ids = _process_deferred_sells(context, getattr(context, 'rotation_keep_codes', set()),
+                                            lambda stock: snapshot[stock], _bought_today(context))
+        g.recent_orders.extend(order_ids)
+    finally:
+        context.price_cache = None
+        context.depth_cache = None
+    avg_wait = stats['wait_days'] / stats['submitted'] if stats['submitted'] else 0.0
+    log.info(f'延迟卖出任务: 本次提交{stats["submitted"] - submitted_before}只'
+             f'(预估回笼{stats["released_value"] - released_before:.0f}元), 继续等待{len(context.deferred_sells)}只; '
+             f'累计运行{stats["runs"]}次, 卖出{stats["submitted"]}只, 移出{stats["dropped"]}只, 平均等待{avg_wait:.1f}天')
+
+
+# 盘中风控：context.risk_monitor_enabled 开启后，交易端 run_interval 每 risk_interval_seconds 秒检查一次持仓。
+# 每次只调用一次批量 get_snapshot，按持仓数组判断跌停、止损(相对持仓成本)和移动止损(相对持仓以来最高价)，
+# 触发的股票按快照盘口限价卖出并登记到订单簿；可卖数量为0(T+1)或停牌的当天不再重复触发，下一交易日重新检查
+_RISK_HALT_STATUS = ('HALT', 'SUSP', 'STOPT', 'STOP', 'DELISTED')
+
+
+def _risk_triggers(price, cost, peak, down_px, stop_loss, trailing_stop, limit_down):
+    """按持仓数组判断风控规则，返回每只股票触发的规则(未触发为空串)；同时触发时依次取跌停、止损、移动止损"""
+    reasons = np.full(len(price), '', dtype=object)
+    valid = np.isfinite(price) & (price > 0)
+    with np.errstate(invalid='ignore'):
+        rules = (
+            ('limit_down', limit_down, valid & (down_px > 0) & (price <= down_px + 1e-6)),
+            ('stop_loss', stop_loss, valid & (cost > 0) & (price <= cost * (1 - (stop_loss or 0)))),
+            ('trailing_stop', trailing_stop, valid & (peak > 0) & (price <= peak * (1 - (trailing_stop or 0)))),
+        )
+    for name, enabled, hit in rules:
+        if enabled:
+            reasons[hit & (reasons == '')] = name
+    return reasons
+
+
+def _risk_state(context):
+    """当日风控状态：已触发的代码 -> 订单ID(未下单为None)、检查次数与各规则触发次数；跨日重置"""
+    today = context.current_dt.date()
+    state = getattr(g, 'risk_exits', None)
+    if not state or state['date'] != today:
+        state = g.risk_exits = {'date': today, 'codes': {}, 'ticks': 0, 'rules': {}}
+    return state
+
+
+def risk_monitor_worker(context):
+    """交易端run_interval任务：一次批量快照检查全部持仓，触发风控规则的股票立即卖出"""
+    now = context.current_dt.strftime('%H:%M')
+    if not context.risk_start_time <= now <= context.risk_end_time:
+        return
+    positions = context.portfolio.positions or {}
+    held = dict((code, pos) for code, pos in positions.items()
+                if (getattr(pos, 'amount', 0) or getattr(pos, 'total_amount', 0) or 0) > 0)
+    peaks = g.risk_peaks if isinstance(getattr(g, 'risk_peaks', None), dict) else {}
+    g.risk_peaks = dict((code, peak) for code, peak in peaks.items() if code in held)
+    state = _risk_state(context)
+    deferred = getattr(context, 'deferred_sells', None) or set()
+    codes = sorted(code for code in held if code not in state['codes'] and code not in deferred)
+    if not codes:
+        return
+    _trace_event(context, 'risk_monitor_worker')
+    state['ticks'] += 1
+    try:
+        snap = get_snapshot(codes) or {}
+    except Exception as e:
+        log.warning(f'盘中风控获取快照失败: {e}')
+        return
+    n = len(codes)
+    price, down_px = np.full(n, np.nan), np.full(n, np.nan)
+    halted = np.zeros(n, dtype=bool)
+    for i, code in enumerate(codes):
+        info = snap.get(code)
+        if not info:
+            continue
+        price[i] = _snapshot_price(info) or np.nan
+        down_px[i] = info.get('down_px') or np.nan
+        halted[i] = str(info.get('trade_status', '')).upper() in _RISK_HALT_STATUS
+    cost = np.array([getattr(held[code], 'cost_basis', None) or np.nan for code in codes], dtype=np.float64)
+    peak = np.array([g.risk_peaks.get(code, np.nan) for code in codes], dtype=np.float64)
+    # 持仓以来最高价从成本价起算，只随快照价格上移
+    peak = np.fmax(np.fmax(peak, cost), price)
+    g.risk_peaks.update((code, float(peak[i])) for i, code in enumerate(codes) if np.isfinite(peak[i]))
+    reasons = _risk_triggers(price, cost, peak, down_px, context.risk_stop_loss, context.risk_trailing_stop,
+                             context.risk_limit_down)
+    reasons[halted] = ''
+    triggered = np.flatnonzero(reasons != '')
+    if not len(triggered):
+        return
+    bought_today = _bought_today(context)
+    names = {'limit_down': '跌停', 'stop_loss': '止损', 'trailing_stop': '移动止损'}
+    for i in triggered:
+        code, reason = codes[i], reasons[i]
+        state['rules'][reason] = state['rules'].get(reason, 0) + 1
+        pos = held[code]
+        qty = getattr(pos, 'enable_amount', 0) or 0
+        detail = f'现价{price[i]:.2f}, 成本{cost[i]:.2f}, 最高{peak[i]:.2f}'
+        if qty <= 0 or code in bought_today:
+            state['codes'][code] = None
+            log.warning(f'盘中风控触发{names[reason]}但暂不能卖出: {code}({detail}, 可卖{qty}股)')
+            continue
+        limit = down_px[i] if reason == 'limit_down' else (
+            _depth_limit_price(snap.get(code), -1, qty, getattr(context, 'limit_max_levels', 3)) or price[i])
+        try:
+            order_id = order_target_value(code, 0, limit_price=float(limit))
+        except Exception as e:
+            log.warning(f'盘中风控卖出下单失败 {code}: {e}')
+            continue
+        state['codes'][code] = order_id
+        if order_id:
+            _register_order(context, order_id, code, side=-1, reference=price[i], limit=limit)
+            g.recent_orders.append(order_id)
+        log.warning(f'盘中风控触发{names[reason]}: {code}({detail}), 限价{float(limit):.2f}卖出{qty}股, 订单{order_id}')
+
+
+def adjust_position(context, target_position, phase='all', sold=None):
     """调整持仓到目标仓位
     
     基于API文档优化的版本：
@@ -1527,10 +4160,24 @@ def adjust_position(context, target_position):
     3. 添加订单状态检查
     4. 优化下单逻辑和日志记录
     5. 添加订单执行状态监控
+    
+    phase='all' 先卖后买；开启 context.two_phase_rebalance 时，卖单未全部结束则买入交给
+    pending_buy_worker，由其以 phase='buy' 再次调用：不撤单、不重复卖出，按卖单实际回笼后的现金计算买入；
+    sold 为第一段已提交的卖单ID，记入本次调仓记录，监控与绩效统计按完整的一次调仓计数。
     """
+    try:
+        _adjust_position(context, target_position, phase, sold or [])
+    finally:
+        # 价格缓存与盘口深度仅在本次调仓内有效，提前返回或异常时同样清空
+        context.price_cache = None
+        context.depth_cache = None
+
+
+def _adjust_position(context, target_position, phase, sold):
+    selling = phase != 'buy'
     
-    # 检查并取消未完成的订单，避免重复下单
-    open_orders = get_open_orders()
+    # 检查并取消未完成的订单，避免重复下单（买入阶段不能撤掉仍在成交中的卖单）
+    open_orders = get_open_orders() if selling else None
     if open_orders:
         log.info(f'发现{len(open_orders)}个未完成订单，先取消以避免冲突')
         for order_id, order_info in open_orders.items():
@@ -1556,78 +4203,36 @@ def adjust_position(context, target_position):
     if not hasattr(context, 'deferred_sells'):
         context.deferred_sells = set()
 
-    # 统一卖出前检查函数：可卖数量>0、非停牌、非当日买入
-    def can_sell_stock(stock):
-        try:
-            # 可卖数量检查
-            pos = get_position(stock)
-            enable_amt = getattr(pos, 'enable_amount', 0) if pos else 0
-            total_amt = getattr(pos, 'amount', 0) if pos else 0
-            if enable_amt <= 0:
-                return False, f'可卖数量为0(总持仓={total_amt})'
-
-            # 停牌检查
-            try:
-                halt_status = get_stock_status(stock, 'HALT')
-                if halt_status and halt_status.get(stock, False):
-                    return False, '停牌中'
-            except Exception:
-                pass
+    # 本次调仓涉及的全部代码一次性取价，后续估算、卖出、延迟卖出和买入都从缓存读取
+    involved = set(current_positions.keys() if current_positions else []) | set(target_position.keys()) | set(context.deferred_sells)
+    context.price_cache = _build_price_cache(context, involved)
+    context.depth_cache = _build_depth_cache(context, involved)
+    # 停牌、涨跌停与可卖数量同样一次性取齐，后续买卖判断只读快照
+    tradable = _build_tradability(current_positions, involved)
+    bought_today = _bought_today(context)
 
-            # 当日买入检查（T+1保护）
-            try:
-                trades = get_trades()
-                if trades:
-                    # 兼容多种返回结构
-                    for t in trades if isinstance(trades, list) else trades.values():
-                        sec = t.get('security') if isinstance(t, dict) else getattr(t, 'security', None)
-                        side = t.get('side') if isinstance(t, dict) else getattr(t, 'side', None)
-                        if sec == stock and str(side).upper() in ('BUY', 'B', 'BUY_OPEN'):
-                            return False, '当日有买入成交(T+1)'
-            except Exception:
-                pass
+    def tradability(stock):
+        entry = tradable.get(stock)
+        if entry is None:
+            entry = tradable[stock] = _build_tradability(current_positions, [stock]).get(stock)
+        return entry
 
-            return True, '可卖检查通过'
+    # 统一卖出前检查函数：可卖数量>0、非停牌、非跌停、非当日买入
+    def can_sell_stock(stock):
+        try:
+            reason = _sell_block_reason(stock, tradability(stock), bought_today)
+            return (False, reason) if reason else (True, '可卖检查通过')
         except Exception as e:
             return False, f'卖出前检查异常: {str(e)}'
 
+    # 获取保留股票集合（规范化代码）
+    keep_codes = getattr(context, 'rotation_keep_codes', set())
+    if keep_codes:
+        log.debug(f'本次调仓将保留以下股票不卖出: {keep_codes}')
+
     # 优先处理延迟卖出队列（若条件已满足则尝试清仓）
-    if context.deferred_sells:
-        processed = []
-        for stock in list(context.deferred_sells):
-            # 检查是否在保留集合中
-            normalized_stock = _normalize_local(stock)
-            if normalized_stock in keep_codes:
-                log.info(f'延迟卖出队列中的股票{stock}在保留集合中，移出队列')
-                processed.append(stock)
-                continue
-                
-            ok, reason = can_sell_stock(stock)
-            if ok:
-                try:
-                    # 获取开盘后5分钟的价格作为限价
-                    market_open_price = get_market_open_price(stock, context)
-                    if market_open_price:
-                        # 使用开盘后5分钟价格作为限价进行卖出
-                        order_id = order_target_value(stock, 0, limit_price=market_open_price)
-                        log.info(f'延迟卖出使用开盘后5分钟价格{market_open_price:.2f}元作为限价')
-                    else:
-                        # 如果无法获取开盘后5分钟价格，使用市价单
-                        order_id = order_target_value(stock, 0)
-                        log.warning(f'延迟卖出无法获取开盘后5分钟价格，使用市价单')
-                    
-                    if order_id:
-                        log.info(f'延迟卖出执行成功: {stock} (订单ID: {order_id})')
-                        processed.append(stock)
-                    else:
-                        log.warning(f'延迟卖出提交失败: {stock}')
-                except Exception as e:
-                    log.warning(f'延迟卖出执行异常: {stock}, {str(e)}')
-            else:
-                log.info(f'延迟卖出继续等待: {stock}，原因: {reason}')
-        for s in processed:
-            context.deferred_sells.discard(s)
-        log.debug(f'通过context.portfolio.positions获取到持仓数据: {len(current_positions)}只股票')
+    if selling and context.deferred_sells:
+        g.recent_orders.extend(_process_deferred_sells(context, keep_codes, tradability, bought_today))
     
     portfolio_value = context.portfolio.portfolio_value
     available_cash = context.portfolio.cash
@@ -1654,24 +4259,19 @@ def adjust_position(context, target_position):
     if len(target_position) == 0:
         log.warning('目标持仓为空，将清空所有持仓')
     
-    # 获取保留股票集合（规范化代码）
-    keep_codes = getattr(context, 'rotation_keep_codes', set())
-    if keep_codes:
-        log.debug(f'本次调仓将保留以下股票不卖出: {keep_codes}')
-    
     # 第一步：卖出不在目标池且不在保留集合的股票（基于API的可卖数量）
     stocks_to_sell = []
-    if current_positions:
+    if selling and current_positions:
         for stock in current_positions:
             # 规范化股票代码进行比较
             normalized_stock = _normalize_local(stock)
             
-            # 使用get_position()获取单个股票的详细持仓信息
+            # 从可交易性快照读取可卖数量与总持仓
             try:
-                position = get_position(stock)
-                if position:
-                    sellable_amount = getattr(position, 'enable_amount', 0)
-                    total_amount = getattr(position, 'amount', 0) or getattr(position, 'total_amount', 0)
+                entry = tradability(stock)
+                if entry:
+                    sellable_amount = entry['enable_amount']
+                    total_amount = entry['total_amount']
 
                     log.debug(f'股票{stock}({normalized_stock}): 总持仓={total_amount}, 可卖数量={sellable_amount}')
 
@@ -1718,8 +4318,8 @@ def adjust_position(context, target_position):
     try:
         for stock in stocks_to_sell:
             try:
-                pos = get_position(stock)
-                sellable_amount = getattr(pos, 'enable_amount', 0) if pos else 0
+                pos = current_positions.get(stock)
+                sellable_amount = tradability(stock)['enable_amount']
                 price = get_market_open_price(stock, context)
                 if not price and pos:
                     price = getattr(pos, 'last_sale_price', None)
@@ -1736,13 +4336,9 @@ def adjust_position(context, target_position):
     for stock in stocks_to_sell:
         try:
             # 检查股票是否停牌
-            try:
-                halt_status = get_stock_status(stock, 'HALT')
-                if halt_status and halt_status.get(stock, False):
-                    log.warning(f'股票{stock}已停牌，无法卖出')
-                    continue
-            except Exception as e:
-                log.warning(f'检查股票{stock}停牌状态失败: {str(e)}，继续执行')
+            if tradability(stock)['halted']:
+                log.warning(f'股票{stock}已停牌，无法卖出')
+                continue
             
             # 卖出前统一检查
             ok, reason = can_sell_stock(stock)
@@ -1752,24 +4348,50 @@ def adjust_position(context, target_position):
                 continue
 
             # 获取开盘后5分钟的价格作为限价
-            market_open_price = get_market_open_price(stock, context)
-            if market_open_price:
+            market_open_price = _order_limit_price(context, stock, -1, tradability(stock)['enable_amount'],
+                                                   get_market_open_price(stock, context))
+            # 分片执行：交给执行引擎拆成子单，返回母单ID
+            order_id = _submit_parent(context, stock, 0, tradability(stock)['total_amount'], market_open_price)
+            if order_id:
+                _log_event('order', 'info', '股票%s卖出交给分片执行: %s', stock, order_id)
+            elif market_open_price:
                 # 使用开盘后5分钟价格作为限价进行卖出
                 order_id = order_target_value(stock, 0, limit_price=market_open_price)
-                log.info(f'股票{stock}卖出使用开盘后5分钟价格{market_open_price:.2f}元作为限价')
+                _log_event('order', 'info', '股票%s卖出使用开盘后5分钟价格%.2f元作为限价', stock, market_open_price)
             else:
                 # 如果无法获取开盘后5分钟价格，使用市价单
                 order_id = order_target_value(stock, 0)
                 log.warning(f'股票{stock}卖出无法获取开盘后5分钟价格，使用市价单')
             
             if order_id:
+                _register_order(context, order_id, stock, -1, _reference_price(context, stock), market_open_price)
                 sell_orders.append(order_id)
-                log.info(f'已提交卖出订单: {stock} (订单ID: {order_id})')
+                _log_event('order', 'info', '已提交卖出订单: %s (订单ID: %s)', stock, order_id)
             else:
                 log.warning(f'卖出股票{stock}的订单提交失败')
         except Exception as e:
             log.error(f'卖出股票{stock}时发生错误: {str(e)}')
     
+    # 两段式调仓：卖单结束后按实际回笼现金计算买入，而不是只用卖出前的可用现金
+    if selling and sell_orders and target_position and getattr(context, 'two_phase_rebalance', False):
+        if _orders_settled(sell_orders):
+            available_cash = context.portfolio.cash
+            log.info(f'卖单已全部结束，按实际可用现金{available_cash:.0f}元计算买入')
+        elif 'is_trade' in globals() and is_trade():
+            deadline = context.current_dt + datetime.timedelta(minutes=getattr(context, 'buy_deadline_minutes', 10))
+            g.pending_buys = {'date': context.current_dt.date(), 'targets': dict(target_position),
+                              'sell_orders': list(sell_orders), 'deadline': deadline}
+            g.recent_orders.extend(sell_orders)
+            # 先记下卖出阶段，买入阶段执行后由完整记录覆盖；买入未执行时监控仍能看到本次卖单
+            if not hasattr(context, 'recent_orders'):
+                context.recent_orders = {}
+            context.recent_orders['last_adjustment'] = {
+                'timestamp': context.current_dt, 'sell_orders': list(sell_orders), 'sell_orders_adjust': [],
+                'buy_orders': [], 'target_stocks': len(target_position), 'successful': 0, 'failed': 0,
+                'scaling_factor': None, 'cash_utilization': None}
+            log.info(f'已提交{len(sell_orders)}笔卖单，买入等待卖单成交后执行，最迟{deadline.strftime("%H:%M:%S")}')
+            return
+    
     # 第二步：计算全局资金需求和动态调整目标仓位
     target_stocks = list(target_position.keys())
     log.info(f'开始分析{len(target_stocks)}只目标股票的资金需求')
@@ -1783,10 +4405,32 @@ def adjust_position(context, target_position):
     total_required_cash = 0
     total_released_cash = 0
     
+    # 全组合再平衡：目标市值按总资产计算，保留股票与新增股票一起按容忍带决定交易
+    full_book = getattr(context, 'rebalance_mode', 'rotation') == 'full_book'
+    book_plan = {}
+    if full_book and target_stocks:
+        held_values = {}
+        for stock in target_stocks:
+            position = current_positions.get(stock)
+            if position:
+                held_values[stock] = position.amount * position.last_sale_price
+        max_turnover = getattr(context, 'max_turnover', None)
+        # 清仓卖出(已不在目标中的持仓)必须执行，换手上限扣除这部分后再分配给目标股票的调整
+        turnover_budget = max(max_turnover * portfolio_value - estimated_release_cash, 0.0) if max_turnover else None
+        codes, book_targets, book_trades = _full_book_plan(
+            target_position, held_values, portfolio_value, getattr(context, 'rebalance_band', 0.02), turnover_budget)
+        book_plan = dict((c, (t, d)) for c, t, d in zip(codes, book_targets, book_trades))
+        log.info(f'全组合再平衡: 目标{len(codes)}只, 需交易{int(np.count_nonzero(book_trades))}只, '
+                 f'预计换手{(np.abs(book_trades).sum() + estimated_release_cash) / portfolio_value:.2%}')
+    
     for stock in target_stocks:
         try:
             target_weight = target_position[stock]
             target_value = buy_base_cash * target_weight
+            if full_book and stock in book_plan:
+                # 容忍带与换手上限已在向量化计划中处理，目标市值=当前市值+计划交易额
+                target_value = (current_positions[stock].amount * current_positions[stock].last_sale_price
+                                if current_positions.get(stock) else 0.0) + book_plan[stock][1]
             
             # 验证目标权重合理性
             if target_weight <= 0 or target_weight > 1:
@@ -1794,13 +4438,10 @@ def adjust_position(context, target_position):
                 continue
             
             # 检查股票是否停牌
-            try:
-                halt_status = get_stock_status(stock, 'HALT')
-                if halt_status and halt_status.get(stock, False):
-                    log.warning(f'股票{stock}已停牌，无法交易')
-                    continue
-            except Exception as e:
-                log.warning(f'检查股票{stock}停牌状态失败: {str(e)}，继续执行')
+            limit_state = tradability(stock)
+            if limit_state['halted']:
+                log.warning(f'股票{stock}已停牌，无法交易')
+                continue
             
             # 获取当前持仓信息
             current_position = current_positions.get(stock)
@@ -1826,9 +4467,12 @@ def adjust_position(context, target_position):
                 'action': 'hold'  # 默认持有
             }
             
-            # 设置调仓阈值：权重差异>1%或价值差异绝对值>1000元
-            if weight_diff > 0.01 or abs(value_diff) > 1000:
-                if value_diff > 0:  # 需要买入
+            # 设置调仓阈值：权重差异>1%或价值差异绝对值>1000元；全组合模式下计划交易额非0即交易
+            if (abs(value_diff) > 0) if full_book else (weight_diff > 0.01 or abs(value_diff) > 1000):
+                if value_diff > 0 and limit_state['limit'] == 1:
+                    # 涨停封板时买单难以成交，不占用资金
+                    log.warning(f'股票{stock}涨停中，本次不买入')
+                elif value_diff > 0:  # 需要买入
                     stock_analysis[stock]['action'] = 'buy'
                     total_required_cash += value_diff
                 elif value_diff < 0:  # 需要卖出
@@ -1862,6 +4506,28 @@ def adjust_position(context, target_position):
                 stock_analysis[stock]['target_value'] = stock_analysis[stock]['current_value'] + scaled_diff
                 stock_analysis[stock]['value_diff'] = scaled_diff
     
+    # 整手资金分配：先确定买入限价，再对全部买入统一求解整手股数
+    buy_prices, lot_plan = {}, None
+    if getattr(context, 'lot_allocation', False):
+        buy_targets = {}
+        for stock, analysis in stock_analysis.items():
+            if analysis['action'] != 'buy':
+                continue
+            price = get_market_open_price(stock, context)
+            if price:
+                buy_prices[stock] = _order_limit_price(context, stock, 1, analysis['value_diff'] / price, price)
+                buy_targets[stock] = analysis['value_diff']
+        if buy_targets:
+            # 资金上限为扣除缓冲后的可用现金，再减去分片执行中买入母单尚未成交的占用；
+            # 本次调整卖出的回笼资金尚未到账，不计入
+            committed = _committed_buy_cash()
+            lot_cash = max(usable_cash - committed, 0.0)
+            lot_plan = _allocate_lots(buy_prices, buy_targets, lot_cash,
+                                      getattr(context, 'commission_ratio', 0.0002), getattr(context, 'min_commission', 5.0))
+            planned = sum(lot_plan.get(s, 0) * buy_prices[s] for s in buy_targets)
+            log.info(f'整手资金分配: 目标{sum(buy_targets.values()):.0f}元, 可用{lot_cash:.0f}元(已占用{committed:.0f}元), '
+                     f'计划买入{planned:.0f}元, 股数{lot_plan}')
+    
     # 第三步：执行调仓操作
     buy_orders = []
     sell_orders_adjust = []  # 调整阶段的卖出订单
@@ -1879,15 +4545,14 @@ def adjust_position(context, target_position):
                 current_value = analysis['current_value']
                 value_diff = analysis['value_diff']
                 
-                log.debug(f'{"卖出" if action_type == "sell" else "买入"}股票{stock}: '
-                        f'当前权重{analysis["current_weight"]:.2%}({current_value:.0f}元) -> '
-                        f'目标权重{analysis["target_weight"]:.2%}({target_value:.0f}元)')
+                _log_event('order', 'debug', '%s股票%s: 当前权重%.2f%%(%.0f元) -> 目标权重%.2f%%(%.0f元)',
+                           '卖出' if action_type == 'sell' else '买入', stock, analysis['current_weight'] * 100,
+                           current_value, analysis['target_weight'] * 100, target_value)
                 
                 # 卖出前检查可卖数量，避免无效委托
                 if action_type == 'sell':
                     try:
-                        pos = get_position(stock)
-                        if pos and getattr(pos, 'enable_amount', 0) == 0:
+                        if current_positions.get(stock) and tradability(stock)['enable_amount'] == 0:
                             log.warning(f'股票{stock}可卖数量为0，跳过卖出调仓')
                             failed_adjustments += 1
                             continue
@@ -1903,26 +4568,49 @@ def adjust_position(context, target_position):
                         failed_adjustments += 1
                         continue
                 
-                # 获取开盘后5分钟的价格作为限价
-                market_open_price = get_market_open_price(stock, context)
-                if market_open_price:
+                # 获取开盘后5分钟的价格作为限价，有盘口深度时按本单数量在对手盘中定价
+                if stock in buy_prices:
+                    market_open_price = buy_prices[stock]
+                else:
+                    market_open_price = get_market_open_price(stock, context)
+                    if market_open_price:
+                        market_open_price = _order_limit_price(context, stock, 1 if action_type == 'buy' else -1,
+                                                               abs(value_diff) / market_open_price, market_open_price)
+                shares = lot_plan.get(stock, 0) if lot_plan is not None and stock in buy_prices else None
+                if shares == 0:
+                    log.warning(f'股票{stock}整手分配为0股(资金不足一手)，跳过买入')
+                    failed_adjustments += 1
+                    continue
+                held = current_positions.get(stock)
+                order_id = _submit_parent(context, stock, target_value,
+                                          (getattr(held, 'amount', 0) or getattr(held, 'total_amount', 0)) if held else 0,
+                                          market_open_price, delta_amount=shares)
+                if order_id:
+                    _log_event('order', 'debug', '股票%s交给分片执行: %s', stock, order_id)
+                elif shares:
+                    # 按整手分配的股数限价买入
+                    order_id = order(stock, shares, limit_price=market_open_price)
+                    _log_event('order', 'debug', '股票%s按整手分配买入%d股，限价%.2f元', stock, shares, market_open_price)
+                elif market_open_price:
                     # 使用开盘后5分钟价格作为限价进行交易
                     order_id = order_target_value(stock, target_value, limit_price=market_open_price)
-                    log.debug(f'股票{stock}使用开盘后5分钟价格{market_open_price:.2f}元作为限价')
+                    _log_event('order', 'debug', '股票%s使用开盘后5分钟价格%.2f元作为限价', stock, market_open_price)
                 else:
                     # 如果无法获取开盘后5分钟价格，使用市价单
                     order_id = order_target_value(stock, target_value)
                     log.warning(f'股票{stock}无法获取开盘后5分钟价格，使用市价单')
                 
-                log.debug(f'股票{stock}当前价值: {current_value:.2f}元')
+                _log_event('order', 'debug', '股票%s当前价值: %.2f元', stock, current_value)
                 if order_id:
+                    _register_order(context, order_id, stock, 1 if action_type == 'buy' else -1,
+                                    _reference_price(context, stock), market_open_price)
                     if action_type == 'sell':
                         sell_orders_adjust.append(order_id)
                     else:
                         buy_orders.append(order_id)
                     successful_adjustments += 1
-                    log.info(f'已提交{"卖出" if action_type == "sell" else "买入"}订单: {stock} '
-                            f'目标价值{target_value:.0f}元 (订单ID: {order_id})')
+                    _log_event('order', 'info', '已提交%s订单: %s 目标价值%.0f元 (订单ID: %s)',
+                               '卖出' if action_type == 'sell' else '买入', stock, target_value, order_id)
                 else:
                     failed_adjustments += 1
                     log.warning(f'股票{stock}的{"卖出" if action_type == "sell" else "买入"}订单提交失败')
@@ -1973,9 +4661,10 @@ def adjust_position(context, target_position):
     if not hasattr(context, 'recent_orders'):
         context.recent_orders = {}
     
+    # 两段式买入阶段本身不卖出，第一段的卖单一并记入；订单ID已在第一段加入 g.recent_orders
     context.recent_orders['last_adjustment'] = {
         'timestamp': context.current_dt,
-        'sell_orders': sell_orders,
+        'sell_orders': list(sold) + sell_orders,
         'sell_orders_adjust': sell_orders_adjust,
         'buy_orders': buy_orders,
         'target_stocks': len(target_position),
@@ -1985,81 +4674,308 @@ def adjust_position(context, target_position):
         'cash_utilization': cash_utilization
     }
     
+    # 价格缓存与盘口深度仅在本次调仓内有效
+    context.price_cache = None
+    context.depth_cache = None
     log.info('adjust_position函数执行完成')
     
     # 调用订单状态检查
     check_order_status(context)
 
 
+def _reconcile_order(entry):
+    """轮询兜底：用get_order校正订单簿中的单个订单"""
+    order_info = get_order(entry['id'])
+    # 如果返回的是列表，取第一个元素
+    if isinstance(order_info, list):
+        order_info = order_info[0] if order_info else None
+    if order_info is None:
+        entry['misses'] += 1
+        entry['updated'] = time.time()
+        return
+    entry['misses'] = 0
+    if not entry['security']:
+        entry['security'] = _trade_field(order_info, 'symbol', 'security', 'stock_code')
+    # 委托查询中的价格是委托限价而不是成交价，成交均价只由成交主推或盘后的get_trades补全
+    _apply_order_status(entry, _trade_field(order_info, 'status'),
+                        _trade_field(order_info, 'filled', 'business_amount'), _trade_field(order_info, 'amount'))
+
+
+def _refresh_order(entry, trade_mode, now):
+    """订单簿中的未完成订单：回测中没有主推直接轮询，交易端超过对账间隔未更新才轮询"""
+    if entry['state'] in _ORDER_FINAL_STATES:
+        return False
+    if trade_mode and now - entry['updated'] < _ORDER_RECONCILE_SECONDS:
+        return False
+    try:
+        _reconcile_order(entry)
+    except Exception as e:
+        log.warning(f'检查订单 {entry["id"]} 状态时出错: {str(e)}')
+        entry['misses'] += 1
+    return True
+
+
+def _orders_settled(order_ids):
+    """给定订单是否都已结束(全成、撤单或废单)；查不到的订单按已结束处理"""
+    trade_mode = 'is_trade' in globals() and is_trade()
+    now = time.time()
+    parents = getattr(g, 'exec_parents', None) or {}
+    for order_id in order_ids:
+        if order_id in parents:
+            if parents[order_id]['state'] == 'working':
+                return False
+            continue
+        entry = _order_entry(order_id)
+        _refresh_order(entry, trade_mode, now)
+        if entry['state'] not in _ORDER_FINAL_STATES and entry['misses'] < _ORDER_MISS_LIMIT:
+            return False
+    return True
+
+
+def pending_buy_worker(context):
+    """
+    交易端run_interval任务：两段式调仓中等待卖单成交，卖单全部结束或到达截止时间后，
+    按当时的实际可用现金执行买入阶段；截止时仍未成交的卖单保留，买入按已回笼的现金计算。
+    """
+    plan = getattr(g, 'pending_buys', None)
+    if not plan:
+        return
+    _trace_event(context, 'pending_buy_worker')
+    if plan['date'] != context.current_dt.date():
+        log.warning(f'丢弃过期的待买入计划: {plan["date"]} {list(plan["targets"].keys())}')
+        g.pending_buys = None
+        return
+    settled = _orders_settled(plan['sell_orders'])
+    if not settled and context.current_dt < plan['deadline']:
+        return
+    # 先清除计划再下单，避免并发的下一次轮询重复买入
+    g.pending_buys = None
+    if settled:
+        log.info('卖单已全部结束，执行买入阶段')
+    else:
+        log.warning(f'到达买入截止时间{plan["deadline"]}，卖单未全部成交，按当前可用现金执行买入')
+    try:
+        adjust_position(context, plan['targets'], phase='buy', sold=plan['sell_orders'])
+    except Exception as e:
+        log.error(f'两段式买入阶段执行异常: {e}')
+
+
+def _slicing_active(context):
+    """分片执行只在交易端可用(依赖run_interval)，回测中始终直接下单"""
+    if getattr(context, 'execution_mode', 'direct') not in ('twap', 'pov'):
+        return False
+    return 'is_trade' in globals() and is_trade()
+
+
+def _submit_parent(context, stock, target_value, current_amount, ref_price, delta_amount=None):
+    """
+    把一笔目标市值调仓登记为分片执行母单，返回母单ID；未开启分片或无法计算数量时返回None，调用方按原方式直接下单。
+    母单数量按参考价折算为整手目标股数与当前持仓之差；已由整手分配确定股数时直接传入delta_amount。
+    """
+    if not _slicing_active(context) or not ref_price:
+        return None
+    if delta_amount is not None:
+        delta = int(delta_amount)
+    else:
+        target_amount = int(target_value / ref_price // 100 * 100) if target_value > 0 else 0
+        delta = target_amount - int(current_amount or 0)
+    if delta == 0:
+        return None
+    parents = getattr(g, 'exec_parents', None)
+    if parents is None:
+        parents = g.exec_parents = {}
+    now = context.current_dt
+    window = datetime.timedelta(minutes=getattr(context, 'execution_window_minutes', 30))
+    g.exec_seq = getattr(g, 'exec_seq', 0) + 1
+    parent_id = 'P%s-%d' % (now.strftime('%Y%m%d'), g.exec_seq)
+    parents[parent_id] = {
+        'id': parent_id, 'security': stock, 'side': 1 if delta > 0 else -1, 'total': abs(delta),
+        'done': 0, 'filled': 0, 'child': None, 'child_sent': None, 'children': [],
+        'start': now, 'end': now + window, 'next_slice': now, 'state': 'working',
+        'reference': _reference_price(context, stock) or ref_price,
+    }
+    log.info(f'分片执行母单{parent_id}: {stock} {"买入" if delta > 0 else "卖出"}{abs(delta)}股, '
+             f'{getattr(context, "execution_mode", "twap")}至{(now + window).strftime("%H:%M")}')
+    return parent_id
+
+
+def _child_limit_price(info, side, qty):
+    """子单限价：按子单数量在对手盘中定价(最多穿越1档)，无盘口时用最新价"""
+    px = _depth_limit_price(info, side, qty, max_levels=1)
+    if px:
+        return px
+    px = _snapshot_price(info) if info is not None else None
+    return float(px) if px is not None and np.isfinite(px) and px > 0 else None
+
+
+def _recent_slice_volume(codes, slice_seconds):
+    """按最近一根5分钟K线成交量折算每个分片时长内的市场成交量(股)"""
+    volumes = {}
+    try:
+        bars = get_history(1, '5m', ['volume'], security_list=list(codes), include=True)
+        for code, (vol, _) in _last_by_code(bars, 'volume').items():
+            volumes[code] = vol * slice_seconds / 300.0
+    except Exception as e:
+        log.warning(f'获取分片成交量失败，本轮不做参与率限制: {e}')
+    return volumes
+
+
+def _slice_quantity(context, parent, now, remaining, market_volume):
+    """本轮子单数量：TWAP按时间进度追赶计划量，POV按参与率跟随成交量；两者都受参与率上限约束"""
+    slice_seconds = getattr(context, 'execution_slice_seconds', 60)
+    participation = getattr(context, 'execution_participation', 0.1)
+    cap = participation * market_volume if market_volume is not None else None
+    if getattr(context, 'execution_mode', 'twap') == 'pov':
+        qty = cap if cap is not None else remaining
+    else:
+        span = max((parent['end'] - parent['start']).total_seconds(), 1.0)
+        progress = min(((now - parent['start']).total_seconds() + slice_seconds) / span, 1.0)
+        qty = int(np.ceil(parent['total'] * progress)) - (parent['total'] - remaining)
+        if cap is not None:
+            qty = min(qty, cap)
+    qty = min(int(qty // 100 * 100), remaining)
+    # 卖出零股只能一次性卖出
+    if parent['side'] < 0 and remaining < 100:
+        qty = remaining
+    return max(qty, 0)
+
+
+def _advance_parent(context, parent, now, info, market_volume):
+    """推进单个母单：结算已结束的子单、撤掉超时未成交的子单、按计划提交下一笔子单"""
+    child = parent['child']
+    if child is not None:
+        entry = _order_entry(child)
+        _refresh_order(entry, True, time.time())
+        parent['filled'] = parent['done'] + entry['filled']
+        if entry['state'] in _ORDER_FINAL_STATES or entry['misses'] >= _ORDER_MISS_LIMIT:
+            parent['done'] += entry['filled']
+            parent['child'] = None
+        elif (now - parent['child_sent']).total_seconds() >= getattr(context, 'execution_slice_seconds', 60):
+            # 子单超过一个分片时长仍未成交，撤单后下一轮按最新对手价重新报价
+            try:
+                cancel_order(child)
+            except Exception as e:
+                log.warning(f'撤销子单{child}失败: {e}')
+            return
+        else:
+            return
+
+    remaining = parent['total'] - parent['done']
+    if remaining <= 0 or (parent['side'] > 0 and remaining < 100):
+        parent['state'] = 'done'
+        log.info(f'分片母单{parent["id"]}完成: {parent["security"]} 成交{parent["done"]}/{parent["total"]}股, '
+                 f'子单{len(parent["children"])}笔')
+        return
+    if now >= parent['end']:
+        parent['state'] = 'expired'
+        log.warning(f'分片母单{parent["id"]}到期未完成: {parent["security"]} 成交{parent["done"]}/{parent["total"]}股')
+        return
+    if now < parent['next_slice'] or info is None:
+        return
+    qty = _slice_quantity(context, parent, now, remaining, market_volume)
+    quote = _child_limit_price(info, parent['side'], qty) if qty > 0 else None
+    if quote is None:
+        return
+    try:
+        order_id = order(parent['security'], qty * parent['side'], limit_price=quote)
+    except Exception as e:
+        log.warning(f'分片子单提交异常 {parent["security"]}: {e}')
+        order_id = None
+    parent['next_slice'] = now + datetime.timedelta(seconds=getattr(context, 'execution_slice_seconds', 60))
+    if order_id:
+        _register_order(context, order_id, parent['security'], parent['side'], parent.get('reference'), quote)
+        parent['child'] = order_id
+        parent['child_sent'] = now
+        parent['children'].append(order_id)
+        log.debug(f'分片子单{order_id}: {parent["security"]} {qty * parent["side"]}股 限价{quote:.2f}')
+
+
+def execution_worker(context):
+    """
+    交易端run_interval任务：推进所有执行中的分片母单。
+    每轮一次批量快照取对手价、一次5分钟K线取成交量，供全部母单共用。
+    """
+    parents = getattr(g, 'exec_parents', None)
+    if not parents:
+        return
+    today = context.current_dt.date()
+    for parent_id in [pid for pid, p in parents.items() if p['start'].date() != today]:
+        parents.pop(parent_id, None)
+    working = [p for p in parents.values() if p['state'] == 'working']
+    if not working:
+        return
+    _trace_event(context, 'execution_worker')
+    now = context.current_dt
+    codes = sorted(set(p['security'] for p in working))
+    try:
+        snap = get_snapshot(codes) or {}
+    except Exception as e:
+        log.warning(f'分片执行获取快照失败: {e}')
+        snap = {}
+    volumes = _recent_slice_volume(codes, getattr(context, 'execution_slice_seconds', 60))
+    for parent in working:
+        try:
+            _advance_parent(context, parent, now, snap.get(parent['security']), volumes.get(parent['security']))
+        except Exception as e:
+            log.warning(f'推进分片母单{parent["id"]}异常: {e}')
+
+
 def check_order_status(context):
-    """检查最近订单的执行状态"""
+    """
+    汇总最近订单的执行状态。
+    状态以订单簿为准(由on_order_response/on_trade_response实时维护)；回测中没有主推，
+    交易端订单超过 _ORDER_RECONCILE_SECONDS 未更新时，才调用get_order轮询对账。
+    """
     if not hasattr(g, 'recent_orders') or not g.recent_orders:
         return
     
     try:
-        # 获取所有订单状态
-        completed_orders = 0
-        failed_orders = 0
-        pending_orders = 0
-        
+        trade_mode = 'is_trade' in globals() and is_trade()
+        now = time.time()
+        counts = {'filled': 0, 'failed': 0, 'pending': 0}
         # 创建一个新的列表来存储仍在处理中的订单
         remaining_orders = []
+        polled = 0
         
-        for order_id in g.recent_orders:
-            try:
-                order_info = get_order(order_id)
-                
-                # 处理不同的返回格式
-                if order_info is None:
-                    # 订单不存在或已过期，视为已完成
-                    completed_orders += 1
-                    continue
-                
-                # 如果返回的是列表，取第一个元素
-                if isinstance(order_info, list):
-                    if len(order_info) > 0:
-                        order_info = order_info[0]
-                    else:
-                        completed_orders += 1
-                        continue
-                
-                # 获取订单状态
-                if hasattr(order_info, 'status'):
-                    status = order_info.status
-                elif isinstance(order_info, dict):
-                    status = order_info.get('status', '8')  # 默认为已成交
-                else:
-                    # 无法确定状态，假设已完成
-                    completed_orders += 1
-                    continue
-                
-                # 根据API文档中的状态码判断订单状态
-                if status in ['8']:  # 已成交
-                    completed_orders += 1
-                elif status in ['6', '9', '5']:  # 已撤、废单、部撤
-                    failed_orders += 1
-                else:  # 其他状态视为待处理
-                    pending_orders += 1
+        parents = getattr(g, 'exec_parents', None) or {}
+        for order_id in list(g.recent_orders):
+            if order_id in parents:
+                # 分片母单由执行引擎跟踪，子单状态已在订单簿中
+                parent = parents[order_id]
+                if parent['state'] == 'working':
+                    counts['pending'] += 1
                     remaining_orders.append(order_id)
-                    
-            except Exception as e:
-                log.warning(f'检查订单 {order_id} 状态时出错: {str(e)}')
-                # 出错的订单保留在列表中，下次再检查
-                remaining_orders.append(order_id)
+                elif parent['filled'] > 0:
+                    counts['filled'] += 1
+                else:
+                    counts['failed'] += 1
                 continue
+            entry = _order_entry(order_id)
+            if _refresh_order(entry, trade_mode, now):
+                polled += 1
+            
+            if entry['state'] == 'filled':
+                counts['filled'] += 1
+            elif entry['state'] in ('cancelled', 'rejected'):
+                counts['failed'] += 1
+            elif entry['misses'] >= _ORDER_MISS_LIMIT:
+                log.warning(f'订单 {order_id} 多次查询不到，停止跟踪')
+            else:
+                counts['pending'] += 1
+                remaining_orders.append(order_id)
         
         # 更新订单列表，只保留未完成的订单
         g.recent_orders = remaining_orders
         
         # 记录状态信息
-        total_orders = completed_orders + failed_orders + pending_orders
-        if total_orders > 0:
-            if pending_orders == 0:
-                log.info(f'所有订单已处理完成: 成功{completed_orders}个，失败{failed_orders}个')
+        if sum(counts.values()) > 0:
+            if counts['pending'] == 0:
+                log.info(f'所有订单已处理完成: 成功{counts["filled"]}个，失败{counts["failed"]}个')
             else:
-                log.info(f'订单状态: 已完成{completed_orders}个，失败{failed_orders}个，待处理{pending_orders}个')
+                log.info(f'订单状态: 已完成{counts["filled"]}个，失败{counts["failed"]}个，'
+                         f'待处理{counts["pending"]}个(本次轮询对账{polled}个)')
             
     except Exception as e:
         log.warning(f'检查订单状态时发生错误: {str(e)}')
 
-    return
\ No newline at end of file
+    return
@@ -0,0 +1,307 @@
+# coding=utf-8
+"""
+小市值策略接口轨迹离线回放
+
+读取策略开启 context.api_trace_enabled 后在交易端/平台回测中录制的轨迹文件
+(研究目录下 small_cap_trace/trace_YYYYMMDD.pkl.gz)，把录制的接口返回值喂回未经修改的策略：
+1. 离线精确复现某一天(例如耗时异常的周五)的运行过程
+2. 配合 --profile 用 cProfile 采集热点
+3. 比对回放产生的委托与录制时的委托是否完全一致，用于确认优化没有改变下单结果
+
+轨迹记录格式(逐条pickle写入gzip流):
+    ('event', 回调名, current_dt, 组合快照, context状态, g状态, 主推数据, 模块缓存)
+    ('call', 接口名, args, kwargs, 返回值, 异常repr或None, 调用期间到达的主推)
+每个 event 之后、下一个 event 之前的 call 属于该次回调；委托/成交主推和盘后处理各自是独立的事件，
+主推数据为 on_order_response/on_trade_response 收到的委托/成交列表，其余回调为 None。
+下单等接口调用期间同步到达的主推不另起事件，以 [(回调名, 主推数据), ...] 记在该次调用上，回放时在接口返回前送回策略。
+模块缓存为跨交易日累积的模块级缓存(交易日历、股票池、除权因子等)，每个轨迹文件的首个事件和缓存变化后的事件才有，
+回放开始时按所选第一个事件之前最近的一份恢复。
+
+用法:
+    python 小市值策略_回放.py trace_20240105.pkl.gz
+    python 小市值策略_回放.py trace_20240105.pkl.gz --event 1 --profile friday.pstats
+"""
+import argparse
+import cProfile
+import gzip
+import importlib.util
+import logging
+import os
+import pickle
+import sys
+import time
+import types
+from collections import defaultdict, deque
+
+STRATEGY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '小市值策略.py')
+# 产生委托的接口，回放时只比对、不执行
+ORDER_API_NAMES = ('order', 'order_value', 'order_target', 'order_target_value')
+# run_daily/run_interval 注册的定时任务，只接收 context 一个参数
+SCHEDULED_FUNCS = ('trade_rotation', 'pending_buy_worker', 'execution_worker', 'deferred_sell_worker',
+                   'risk_monitor_worker')
+# 委托/成交主推回调，以录制的主推数据作为第二个参数
+PUSH_CALLBACKS = ('on_order_response', 'on_trade_response')
+# 回放中不需要录制结果、直接忽略的设置类接口
+NOOP_API_NAMES = ('set_benchmark', 'set_commission', 'set_slippage', 'set_fixed_slippage',
+                  'set_volume_ratio', 'set_universe', 'run_daily', 'run_interval', 'create_dir')
+
+log = logging.getLogger('small_cap.replay')
+
+
+class ReplayMiss(Exception):
+    """回放时找不到对应的录制调用"""
+
+
+def read_trace(path):
+    """读取轨迹文件；进程异常退出导致的末尾截断会被忽略"""
+    records = []
+    with gzip.open(path, 'rb') as f:
+        while True:
+            try:
+                records.append(pickle.load(f))
+            except EOFError:
+                break
+            except Exception as e:
+                log.warning('轨迹文件末尾不完整，已读取 %d 条: %s', len(records), e)
+                break
+    return records
+
+
+def split_segments(records):
+    """按回调事件切分轨迹，返回 [(event记录, [call记录, ...]), ...]"""
+    segments = []
+    for rec in records:
+        if rec[0] == 'event':
+            segments.append((rec, []))
+        elif segments:
+            segments[-1][1].append(rec)
+    return segments
+
+
+def _call_key(name, args, kwargs):
+    return '%s%r%r' % (name, tuple(args), sorted(kwargs.items()))
+
+
+class _Segment(object):
+    """单次回调内的录制调用：优先按 (接口, 参数) 精确匹配，其次按接口名顺序匹配"""
+
+    def __init__(self, calls):
+        self.by_key = defaultdict(deque)
+        self.by_name = defaultdict(deque)
+        self.orders = []
+        for rec in calls:
+            name, args, kwargs, result, error = rec[1:6]
+            entry = {'name': name, 'key': _call_key(name, args, kwargs), 'result': result,
+                     'error': error, 'pushes': rec[6] if len(rec) > 6 else [], 'used': False}
+            self.by_key[entry['key']].append(entry)
+            self.by_name[name].append(entry)
+            if name in ORDER_API_NAMES:
+                self.orders.append(entry['key'])
+
+    def take(self, name, args, kwargs):
+        queue = self.by_key.get(_call_key(name, args, kwargs))
+        while queue:
+            entry = queue.popleft()
+            if not entry['used']:
+                entry['used'] = True
+                return entry, True
+        queue = self.by_name.get(name)
+        while queue:
+            entry = queue.popleft()
+            if not entry['used']:
+                entry['used'] = True
+                return entry, False
+        return None, False
+
+    def unused(self):
+        return [e for q in self.by_name.values() for e in q if not e['used']]
+
+
+class ReplayPlatform(object):
+    """把录制的返回值注入策略模块命名空间"""
+
+    def __init__(self, api_names, research_path=None):
+        self.api_names = set(api_names)
+        self.segment = None
+        self.module = None
+        self.context = None
+        self.orders = []
+        self.misses = []
+        self.fuzzy = 0
+        self.served = 0
+        self.research_path = research_path or os.path.join(os.getcwd(), 'research')
+        self.g = types.SimpleNamespace()
+        self.log = logging.getLogger('small_cap.strategy')
+
+    def bind(self, module):
+        for name in self.api_names:
+            setattr(module, name, self._stub(name))
+        for name in NOOP_API_NAMES:
+            setattr(module, name, lambda *args, **kwargs: None)
+        module.get_research_path = lambda: self.research_path
+        module.g = self.g
+        module.log = self.log
+
+    def bind_traced(self, module):
+        """策略录制的全部接口都替换为回放桩，轨迹中没有出现的接口调用记为未命中而不是NameError"""
+        self.module = module
+        for name in getattr(module, '_TRACE_API_NAMES', ()):
+            if name not in self.api_names:
+                self.api_names.add(name)
+                setattr(module, name, self._stub(name))
+
+    def _stub(self, name):
+        def stub(*args, **kwargs):
+            return self.call(name, args, kwargs)
+        return stub
+
+    def call(self, name, args, kwargs):
+        key = _call_key(name, args, kwargs)
+        if name in ORDER_API_NAMES:
+            self.orders.append(key)
+        entry, exact = self.segment.take(name, args, kwargs) if self.segment else (None, False)
+        if entry is None:
+            self.misses.append(key)
+            if name in ORDER_API_NAMES:
+                return 'replay-%d' % len(self.orders)
+            raise ReplayMiss('录制中没有对应调用: %s' % key[:200])
+        self.served += 1
+        if not exact:
+            self.fuzzy += 1
+        for callback, payload in entry['pushes']:
+            getattr(self.module, callback)(self.context, payload or [])
+        if entry['error'] is not None:
+            raise RuntimeError('录制时调用异常: %s' % entry['error'])
+        return entry['result']
+
+
+def _portfolio(snapshot):
+    return types.SimpleNamespace(
+        cash=snapshot['cash'],
+        portfolio_value=snapshot['portfolio_value'],
+        positions_value=snapshot['portfolio_value'] - snapshot['cash'],
+        positions=snapshot['positions'],
+    )
+
+
+def load_strategy(platform, path=STRATEGY_FILE):
+    spec = importlib.util.spec_from_file_location('small_cap_strategy_replay', path)
+    module = importlib.util.module_from_spec(spec)
+    platform.bind(module)
+    spec.loader.exec_module(module)
+    platform.bind_traced(module)
+    return module
+
+
+def restore_caches(module, segments, index):
+    """把第 index 个事件之前(含)最近一次录制的模块缓存恢复到策略模块"""
+    for event, _ in reversed(segments[:index + 1]):
+        caches = event[7] if len(event) > 7 else None
+        if caches:
+            for name, cache in caches.items():
+                target = getattr(module, name)
+                target.clear()
+                target.update(cache)
+            return True
+    return False
+
+
+def replay(trace_path, strategy_path=STRATEGY_FILE, events=None, profile_path=None):
+    """
+    回放轨迹；events 为需要回放的事件序号列表(从0开始)，默认全部。
+    策略状态在第一个回放事件处按录制快照恢复，之后由回放过程自然演进。
+    """
+    segments = split_segments(read_trace(trace_path))
+    if not segments:
+        raise ValueError('轨迹中没有回调事件: %s' % trace_path)
+    api_names = set(rec[1] for _, calls in segments for rec in calls)
+    platform = ReplayPlatform(api_names)
+    module = load_strategy(platform, strategy_path)
+    context = types.SimpleNamespace(blotter=types.SimpleNamespace())
+    platform.context = context
+
+    selected = range(len(segments)) if events is None else sorted(events)
+    profiler = cProfile.Profile() if profile_path else None
+    report = {'events': [], 'orders_recorded': [], 'orders_replayed': []}
+    restored = False
+    for k in selected:
+        event, calls = segments[k]
+        _, name, current_dt, snapshot, context_state, g_state = event[:6]
+        # 旧版轨迹的事件记录没有主推数据
+        payload = event[6] if len(event) > 6 else None
+        if not restored:
+            context.__dict__.update(context_state)
+            platform.g.__dict__.update(g_state)
+            restore_caches(module, segments, k)
+            restored = True
+        # 回放时不再录制
+        context.api_trace_enabled = False
+        context.current_dt = current_dt
+        context.blotter.current_dt = current_dt
+        context.portfolio = _portfolio(snapshot)
+        segment = _Segment(calls)
+        platform.segment = segment
+        orders_before = len(platform.orders)
+        func = getattr(module, name)
+        t0 = time.time()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            if name in SCHEDULED_FUNCS:
+                func(context)
+            elif name in PUSH_CALLBACKS:
+                func(context, payload or [])
+            else:
+                func(context, {})
+        finally:
+            if profiler is not None:
+                profiler.disable()
+        elapsed = time.time() - t0
+        report['orders_recorded'].extend(segment.orders)
+        report['orders_replayed'].extend(platform.orders[orders_before:])
+        report['events'].append({'index': k, 'name': name, 'dt': current_dt, 'elapsed': elapsed,
+                                 'calls_recorded': len(calls), 'unused': len(segment.unused())})
+    report['misses'] = platform.misses
+    report['fuzzy'] = platform.fuzzy
+    report['served'] = platform.served
+    report['orders_identical'] = report['orders_recorded'] == report['orders_replayed']
+    if profiler is not None:
+        profiler.dump_stats(profile_path)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='小市值策略接口轨迹离线回放')
+    parser.add_argument('trace', help='轨迹文件 trace_YYYYMMDD.pkl.gz')
+    parser.add_argument('--strategy', default=STRATEGY_FILE, help='被回放的策略文件，默认当前版本')
+    parser.add_argument('--event', type=int, action='append', help='只回放指定序号的事件，可重复')
+    parser.add_argument('--profile', help='输出cProfile统计文件(pstats格式)')
+    parser.add_argument('--verbose', action='store_true', help='输出策略日志')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    logging.getLogger('small_cap.strategy').setLevel(logging.INFO if args.verbose else logging.ERROR)
+
+    report = replay(args.trace, args.strategy, events=args.event, profile_path=args.profile)
+    for ev in report['events']:
+        log.info('事件#%d %s %s: 耗时 %.3fs, 录制调用 %d, 未使用 %d',
+                 ev['index'], ev['name'], ev['dt'], ev['elapsed'], ev['calls_recorded'], ev['unused'])
+    log.info('命中录制调用 %d 次(其中按接口名顺序匹配 %d 次)，未命中 %d 次',
+             report['served'], report['fuzzy'], len(report['misses']))
+    for key in report['misses'][:20]:
+        log.info('  未命中: %s', key[:200])
+    if report['orders_identical']:
+        log.info('委托一致: 共 %d 笔', len(report['orders_replayed']))
+        return 0
+    recorded, replayed = report['orders_recorded'], report['orders_replayed']
+    log.warning('委托不一致: 录制 %d 笔, 回放 %d 笔', len(recorded), len(replayed))
+    for key in recorded:
+        if key not in replayed:
+            log.warning('  仅录制中存在: %s', key)
+    for key in replayed:
+        if key not in recorded:
+            log.warning('  仅回放中存在: %s', key)
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
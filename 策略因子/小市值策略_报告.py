@@ -0,0 +1,223 @@
+# coding=utf-8
+"""
+小市值策略运行指标周报
+
+读取策略开启 context.metrics_enabled(默认关闭；在 initialize 中设为True，或离线回测加 --metrics)
+后写入研究目录的 small_cap_metrics/metrics.db(SQLite)，
+按周汇总每次调仓的记录，用于发现运行耗时或执行质量的退化，而不必翻日志：
+1. 周度趋势：调仓次数、选股/调仓耗时、接口调用次数、委托与成交率、资金缩放比例与利用率、下单延迟
+2. 漏斗各阶段的平均耗时与剩余股票数
+3. 最近一周与此前若干周中位数对比，超过阈值的指标标记为退化
+4. 执行质量(executions 表)：相对09:35参考价的执行偏差、机会成本与实施偏差，成交率和成交用时，
+   按周、买卖方向、价格档和市值档汇总，用于调整调仓时点和限价逻辑
+
+用法:
+    python 小市值策略_报告.py metrics.db
+    python 小市值策略_报告.py metrics.db --weeks 12 --baseline 8 --threshold 0.3 --csv ./report
+"""
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import sys
+
+import pandas as pd
+
+TABLE = 'rebalance_runs'
+EXECUTION_TABLE = 'executions'
+# 执行质量分组的价格档(元)和市值档(元)
+PRICE_BINS = ([0, 5, 10, 20, float('inf')], ['<5元', '5-10元', '10-20元', '>=20元'])
+CAP_BINS = ([0, 20e8, 50e8, 100e8, float('inf')], ['<20亿', '20-50亿', '50-100亿', '>=100亿'])
+# 周度汇总: 列名 -> (聚合方式, 报表中的名称)
+WEEKLY_FIELDS = (
+    ('run_id', 'count', '调仓次数'),
+    ('pool_size', 'mean', '初始股票数'),
+    ('selected', 'mean', '入选股票数'),
+    ('select_seconds', 'mean', '选股耗时s'),
+    ('adjust_seconds', 'mean', '调仓耗时s'),
+    ('total_seconds', 'max', '最长总耗时s'),
+    ('api_calls', 'mean', '接口调用'),
+    ('orders', 'sum', '委托笔数'),
+    ('orders_filled', 'sum', '全成笔数'),
+    ('fill_ratio', 'mean', '成交率'),
+    ('scaling_factor', 'min', '最小缩放'),
+    ('cash_utilization', 'mean', '资金利用率'),
+    ('latency_seconds', 'mean', '下单延迟s'),
+    ('peak_memory_mb', 'max', '内存峰值MB'),
+    ('capacity_aum', 'min', '容量上限元'),
+)
+# 退化检查: 列名 -> True 表示越大越差
+REGRESSION_FIELDS = (
+    ('total_seconds', True), ('select_seconds', True), ('adjust_seconds', True), ('api_calls', True),
+    ('latency_seconds', True), ('peak_memory_mb', True), ('fill_ratio', False), ('cash_utilization', False),
+)
+
+log = logging.getLogger('small_cap.report')
+
+
+def load_runs(path):
+    conn = sqlite3.connect(path)
+    try:
+        runs = pd.read_sql_query('SELECT * FROM %s ORDER BY run_id' % TABLE, conn)
+    finally:
+        conn.close()
+    if runs.empty:
+        return runs
+    dates = pd.to_datetime(runs['trade_date'])
+    runs['week'] = dates.dt.strftime('%G-W%V')
+    return runs
+
+
+def load_executions(path):
+    conn = sqlite3.connect(path)
+    try:
+        exists = conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?",
+                              (EXECUTION_TABLE,)).fetchone()
+        if not exists:
+            return pd.DataFrame()
+        executions = pd.read_sql_query('SELECT * FROM %s ORDER BY trade_date' % EXECUTION_TABLE, conn)
+    finally:
+        conn.close()
+    if executions.empty:
+        return executions
+    executions['week'] = pd.to_datetime(executions['trade_date']).dt.strftime('%G-W%V')
+    executions['direction'] = executions['side'].map({1: '买入', -1: '卖出'}).fillna('未知')
+    price = executions['reference'].fillna(executions['avg_price'])
+    executions['price_bucket'] = pd.cut(price, PRICE_BINS[0], labels=PRICE_BINS[1], right=False)
+    executions['cap_bucket'] = pd.cut(executions['market_value'], CAP_BINS[0], labels=CAP_BINS[1], right=False)
+    # 实施偏差(按委托全部数量计)：已成交部分的执行偏差按成交比例折算，加上未成交部分的机会成本
+    # 有成交但没有成交明细(fill_source为空)的委托执行偏差未知，不计入实施偏差
+    executions['shortfall_total_bps'] = (executions['shortfall_bps'].fillna(0) * executions['fill_ratio'].fillna(0)
+                                         + executions['opportunity_bps'].fillna(0))
+    known = executions['shortfall_bps'].notna() | (executions['filled'].fillna(0) == 0)
+    executions['shortfall_total_bps'] = executions['shortfall_total_bps'].where(known)
+    executions['notional'] = executions['amount'] * price
+    return executions
+
+
+def _weighted(values, weights):
+    mask = values.notna() & weights.notna() & (weights > 0)
+    if not mask.any():
+        return float('nan')
+    return float((values[mask] * weights[mask]).sum() / weights[mask].sum())
+
+
+def execution_quality(executions, by):
+    """按分组汇总执行质量：执行偏差按成交金额加权，实施偏差按委托金额加权，成交率按股数计"""
+    rows = {}
+    for key, group in executions.groupby(by, observed=True):
+        filled_value = group['filled'] * group['avg_price']
+        rows[key] = {
+            '委托笔数': len(group),
+            '全成比例': float((group['state'] == 'filled').mean()),
+            '成交率': float(group['filled'].sum()) / group['amount'].sum() if group['amount'].sum() else float('nan'),
+            '执行偏差bp': _weighted(group['shortfall_bps'], filled_value),
+            '机会成本bp': _weighted(group['opportunity_bps'], group['notional']),
+            '实施偏差bp': _weighted(group['shortfall_total_bps'], group['notional']),
+            '首笔成交s(中位)': group['time_to_fill'].median(),
+            '全部成交s(中位)': group['time_to_complete'].median(),
+        }
+    return pd.DataFrame.from_dict(rows, orient='index')
+
+
+def weekly_trend(runs):
+    """按ISO周汇总每次调仓的记录"""
+    columns = dict((field, (field, how)) for field, how, _ in WEEKLY_FIELDS if field in runs.columns)
+    weekly = runs.groupby('week').agg(**columns)
+    return weekly.rename(columns=dict((field, name) for field, _, name in WEEKLY_FIELDS))
+
+
+def stage_table(runs):
+    """漏斗各阶段按周的平均耗时(秒)与平均剩余股票数"""
+    rows = []
+    for week, stages in zip(runs['week'], runs['stages']):
+        try:
+            for stage, count, seconds in json.loads(stages or '[]'):
+                rows.append({'week': week, 'stage': stage, 'count': count, 'seconds': seconds})
+        except (TypeError, ValueError):
+            continue
+    if not rows:
+        return pd.DataFrame(), pd.DataFrame()
+    frame = pd.DataFrame(rows)
+    order = list(dict.fromkeys(frame['stage']))
+    seconds = frame.pivot_table(index='week', columns='stage', values='seconds', aggfunc='mean')[order]
+    counts = frame.pivot_table(index='week', columns='stage', values='count', aggfunc='mean')[order]
+    return seconds, counts
+
+
+def regressions(runs, baseline=8, threshold=0.3):
+    """最近一周的均值与此前baseline周的周均值中位数比较，变差超过threshold的指标"""
+    weekly = runs.groupby('week').mean(numeric_only=True)
+    if len(weekly) < 2:
+        return []
+    latest = weekly.iloc[-1]
+    history = weekly.iloc[-1 - baseline:-1]
+    found = []
+    for field, higher_is_worse in REGRESSION_FIELDS:
+        if field not in weekly.columns:
+            continue
+        reference = history[field].median()
+        value = latest[field]
+        if pd.isna(reference) or pd.isna(value) or reference == 0:
+            continue
+        change = (value - reference) / abs(reference)
+        if (change if higher_is_worse else -change) > threshold:
+            found.append((field, value, reference, change))
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='小市值策略运行指标周报')
+    parser.add_argument('db', help='运行指标库 metrics.db')
+    parser.add_argument('--weeks', type=int, default=12, help='显示最近多少周，默认12')
+    parser.add_argument('--baseline', type=int, default=8, help='退化检查的对比周数，默认8')
+    parser.add_argument('--threshold', type=float, default=0.3, help='退化阈值(相对变化)，默认0.3')
+    parser.add_argument('--csv', help='同时把各表写入该目录下的csv文件')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    runs = load_runs(args.db)
+    if runs.empty:
+        log.info('指标库中没有调仓记录: %s', args.db)
+        return 0
+    pd.set_option('display.width', 200)
+    pd.set_option('display.max_columns', 40)
+    trend = weekly_trend(runs).tail(args.weeks)
+    seconds, counts = stage_table(runs)
+    log.info('调仓记录 %d 条，%s 至 %s', len(runs), runs['trade_date'].iloc[0], runs['trade_date'].iloc[-1])
+    log.info('\n周度趋势:\n%s', trend.round(3).to_string())
+    if not seconds.empty:
+        log.info('\n漏斗各阶段平均耗时(秒):\n%s', seconds.tail(args.weeks).round(4).to_string())
+        log.info('\n漏斗各阶段平均剩余股票数:\n%s', counts.tail(args.weeks).round(1).to_string())
+    found = regressions(runs, args.baseline, args.threshold)
+    for field, value, reference, change in found:
+        log.warning('退化: %s 最近一周 %.4g，对比中位数 %.4g (%+.0f%%)', field, value, reference, change * 100)
+    if not found:
+        log.info('\n最近一周未发现超过阈值(%.0f%%)的退化', args.threshold * 100)
+    executions = load_executions(args.db)
+    quality = {}
+    if not executions.empty:
+        weeks = sorted(executions['week'].unique())[-args.weeks:]
+        recent = executions[executions['week'].isin(weeks)]
+        quality = {
+            'execution_weekly': execution_quality(recent, ['week', 'direction']),
+            'execution_price': execution_quality(recent, ['direction', 'price_bucket']),
+            'execution_cap': execution_quality(recent, ['direction', 'cap_bucket']),
+        }
+        titles = {'execution_weekly': '按周', 'execution_price': '按价格档', 'execution_cap': '按市值档'}
+        for name, table in quality.items():
+            log.info('\n执行质量(%s，偏差为正表示不利):\n%s', titles[name], table.round(2).to_string())
+    if args.csv:
+        os.makedirs(args.csv, exist_ok=True)
+        trend.to_csv(os.path.join(args.csv, 'weekly_trend.csv'))
+        if not seconds.empty:
+            seconds.to_csv(os.path.join(args.csv, 'stage_seconds.csv'))
+            counts.to_csv(os.path.join(args.csv, 'stage_counts.csv'))
+        for name, table in quality.items():
+            table.to_csv(os.path.join(args.csv, '%s.csv' % name))
+    return 1 if found else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
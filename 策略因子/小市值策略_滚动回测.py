@@ -0,0 +1,940 @@
+# coding=utf-8
+"""
+小市值策略离线滚动回测(walk-forward)与多参数并行运行器
+
+本脚本在本地(非PTrade平台)运行，用于研究阶段加速回测：
+1. 行情与基本面以"日期 x 股票"的面板存放为 .npy 内存映射文件，工作进程只接收目录路径，
+   按需只读映射数据页，不再把 DataFrame 序列化后逐个发送给子进程
+2. 长区间按窗口切分：串行模式下窗口边界交接持仓与 last_friday_selection；
+   并行模式下每个窗口先做预热再对齐交接状态，不一致的窗口按真实交接状态串行重跑
+3. 多组独立参数在进程池中并行运行，默认使用全部本地核心
+
+策略文件本身不做任何修改：脚本以独立模块加载 小市值策略.py，并把离线实现的平台接口
+(get_history、get_fundamentals、order_target_value 等)注入到模块命名空间。
+
+面板目录结构:
+    meta.json                 日期、代码、字段列表、年份、股票基础信息(名称/上市日期)
+    <日频字段>.npy            形状 (日期数, 代码数)，如 open/high/low/close/volume、
+                              dividend_ratio/total_value/turnover_rate、total_liability/total_assets
+    annual_<年报字段>.npy     形状 (年份数, 代码数)，如 np_parent_company_owners/net_profit
+
+用法:
+    python 小市值策略_滚动回测.py --store ./panel_store --start 2021-01-04 --end 2024-12-31 \
+        --window 120 --grid params.json --processes 8
+"""
+import argparse
+import datetime
+import importlib.util
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+STRATEGY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '小市值策略.py')
+REPLAY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '小市值策略_回放.py')
+STORE_META = 'meta.json'
+ANNUAL_PREFIX = 'annual_'
+
+# 估值表与资产负债表字段从日频面板读取，利润表字段从年报面板读取
+VALUATION_FIELDS = ('dividend_ratio', 'total_value', 'turnover_rate')
+BALANCE_FIELDS = ('total_liability', 'total_assets')
+# 订单状态码与PTrade数据字典保持一致
+OPEN_ORDER_STATUS = ('0', '1', '2', '7')
+
+log = logging.getLogger('small_cap.walk_forward')
+
+
+# ---------------------------------------------------------------------------
+# 面板存储(内存映射)
+# ---------------------------------------------------------------------------
+
+def write_panel_store(path, dates, codes, daily_fields, annual_fields=None, years=None, stock_info=None):
+    """
+    写入面板目录
+    daily_fields: {字段名: 形状(len(dates), len(codes))的数组}
+    annual_fields: {字段名: 形状(len(years), len(codes))的数组}
+    stock_info: {代码: {'stock_name': ..., 'listed_date': 'YYYY-MM-DD'}}
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    annual_fields = annual_fields or {}
+    shape = (len(dates), len(codes))
+    for name, values in daily_fields.items():
+        arr = np.asarray(values, dtype=np.float64)
+        if arr.shape != shape:
+            raise ValueError('日频字段 %s 形状应为 %s，实际为 %s' % (name, shape, arr.shape))
+        np.save(os.path.join(path, name + '.npy'), arr)
+    for name, values in annual_fields.items():
+        arr = np.asarray(values, dtype=np.float64)
+        if arr.shape != (len(years or []), len(codes)):
+            raise ValueError('年报字段 %s 形状与年份/代码数量不一致' % name)
+        np.save(os.path.join(path, ANNUAL_PREFIX + name + '.npy'), arr)
+    meta = {
+        'dates': [_to_date(d).isoformat() for d in dates],
+        'codes': list(codes),
+        'daily_fields': sorted(daily_fields),
+        'annual_fields': sorted(annual_fields),
+        'years': [int(y) for y in (years or [])],
+        'stock_info': stock_info or {},
+    }
+    with open(os.path.join(path, STORE_META), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+    return path
+
+
+def open_panel_store(path):
+    """只读打开面板目录，字段数组以内存映射方式加载，多个进程共享同一份页缓存"""
+    with open(os.path.join(path, STORE_META), encoding='utf-8') as f:
+        meta = json.load(f)
+    dates = [_to_date(d) for d in meta['dates']]
+    codes = list(meta['codes'])
+    store = {
+        'path': path,
+        'dates': dates,
+        'codes': codes,
+        'date_index': dict((d, i) for i, d in enumerate(dates)),
+        'code_index': dict((c, i) for i, c in enumerate(codes)),
+        'daily': {},
+        'annual': {},
+        'years': list(meta.get('years', [])),
+        'stock_info': meta.get('stock_info', {}),
+    }
+    # 策略的本地日线归档按容量预留行列，只取meta中记录的实际日期和代码
+    for name in meta.get('daily_fields', []):
+        panel = np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+        store['daily'][name] = panel[:len(dates), :len(codes)]
+    for name in meta.get('annual_fields', []):
+        store['annual'][name] = np.load(os.path.join(path, ANNUAL_PREFIX + name + '.npy'), mmap_mode='r')
+    return store
+
+
+# 子进程内按路径缓存已打开的面板，同一进程处理多个任务时不重复映射
+_STORE_CACHE = {}
+
+
+def _get_store(path):
+    store = _STORE_CACHE.get(path)
+    if store is None:
+        store = open_panel_store(path)
+        _STORE_CACHE[path] = store
+    return store
+
+
+def _to_date(value):
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    s = str(value).strip()
+    if '-' in s:
+        return datetime.datetime.strptime(s[:10], '%Y-%m-%d').date()
+    return datetime.datetime.strptime(s[:8], '%Y%m%d').date()
+
+
+# ---------------------------------------------------------------------------
+# 离线平台：以面板数据实现策略用到的PTrade接口
+# ---------------------------------------------------------------------------
+
+class _Obj(object):
+    """简单属性容器，模拟平台的 g / Position / Order 等对象"""
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def get(self, key, default=None):
+        return self.__dict__.get(key, default)
+
+
+class _Portfolio(object):
+    def __init__(self, platform):
+        self._platform = platform
+
+    @property
+    def cash(self):
+        return self._platform.cash
+
+    @property
+    def positions(self):
+        return self._platform.get_positions()
+
+    @property
+    def positions_value(self):
+        return sum(p.amount * p.last_sale_price for p in self._platform.positions.values())
+
+    @property
+    def portfolio_value(self):
+        return self.cash + self.positions_value
+
+
+class OfflinePlatform(object):
+    """
+    基于面板数据的日频撮合环境
+    - handle_data 在 handle_data_time(默认09:35)调用一次，与交易端 run_daily 时点一致
+    - 行情查询只返回当前交易日之前的K线(include=True 时含当日)，估值取前一交易日
+    - 委托按当日 fill_field(默认开盘价)撮合，考虑限价、滑点、佣金、100股整手、T+1与成交量比例
+    - 成交、委托状态变化后同步调用策略定义的 on_trade_response / on_order_response，模拟交易端主推
+    """
+
+    def __init__(self, store, initial_cash=1000000.0, handle_data_time='09:35', fill_field='open',
+                 log_level=logging.WARNING, research_path=None):
+        self.store = store
+        self.research_path = research_path or os.path.join(os.getcwd(), 'research')
+        self.cash = float(initial_cash)
+        self.positions = {}
+        self.orders = {}
+        self.trades_today = []
+        self.order_log = []
+        self.daily_tasks = []
+        self.commission_ratio = 0.0003
+        self.min_commission = 5.0
+        self.slippage = 0.0
+        self.volume_ratio = 1.0
+        self.handle_data_time = handle_data_time
+        self.fill_field = fill_field if fill_field in store['daily'] else 'close'
+        self.day_idx = 0
+        self._order_seq = 0
+        self.module = None
+        self.g = _Obj()
+        self.log = logging.getLogger('small_cap.strategy.%d' % id(self))
+        self.log.setLevel(log_level)
+        self.context = _Obj(current_dt=None, previous_date=None, portfolio=_Portfolio(self))
+        self.context.blotter = _Obj(current_dt=None)
+
+    # ---- 绑定到策略模块 ----
+
+    def bind(self, module):
+        """把平台接口注入策略模块命名空间，需在执行模块代码之前调用"""
+        names = (
+            'set_benchmark', 'set_commission', 'set_slippage', 'set_fixed_slippage', 'set_volume_ratio',
+            'set_universe', 'run_daily', 'run_interval', 'is_trade', 'get_history', 'get_fundamentals',
+            'get_stock_info', 'get_stock_name', 'get_Ashares', 'get_stock_status', 'get_trades',
+            'get_orders', 'get_order', 'get_open_orders', 'cancel_order', 'get_positions', 'get_position',
+            'order', 'order_value', 'order_target', 'order_target_value', 'get_trading_day',
+            'get_trade_days', 'get_all_trades_days', 'get_research_path', 'create_dir',
+        )
+        for name in names:
+            setattr(module, name, getattr(self, name))
+        module.g = self.g
+        module.log = self.log
+        self.module = module
+
+    def _push(self, callback, records):
+        """模拟交易主推：策略定义了对应回调时同步调用"""
+        func = getattr(self.module, callback, None) if self.module is not None else None
+        if func is not None:
+            func(self.context, records)
+
+    def _push_order(self, o):
+        self._push('on_order_response', [{
+            'order_id': o.id, 'stock_code': o.symbol, 'amount': o.amount, 'price': o.limit or 0.0,
+            'business_amount': o.filled, 'status': o.status, 'order_time': o.dt}])
+
+    # ---- 设置函数 ----
+
+    def set_benchmark(self, security):
+        self.benchmark = security
+
+    def set_commission(self, commission_ratio=0.0003, min_commission=5.0, type='STOCK'):
+        self.commission_ratio = float(commission_ratio)
+        self.min_commission = float(min_commission)
+
+    def set_slippage(self, slippage=0.001):
+        self.slippage = float(slippage)
+
+    def set_fixed_slippage(self, fixed_slippage=0.0):
+        pass
+
+    def set_volume_ratio(self, volume_ratio=0.25):
+        self.volume_ratio = float(volume_ratio)
+
+    def set_universe(self, security_list):
+        pass
+
+    def run_daily(self, context, func, time='9:31'):
+        self.daily_tasks.append((_parse_time(time), func))
+
+    def run_interval(self, context, func, seconds=10):
+        # 仅交易端可用，回测中忽略
+        pass
+
+    def is_trade(self):
+        return False
+
+    def get_research_path(self):
+        return self.research_path
+
+    def create_dir(self, user_path):
+        path = os.path.join(self.research_path, user_path)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    # ---- 交易日 ----
+
+    def get_trading_day(self, day=0):
+        i = min(max(self.day_idx + int(day), 0), len(self.store['dates']) - 1)
+        return self.store['dates'][i]
+
+    def get_trade_days(self, start_date=None, end_date=None, count=None):
+        dates = self.store['dates']
+        end = _to_date(end_date) if end_date else dates[self.day_idx]
+        if count is not None:
+            selected = [d for d in dates if d <= end][-int(count):]
+        else:
+            start = _to_date(start_date) if start_date else dates[0]
+            selected = [d for d in dates if start <= d <= end]
+        return np.array(selected)
+
+    def get_all_trades_days(self, date=None):
+        end = _to_date(date) if date else self.store['dates'][self.day_idx]
+        return np.array([d for d in self.store['dates'] if d <= end])
+
+    # ---- 行情与基础数据 ----
+
+    def _code_positions(self, security_list):
+        if security_list is None:
+            security_list = self.store['codes']
+        if isinstance(security_list, str):
+            security_list = [security_list]
+        index = self.store['code_index']
+        codes = [c for c in security_list if c in index]
+        return codes, np.array([index[c] for c in codes], dtype=np.int64)
+
+    def get_history(self, count, frequency='1d', field='close', security_list=None, fq=None,
+                    include=False, fill='nan', is_dict=False):
+        fields = [field] if isinstance(field, str) else list(field)
+        # 离线面板只有日线，其他周期返回空表，策略会回退到日线价格
+        if frequency != '1d':
+            return pd.DataFrame(columns=['code'] + fields)
+        codes, cols = self._code_positions(security_list)
+        end = self.day_idx + 1 if include else self.day_idx
+        start = max(end - int(count), 0)
+        if not codes or end <= start:
+            return pd.DataFrame(columns=['code'] + fields)
+        dates = self.store['dates'][start:end]
+        n_dates = len(dates)
+        data = {'code': np.repeat(np.array(codes, dtype=object), n_dates)}
+        for name in fields:
+            panel = self.store['daily'].get(name)
+            if panel is None:
+                data[name] = np.full(len(codes) * n_dates, np.nan)
+            else:
+                # (日期, 代码) -> 按代码分块展开，与平台多代码返回的长表格式一致
+                data[name] = np.asarray(panel[start:end][:, cols]).T.ravel()
+        index = pd.DatetimeIndex(np.tile(np.array(dates, dtype='datetime64[D]'), len(codes)))
+        return pd.DataFrame(data, index=index)
+
+    def get_fundamentals(self, security, table_name, fields=None, date=None, start_year=None,
+                         end_year=None, report_types=None, date_type=None, merge_type=None):
+        codes, cols = self._code_positions(security)
+        if isinstance(fields, str):
+            fields = [fields]
+        if table_name == 'income_statement':
+            return self._income_statement(codes, cols, fields or [], start_year, end_year)
+        # 估值/资产负债表取查询日期前一交易日
+        if date is not None:
+            day = _to_date(date)
+            row = sum(1 for d in self.store['dates'] if d < day) - 1
+        else:
+            row = self.day_idx - 1
+        default = VALUATION_FIELDS if table_name == 'valuation' else BALANCE_FIELDS
+        fields = list(fields or default)
+        frame = pd.DataFrame(index=pd.Index(codes, name='secu_code'))
+        for name in fields:
+            panel = self.store['daily'].get(name)
+            if panel is None or row < 0:
+                frame[name] = np.nan
+            else:
+                frame[name] = np.asarray(panel[row, cols])
+        return frame
+
+    def _income_statement(self, codes, cols, fields, start_year, end_year):
+        today = self.store['dates'][self.day_idx]
+        years = self.store['years']
+        first = int(start_year) if start_year else today.year - 1
+        last = int(end_year) if end_year else today.year - 1
+        rows = []
+        for i, year in enumerate(years):
+            # 年报按次年4月30日披露，之前不可见，避免引入未来数据
+            publ_date = datetime.date(year + 1, 4, 30)
+            if first <= year <= last and publ_date <= today:
+                rows.append((i, year, publ_date))
+        if not rows or not codes:
+            return pd.DataFrame()
+        records = []
+        for i, year, publ_date in rows:
+            end_date = '%d-12-31' % year
+            for code, col in zip(codes, cols):
+                record = {'secu_code': code, 'end_date': end_date, 'publ_date': publ_date.isoformat()}
+                for name in fields:
+                    if name in ('end_date', 'publ_date'):
+                        continue
+                    panel = self.store['annual'].get(name)
+                    record[name] = float(panel[i, col]) if panel is not None else np.nan
+                records.append(record)
+        frame = pd.DataFrame(records).sort_values(['secu_code', 'end_date'])
+        frame.index = pd.MultiIndex.from_arrays([frame['secu_code'], frame['end_date'].values],
+                                                names=['secu_code', 'end_date'])
+        return frame.drop(columns=['secu_code'])
+
+    def get_stock_info(self, stocks, field='stock_name'):
+        if isinstance(stocks, str):
+            stocks = [stocks]
+        fields = [field] if isinstance(field, str) else list(field)
+        info = self.store['stock_info']
+        return dict((s, dict((f, info.get(s, {}).get(f)) for f in fields)) for s in stocks)
+
+    def get_stock_name(self, stocks):
+        if isinstance(stocks, str):
+            stocks = [stocks]
+        info = self.store['stock_info']
+        return dict((s, info.get(s, {}).get('stock_name')) for s in stocks)
+
+    def get_Ashares(self, date=None):
+        today = _to_date(date) if date else self.store['dates'][self.day_idx]
+        info = self.store['stock_info']
+        result = []
+        for code in self.store['codes']:
+            listed = info.get(code, {}).get('listed_date')
+            if not listed or _to_date(listed) <= today:
+                result.append(code)
+        return result
+
+    def get_stock_status(self, stocks, query_type='ST', query_date=None):
+        codes, cols = self._code_positions(stocks)
+        result = dict((s, False) for s in ([stocks] if isinstance(stocks, str) else stocks))
+        if query_type == 'HALT':
+            volume = self.store['daily'].get('volume')
+            if volume is not None:
+                vols = np.asarray(volume[self.day_idx, cols])
+                for code, vol in zip(codes, vols):
+                    result[code] = bool(not np.isfinite(vol) or vol <= 0)
+        elif query_type == 'ST':
+            info = self.store['stock_info']
+            for code in codes:
+                result[code] = 'ST' in (info.get(code, {}).get('stock_name') or '')
+        return result
+
+    # ---- 委托、成交、持仓 ----
+
+    def _price(self, security, field):
+        panel = self.store['daily'].get(field)
+        col = self.store['code_index'].get(security)
+        if panel is None or col is None:
+            return np.nan
+        return float(panel[self.day_idx, col])
+
+    def _new_position(self, security):
+        return _Obj(sid=security, amount=0, enable_amount=0, cost_basis=0.0,
+                    last_sale_price=self._price(security, 'close'))
+
+    def get_positions(self):
+        return dict((s, p) for s, p in self.positions.items() if p.amount > 0)
+
+    def get_position(self, security):
+        return self.positions.get(security) or self._new_position(security)
+
+    def get_trades(self):
+        return list(self.trades_today)
+
+    def get_orders(self, security=None):
+        return [o for o in self.orders.values() if security is None or o.symbol == security]
+
+    def get_order(self, order_id):
+        return self.orders.get(order_id)
+
+    def get_open_orders(self, security=None):
+        return dict((oid, o) for oid, o in self.orders.items()
+                    if o.status in OPEN_ORDER_STATUS and (security is None or o.symbol == security))
+
+    def cancel_order(self, order_param):
+        order_id = getattr(order_param, 'id', order_param)
+        o = self.orders.get(order_id)
+        if o is not None and o.status in OPEN_ORDER_STATUS:
+            o.status = '5' if o.filled else '6'
+            self._push_order(o)
+
+    def order(self, security, amount, limit_price=None):
+        return self._submit(security, int(amount), limit_price)
+
+    def order_value(self, security, value, limit_price=None):
+        price = limit_price or self._price(security, self.fill_field)
+        if not price or not np.isfinite(price):
+            return None
+        return self._submit(security, int(value / price // 100 * 100), limit_price)
+
+    def order_target(self, security, amount, limit_price=None):
+        current = self.positions[security].amount if security in self.positions else 0
+        return self._submit(security, int(amount) - current, limit_price)
+
+    def order_target_value(self, security, value, limit_price=None):
+        price = self._price(security, self.fill_field)
+        if not np.isfinite(price) or price <= 0:
+            return None
+        current = self.positions[security].amount if security in self.positions else 0
+        target = int(value / price // 100 * 100) if value > 0 else 0
+        return self._submit(security, target - current, limit_price)
+
+    def _submit(self, security, amount, limit_price):
+        if amount == 0:
+            return None
+        self._order_seq += 1
+        order_id = 'offline-%d' % self._order_seq
+        o = _Obj(id=order_id, dt=self.context.current_dt, symbol=security, amount=amount, filled=0,
+                 limit=limit_price, status='2', price=0.0)
+        self.orders[order_id] = o
+        self._match(o)
+        self._push_order(o)
+        o.record = {'id': order_id, 'date': self.store['dates'][self.day_idx].isoformat(),
+                    'security': security, 'amount': amount}
+        self.order_log.append(o.record)
+        return order_id
+
+    def _match(self, o):
+        px = self._price(o.symbol, self.fill_field)
+        if not np.isfinite(px) or px <= 0:
+            return
+        buy = o.amount > 0
+        # 限价单：开盘价劣于限价则当日不成交，收盘时撤单
+        if o.limit and ((buy and px > o.limit) or (not buy and px < o.limit)):
+            return
+        deal_px = px * (1 + self.slippage / 2) if buy else px * (1 - self.slippage / 2)
+        qty = abs(o.amount)
+        volume = self.store['daily'].get('volume')
+        if volume is not None:
+            vol = float(volume[self.day_idx, self.store['code_index'][o.symbol]])
+            if not np.isfinite(vol) or vol <= 0:
+                return
+            qty = min(qty, int(vol * self.volume_ratio // 100 * 100))
+        pos = self.positions.get(o.symbol)
+        if buy:
+            affordable = int((self.cash - self.min_commission) / (deal_px * (1 + self.commission_ratio)) // 100 * 100)
+            qty = min(qty, max(affordable, 0))
+        else:
+            qty = min(qty, pos.enable_amount if pos else 0)
+        if qty <= 0:
+            return
+        value = qty * deal_px
+        commission = max(value * self.commission_ratio, self.min_commission)
+        if pos is None:
+            pos = self._new_position(o.symbol)
+            self.positions[o.symbol] = pos
+        if buy:
+            pos.cost_basis = (pos.cost_basis * pos.amount + value + commission) / (pos.amount + qty)
+            pos.amount += qty
+            self.cash -= value + commission
+        else:
+            pos.amount -= qty
+            pos.enable_amount -= qty
+            self.cash += value - commission
+            if pos.amount <= 0:
+                del self.positions[o.symbol]
+        o.filled = qty
+        o.price = deal_px
+        o.status = '8' if qty == abs(o.amount) else '7'
+        self.trades_today.append({'security': o.symbol, 'side': 'BUY' if buy else 'SELL', 'amount': qty,
+                                  'price': deal_px, 'order_id': o.id, 'dt': self.context.current_dt})
+        self._push('on_trade_response', [{
+            'order_id': o.id, 'stock_code': o.symbol, 'entrust_bs': '1' if buy else '2',
+            'business_amount': qty, 'business_price': deal_px, 'business_time': self.context.current_dt,
+            'status': o.status}])
+
+    # ---- 状态交接 ----
+
+    def export_state(self):
+        """导出窗口边界需要交接的状态：资金、持仓与策略的轮换记忆"""
+        ctx = self.context
+        value = self.context.portfolio.portfolio_value
+        return {
+            'cash': self.cash,
+            'value': value,
+            'weights': dict((s, p.amount * p.last_sale_price / value if value > 0 else 0.0)
+                            for s, p in self.positions.items() if p.amount > 0),
+            'positions': dict((s, {'amount': p.amount, 'cost_basis': p.cost_basis,
+                                   'last_sale_price': p.last_sale_price})
+                              for s, p in self.positions.items() if p.amount > 0),
+            'last_friday_selection': list(getattr(ctx, 'last_friday_selection', []) or []),
+            'last_selection_date': _iso(getattr(ctx, 'last_selection_date', None)),
+            'last_buy_date': _iso(getattr(ctx, 'last_buy_date', None)),
+            'deferred_sells': sorted(getattr(ctx, 'deferred_sells', set()) or []),
+        }
+
+    def import_state(self, state):
+        self.cash = float(state['cash'])
+        self.positions = {}
+        for code, p in state.get('positions', {}).items():
+            pos = self._new_position(code)
+            pos.amount = int(p['amount'])
+            pos.cost_basis = float(p.get('cost_basis', 0.0))
+            # 按交接时(上一窗口最后一日收盘)的价格估值，否则新窗口首日开盘前就计入了首日涨跌，拼接净值时丢失这一天的收益
+            if p.get('last_sale_price'):
+                pos.last_sale_price = float(p['last_sale_price'])
+            self.positions[code] = pos
+        ctx = self.context
+        ctx.last_friday_selection = list(state.get('last_friday_selection', []))
+        ctx.last_selection_date = _from_iso(state.get('last_selection_date'))
+        ctx.last_buy_date = _from_iso(state.get('last_buy_date'))
+        ctx.deferred_sells = set(state.get('deferred_sells', []))
+
+    # ---- 日内流程 ----
+
+    def _set_time(self, day, t):
+        dt = datetime.datetime.combine(day, t)
+        self.context.current_dt = dt
+        self.context.blotter.current_dt = dt
+
+    def _start_day(self):
+        self.trades_today = []
+        for pos in self.positions.values():
+            pos.enable_amount = pos.amount
+
+    def _end_day(self):
+        for o in self.orders.values():
+            if o.status in OPEN_ORDER_STATUS:
+                o.status = '5' if o.filled else '6'
+                self._push_order(o)
+            o.record.update(filled=o.filled, price=o.price, status=o.status)
+        self.orders = {}
+        for code, pos in self.positions.items():
+            close = self._price(code, 'close')
+            if np.isfinite(close) and close > 0:
+                pos.last_sale_price = close
+
+    def run(self, module, start_idx, end_idx, record_from_idx=None):
+        """按交易日推进 [start_idx, end_idx]，返回记录区间内的收盘净值序列"""
+        dates = self.store['dates']
+        nav = []
+        before = getattr(module, 'before_trading_start', None)
+        after = getattr(module, 'after_trading_end', None)
+        tasks = sorted([(_parse_time(self.handle_data_time), lambda ctx: module.handle_data(ctx, {}))]
+                       + self.daily_tasks, key=lambda x: x[0])
+        record_from_idx = start_idx if record_from_idx is None else record_from_idx
+        start_state = None
+        for i in range(start_idx, end_idx + 1):
+            if i == record_from_idx:
+                start_state = self.export_state()
+            self.day_idx = i
+            day = dates[i]
+            self.context.previous_date = dates[i - 1] if i > 0 else None
+            self._start_day()
+            if before is not None:
+                self._set_time(day, datetime.time(8, 30))
+                before(self.context, {})
+            for t, func in tasks:
+                self._set_time(day, t)
+                func(self.context)
+            if after is not None:
+                self._set_time(day, datetime.time(15, 30))
+                after(self.context, {})
+            self._end_day()
+            if i >= record_from_idx:
+                nav.append((day.isoformat(), self.context.portfolio.portfolio_value))
+        return nav, start_state
+
+
+def _parse_time(value):
+    if isinstance(value, datetime.time):
+        return value
+    hh, mm = str(value).split(':')[:2]
+    return datetime.time(int(hh), int(mm))
+
+
+def _iso(value):
+    return value.isoformat() if isinstance(value, (datetime.date, datetime.datetime)) else value
+
+
+def _from_iso(value):
+    return _to_date(value) if value else None
+
+
+def load_strategy(platform, path=STRATEGY_FILE):
+    """以独立模块加载策略文件，每次回测使用全新的模块命名空间"""
+    spec = importlib.util.spec_from_file_location('small_cap_strategy_%d' % id(platform), path)
+    module = importlib.util.module_from_spec(spec)
+    platform.bind(module)
+    spec.loader.exec_module(module)
+    return module
+
+
+# ---------------------------------------------------------------------------
+# 单次回测 / 滚动窗口 / 参数网格
+# ---------------------------------------------------------------------------
+
+def _index_range(store, start, end):
+    dates = store['dates']
+    start, end = _to_date(start), _to_date(end)
+    idx = [i for i, d in enumerate(dates) if start <= d <= end]
+    if not idx:
+        raise ValueError('面板中没有 %s 至 %s 的交易日' % (start, end))
+    return idx[0], idx[-1]
+
+
+def run_backtest(store_path, start, end, params=None, initial_cash=1000000.0, state=None,
+                 warmup_days=0, log_level=logging.WARNING, research_path=None):
+    """
+    运行一次离线回测
+    state: 上一窗口导出的交接状态，传入时从该状态继续(不再预热)
+    warmup_days: 无交接状态时向前预热的交易日数，预热区间不计入净值
+    research_path: 策略研究目录(轨迹、指标等输出)，默认当前目录下的 research
+    """
+    store = _get_store(store_path)
+    start_idx, end_idx = _index_range(store, start, end)
+    platform = OfflinePlatform(store, initial_cash=initial_cash, log_level=log_level, research_path=research_path)
+    module = load_strategy(platform)
+    platform.day_idx = start_idx
+    platform._set_time(store['dates'][start_idx], datetime.time(8, 0))
+    # 参数在 initialize 的默认设置之后、安装接口包装和注册定时任务之前覆盖，
+    # metrics_enabled、profiling_enabled、api_trace_enabled、shared_data_role 等安装时读取的设置同样生效
+    setup_runtime = module._setup_runtime
+
+    def setup_with_params(context):
+        for key, value in (params or {}).items():
+            setattr(context, key, value)
+        setup_runtime(context)
+
+    module._setup_runtime = setup_with_params
+    module.initialize(platform.context)
+    run_from = start_idx
+    if state is not None:
+        platform.import_state(state)
+    elif warmup_days:
+        run_from = max(start_idx - int(warmup_days), 0)
+    nav, start_state = platform.run(module, run_from, end_idx, record_from_idx=start_idx)
+    return {
+        'start': store['dates'][start_idx].isoformat(),
+        'end': store['dates'][end_idx].isoformat(),
+        'params': params or {},
+        'nav': nav,
+        'start_state': start_state,
+        'end_state': platform.export_state(),
+        'orders': platform.order_log,
+    }
+
+
+def split_windows(store, start, end, window_days):
+    """按交易日数切分滚动窗口，返回 [(开始日期, 结束日期), ...]"""
+    start_idx, end_idx = _index_range(store, start, end)
+    dates = store['dates']
+    windows = []
+    i = start_idx
+    while i <= end_idx:
+        j = min(i + int(window_days) - 1, end_idx)
+        windows.append((dates[i].isoformat(), dates[j].isoformat()))
+        i = j + 1
+    return windows
+
+
+def _state_matches(handoff, start_state, tolerance):
+    """
+    判断并行窗口预热得到的起点状态能否替代真实交接状态：
+    持仓代码、轮换记忆、延迟卖出队列一致，且各持仓权重差异不超过 tolerance。
+    资金规模差异不影响结果，净值按收益率拼接。
+    """
+    for key in ('last_friday_selection', 'deferred_sells'):
+        if sorted(handoff.get(key, [])) != sorted(start_state.get(key, [])):
+            return False
+    a, b = handoff.get('weights', {}), start_state.get('weights', {})
+    if set(a) != set(b):
+        return False
+    return all(abs(a[s] - b[s]) <= tolerance for s in a)
+
+
+def _run_job(job):
+    t0 = time.time()
+    result = run_backtest(**job)
+    result['elapsed'] = time.time() - t0
+    return result
+
+
+def _chain_nav(window_results, initial_cash):
+    """按各窗口日收益率拼接净值，窗口首日收益相对于该窗口起始资产"""
+    nav = []
+    value = float(initial_cash)
+    for res in window_results:
+        prev = res['start_state']['value'] if res.get('start_state') else None
+        for day, v in res['nav']:
+            if prev:
+                value *= v / prev
+            prev = v
+            nav.append((day, value))
+    return nav
+
+
+def run_walk_forward(store_path, start, end, window_days, params=None, initial_cash=1000000.0,
+                     processes=None, warmup_days=10, handoff_tolerance=0.02, log_level=logging.WARNING):
+    """
+    滚动窗口回测
+    processes == 1: 串行，窗口结束状态原样交接给下一窗口
+    processes > 1 或 None: 各窗口预热 warmup_days 后并行运行；随后依次核对窗口起点状态与上一窗口
+    结束状态，不一致(见 _state_matches)的窗口用真实交接状态重跑。
+    策略有路径依赖(保留股不再平衡)，持仓权重差异常超过容差，此时会退化为接近串行的耗时；
+    多核加速主要来自 run_parameter_grid。
+    """
+    store = _get_store(store_path)
+    windows = split_windows(store, start, end, window_days)
+    base = {'store_path': store_path, 'params': params, 'initial_cash': initial_cash, 'log_level': log_level}
+    if processes == 1 or len(windows) == 1:
+        results = []
+        state = None
+        for w_start, w_end in windows:
+            res = run_backtest(start=w_start, end=w_end, state=state, **base)
+            results.append(res)
+            state = res['end_state']
+        return {'windows': results, 'nav': _chain_nav(results, initial_cash), 'reruns': 0}
+
+    jobs = [dict(base, start=w_start, end=w_end, warmup_days=warmup_days if k else 0)
+            for k, (w_start, w_end) in enumerate(windows)]
+    with ProcessPoolExecutor(max_workers=processes or os.cpu_count()) as pool:
+        results = list(pool.map(_run_job, jobs))
+    reruns = 0
+    for k in range(1, len(results)):
+        handoff = results[k - 1]['end_state']
+        if not _state_matches(handoff, results[k]['start_state'], handoff_tolerance):
+            log.info('窗口 %s 起点状态与交接状态不一致，按交接状态重跑', windows[k][0])
+            results[k] = run_backtest(start=windows[k][0], end=windows[k][1], state=handoff, **base)
+            reruns += 1
+    return {'windows': results, 'nav': _chain_nav(results, initial_cash), 'reruns': reruns}
+
+
+def summarize_nav(nav):
+    """计算净值序列的区间收益、年化收益与最大回撤"""
+    if not nav:
+        return {'total_return': 0.0, 'annual_return': 0.0, 'max_drawdown': 0.0, 'days': 0}
+    values = np.array([v for _, v in nav], dtype=np.float64)
+    peak = np.maximum.accumulate(values)
+    total = values[-1] / values[0] - 1
+    annual = (1 + total) ** (242.0 / max(len(values), 1)) - 1
+    return {
+        'total_return': float(total),
+        'annual_return': float(annual),
+        'max_drawdown': float(np.max(1 - values / peak)),
+        'days': int(len(values)),
+    }
+
+
+def run_parameter_grid(store_path, param_sets, start, end, initial_cash=1000000.0, processes=None,
+                       log_level=logging.WARNING):
+    """多组独立参数在进程池中并行回测，子进程只接收面板路径与参数"""
+    jobs = [{'store_path': store_path, 'start': start, 'end': end, 'params': p,
+             'initial_cash': initial_cash, 'log_level': log_level} for p in param_sets]
+    with ProcessPoolExecutor(max_workers=processes or os.cpu_count()) as pool:
+        results = list(pool.map(_run_job, jobs))
+    for res in results:
+        res['summary'] = summarize_nav(res['nav'])
+    return results
+
+
+# ---------------------------------------------------------------------------
+# 一致性检查
+# ---------------------------------------------------------------------------
+
+def check_replay(store_path, start, day, params=None, initial_cash=1000000.0):
+    """
+    开启接口录制从 start 回测到 day，再用 小市值策略_回放.py 回放 day 当天的轨迹。
+    返回回放报告；当天有委托且回放产生的委托与录制完全一致时 report['ok'] 为True
+    """
+    research = tempfile.mkdtemp(prefix='small_cap_replay_')
+    try:
+        run_backtest(store_path, start, day, params=dict(params or {}, api_trace_enabled=True),
+                     initial_cash=initial_cash, research_path=research)
+        path = os.path.join(research, 'small_cap_trace', 'trace_%s.pkl.gz' % _to_date(day).strftime('%Y%m%d'))
+        spec = importlib.util.spec_from_file_location('small_cap_replay_check', REPLAY_FILE)
+        replay_tool = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(replay_tool)
+        # 回放中的策略日志与录制时重复，只保留错误
+        logging.getLogger('small_cap.strategy').setLevel(logging.ERROR)
+        report = replay_tool.replay(path)
+    finally:
+        shutil.rmtree(research, ignore_errors=True)
+    report['ok'] = bool(report['orders_recorded']) and report['orders_identical']
+    return report
+
+
+def check_walk_forward(store_path, start, end, window_days, params=None, initial_cash=1000000.0, rtol=1e-9):
+    """
+    串行滚动窗口与一次性回测逐日比对净值：窗口交接不丢失状态、不跳过边界日收益时两者一致。
+    返回 (是否一致, [(日期, 一次性回测净值, 滚动窗口净值), ...] 不一致的日期)
+    """
+    single = run_backtest(store_path, start, end, params=params, initial_cash=initial_cash)['nav']
+    chained = run_walk_forward(store_path, start, end, window_days, params=params, initial_cash=initial_cash,
+                               processes=1)['nav']
+    if [day for day, _ in single] != [day for day, _ in chained]:
+        return False, []
+    diffs = [(day, a, b) for (day, a), (_, b) in zip(single, chained) if abs(a - b) > rtol * max(abs(a), 1.0)]
+    return not diffs, diffs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='小市值策略离线滚动回测/参数并行')
+    parser.add_argument('--store', required=True, help='面板目录')
+    parser.add_argument('--start', required=True)
+    parser.add_argument('--end', required=True)
+    parser.add_argument('--window', type=int, default=0, help='滚动窗口交易日数，0表示不切分')
+    parser.add_argument('--warmup', type=int, default=10, help='并行窗口预热交易日数')
+    parser.add_argument('--tolerance', type=float, default=0.02, help='并行窗口交接状态的持仓权重容差')
+    parser.add_argument('--grid', help='参数网格JSON文件，内容为参数字典列表')
+    parser.add_argument('--cash', type=float, default=1000000.0)
+    parser.add_argument('--processes', type=int, default=None, help='进程数，默认全部核心')
+    parser.add_argument('--output', help='结果输出JSON文件')
+    parser.add_argument('--metrics', action='store_true',
+                        help='开启运行指标，写入研究目录 small_cap_metrics/metrics.db 供 小市值策略_报告.py 使用')
+    parser.add_argument('--check-walk-forward', action='store_true',
+                        help='串行 --window 滚动窗口与一次性回测逐日比对净值，不一致时返回码为1')
+    parser.add_argument('--check-replay', action='store_true',
+                        help='录制 --start 至 --end 的轨迹并回放 --end 当天，委托不一致或当天无委托时返回码为1')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    t0 = time.time()
+    extra = {'metrics_enabled': True} if args.metrics else {}
+    if args.check_walk_forward:
+        ok, diffs = check_walk_forward(args.store, args.start, args.end, args.window or 40, params=extra or None,
+                                       initial_cash=args.cash)
+        log.info('滚动窗口一致性检查: %s', '逐日净值一致' if ok else '%d 个交易日不一致' % len(diffs))
+        for day, a, b in diffs[:10]:
+            log.info('  %s 一次性回测 %.2f, 滚动窗口 %.2f', day, a, b)
+        return 0 if ok else 1
+    if args.check_replay:
+        report = check_replay(args.store, args.start, args.end, params=extra or None, initial_cash=args.cash)
+        log.info('回放检查 %s: 录制委托 %d 笔, 回放委托 %d 笔, 一致 %s, 未命中调用 %d 次',
+                 args.end, len(report['orders_recorded']), len(report['orders_replayed']),
+                 report['orders_identical'], len(report['misses']))
+        return 0 if report['ok'] else 1
+    if args.grid:
+        with open(args.grid, encoding='utf-8') as f:
+            param_sets = [dict(p, **extra) for p in json.load(f)]
+        results = run_parameter_grid(args.store, param_sets, args.start, args.end,
+                                     initial_cash=args.cash, processes=args.processes)
+        for res in results:
+            s = res['summary']
+            log.info('参数 %s: 总收益 %.2f%%, 年化 %.2f%%, 最大回撤 %.2f%%, 耗时 %.1fs',
+                     res['params'], s['total_return'] * 100, s['annual_return'] * 100,
+                     s['max_drawdown'] * 100, res['elapsed'])
+        output = results
+    else:
+        if args.window:
+            output = run_walk_forward(args.store, args.start, args.end, args.window, params=extra or None,
+                                      initial_cash=args.cash,
+                                      processes=args.processes, warmup_days=args.warmup,
+                                      handoff_tolerance=args.tolerance)
+            log.info('滚动窗口 %d 个，重跑 %d 个', len(output['windows']), output['reruns'])
+        else:
+            output = run_backtest(args.store, args.start, args.end, params=extra or None, initial_cash=args.cash)
+        s = summarize_nav(output['nav'])
+        output['summary'] = s
+        log.info('总收益 %.2f%%, 年化 %.2f%%, 最大回撤 %.2f%%',
+                 s['total_return'] * 100, s['annual_return'] * 100, s['max_drawdown'] * 100)
+    log.info('总耗时 %.1fs', time.time() - t0)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(output, f, ensure_ascii=False, default=str)
+
+
+if __name__ == '__main__':
+    sys.exit(main())